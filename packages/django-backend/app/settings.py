@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import sys
 import warnings
 
 import redis
@@ -22,6 +23,9 @@ FRONTEND_DIR = os.path.join(BASE_DIR, "..", "react-frontend")
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.1/howto/deployment/checklist/
 
+# Whether we are being run by `manage.py test`
+TESTING = len(sys.argv) > 1 and sys.argv[1] == "test"
+
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = "ll(_n((i#1q@k!3#1@g)tebwh25*4nicwj7lm63aq181*7@b(j"
 
@@ -200,6 +204,21 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 # Files in this directory will be served at the server root.
 WHITENOISE_ROOT = os.path.join(FRONTEND_DIR, "root")
 
+# -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
+# Cache
+
+# The cache is how the task workers find out that the lexicon has changed
+# (see `lexicon.registry`), so it has to be shared between the server and
+# the workers.  Every process is connected to the database already, so it
+# doubles as the cache backend; the cache table is created by the `lexicon`
+# migrations.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "cs_toolkit_cache",
+    }
+}
+
 # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
 # Channels
 ASGI_APPLICATION = "app.routing.application"
@@ -209,6 +228,8 @@ CHANNEL_LAYERS = {
         "CONFIG": {"hosts": [("127.0.0.1", 6379)]},
     }
 }
+if TESTING:
+    CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
 
 # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
 # DRF
@@ -240,8 +261,63 @@ DRAMATIQ_BROKER = {
     "MIDDLEWARE": [
         "dramatiq.middleware.AgeLimit",
         "dramatiq.middleware.TimeLimit",
+        "dramatiq.middleware.CurrentMessage",
         "dramatiq.middleware.Retries",
         "django_dramatiq.middleware.AdminMiddleware",
         "django_dramatiq.middleware.DbConnectionsMiddleware",
     ],
 }
+if TESTING:
+    # The tests run their own workers against an in-memory broker (see
+    # `grammar.tests`).
+    DRAMATIQ_BROKER = {
+        "BROKER": "dramatiq.brokers.stub.StubBroker",
+        "OPTIONS": {},
+        "MIDDLEWARE": [
+            "dramatiq.middleware.CurrentMessage",
+            "dramatiq.middleware.Retries",
+            "django_dramatiq.middleware.DbConnectionsMiddleware",
+        ],
+    }
+
+# How Derivations are processed:
+# - "broker": Each DerivationStep is processed as a separate task.
+# - "dfs"/"bfs"/"best": Each Derivation is explored as a whole by a single
+#   worker (depth-first/breadth-first/best-first), and its DerivationSteps
+#   are saved in bulk every DERIVATION_ENGINE_CHECKPOINT steps.
+# Best-first search expands the most promising steps first, according to
+# DERIVATION_HEURISTIC: One of the names in `grammar.search.HEURISTICS`, or
+# the dotted path to a custom heuristic function.
+DERIVATION_ENGINE = os.getenv("DERIVATION_ENGINE", "broker")
+DERIVATION_ENGINE_CHECKPOINT = 500
+# The number of seconds after which a search that has not reached a
+# checkpoint is presumed abandoned, and the Derivation can be searched by
+# another worker.
+DERIVATION_ENGINE_LEASE = 600
+# In "broker" mode, the number of DerivationSteps to send in each message
+DERIVATION_BATCH_SIZE = 16
+# In "broker" mode, how often (and after how many milliseconds, at first)
+# to retry a batch of DerivationSteps that failed with a transient error
+# (e.g., if the database was briefly unavailable).  Steps that still fail
+# after the last retry are crashed and marked as failed.
+DERIVATION_MAX_RETRIES = 5
+DERIVATION_MIN_BACKOFF = 1000
+if TESTING:
+    DERIVATION_MIN_BACKOFF = 10
+DERIVATION_HEURISTIC = os.getenv("DERIVATION_HEURISTIC", "closest-to-convergence")
+
+# Default search budget for each Derivation, for any limits that are not
+# set in the DerivationRequest.  When a limit is hit, the Derivation is
+# completed with the chains found so far and marked as truncated.
+# - max_steps: DerivationSteps processed
+# - max_depth: Steps in any single chain
+# - max_seconds: Wall-clock time since the first step was processed
+# - max_frontier: DerivationSteps waiting to be processed
+# - max_converged: Converged chains to find before stopping
+DERIVATION_BUDGET = {
+    "max_steps": 50000,
+    "max_depth": None,
+    "max_seconds": 600,
+    "max_frontier": 10000,
+    "max_converged": None,
+}
@@ -8,8 +8,10 @@ from .models import (
     DerivationRequest,
     DerivationStep,
     GeneratorDescription,
+    GrammarConfiguration,
     LexicalArrayItem,
     RuleDescription,
+    SharedSyntacticObject,
     SyntacticObject,
 )
 
@@ -42,7 +44,6 @@ class DerivationStepAdmin(AppModelAdmin):
     list_display = ["root_so_text", "lexical_array_friendly"]
     inlines = [LexicalArrayInline]
     readonly_fields = ["id", "processed_time", "complete"]
-    filter_horizontal = ["rules"]
 
 
 # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
@@ -58,6 +59,18 @@ class SyntacticObjectAdmin(MPTTModelAdmin):
     filter_horizontal = ["features", "deleted_features"]
 
 
+@admin.register(SharedSyntacticObject)
+class SharedSyntacticObjectAdmin(AppModelAdmin):
+    list_display = [
+        "text",
+        "current_language",
+        "feature_string",
+        "deleted_feature_string",
+    ]
+    readonly_fields = ["id"]
+    filter_horizontal = ["features", "deleted_features"]
+
+
 # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
 # Rules
 @admin.register(RuleDescription)
@@ -74,3 +87,12 @@ class GeneratorDescriptionAdmin(AppModelAdmin):
     list_display = ["name", "description", "generator_class"]
     readonly_fields = ["id", "generator_class"]
     form = GeneratorDescriptionForm
+
+
+# -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
+# Grammar configurations
+@admin.register(GrammarConfiguration)
+class GrammarConfigurationAdmin(AppModelAdmin):
+    # GrammarConfigurations are immutable once created.
+    list_display = ["__str__", "content_hash"]
+    readonly_fields = ["id", "content_hash", "rules", "generators"]
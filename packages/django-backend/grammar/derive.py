@@ -3,24 +3,53 @@ The algorithm for processing a single DerivationStep.
 Imported and run by the Dramatiq task workers.
 """
 import dataclasses
+import functools
+import hashlib
 import json
 import logging
+import threading
 import time
-from typing import List
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple, Type
 
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
 from django.utils import timezone
 
 import grammar.generators
 import grammar.rules
-from grammar.generators.base import NextStepDef, Generator, GeneratorMetadata
-from grammar.models import DerivationStep, LexicalArrayItem
-from grammar.rules.base import DerivationFailed, RuleNonFatalError, Rule
+from grammar.generators.base import (
+    NextStepDef,
+    Generator,
+    GeneratorMetadata,
+    SubDerivationPending,
+)
+from grammar.models import (
+    Derivation,
+    DerivationStep,
+    GeneratorDescription,
+    GrammarConfiguration,
+    RuleDescription,
+)
+from grammar.rules.base import DerivationFailed, RuleNonFatalError, Rule, RuleResult
+from grammar.tree import SONode, load_root_so, load_root_sos, store_trees
+from lexicon.models import LexicalItem
+from lexicon.registry import feature_registry
 
 logger = logging.getLogger("cs-toolkit-grammar")
 
+# The results of incremental Rules for recently processed DerivationSteps,
+# so that their next steps can be checked incrementally if they are
+# processed in the same worker process.  (See `Rule.apply_incremental()`)
+RECENT_RULE_RESULTS_SIZE = 1024
+_recent_rule_results: "OrderedDict[str, Dict[str, RuleResult]]" = OrderedDict()
+_recent_rule_results_lock = threading.Lock()
+
 
 def process_derivation_step(
-    step: DerivationStep, derivation_actor
+    step: DerivationStep, derivation_actor, root_so: Optional[SONode] = None
 ) -> List[DerivationStep]:
     """
     Idempotent function to process the given DerivationStep.
@@ -36,12 +65,16 @@ def process_derivation_step(
       forking new ones.
     - This DerivationStep could cause the current derivational chain to
       converge.
+    - This DerivationStep could be parked until a sub-derivation completes
+      (leaving `step.status` as STATUS_WAITING).
 
     Return values:
     - A List of the next DerivationSteps to process, if any.
 
     :param step:
     :param derivation_actor:
+    :param root_so: The step's root SO, if it has already been loaded (e.g.,
+        together with those of other steps; see `.tree.load_root_sos()`)
     :return:
     """
 
@@ -73,17 +106,963 @@ def process_derivation_step(
             # Woo boy
             mark_derivation_chain_ended(step, converged=False, reprocessing=True)
             return []
+
+        if step.status == DerivationStep.STATUS_TRUNCATED:
+            return []
+
+        if step.status == DerivationStep.STATUS_WAITING:
+            # Still waiting for a sub-derivation; we will be sent again
+            # when it completes (see `resume_waiting_steps()`).
+            return []
     else:
         # Need to do clean-up if we're re-running the DerivationStep:
         # - Delete any subsequent steps
         pass
 
+    # If the Derivation has run out of search budget, this chain ends here.
+    truncate_reason = check_step_budget(step)
+    if truncate_reason:
+        with transaction.atomic():
+            if not claim_derivation_step(step, DerivationStep.STATUS_TRUNCATED):
+                return []
+            step.crash_reason = truncate_reason
+            step.processed_time = timezone.now()
+            step.save()
+            complete = count_finished_step(step.derivation, 0)
+        if complete:
+            complete_derivation(step.derivation_id, derivation_actor)
+        logger.debug("DerivationStep {} truncated.".format(step.id))
+        return []
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Phases 1 and 2: Rule checking and generation (see `expand_state()`)
+
+    # Rules and Generators work with an in-memory copy of the root SO.
+    if root_so is None:
+        root_so = load_root_so(step)
+
+    step_metadata = None
+    if step.generator_metadata_json:
+        # Convert metadata: json -> dict -> GeneratorMetadata
+        step_metadata = json.loads(step.generator_metadata_json)
+        step_metadata = GeneratorMetadata(**step_metadata)
+
+    pipeline = get_pipeline(step.configuration_id)
+    lexical_array_tail = step.lexical_array_tail
+
+    # If an identical step has been processed before (possibly in a
+    # different Derivation), we can reuse its results.
+    prune = step.derivation.prune
+    step.fingerprint = get_fingerprint(
+        root_so, lexical_array_tail, pipeline.content_hash, step_metadata, prune
+    )
+    outcome = get_memoized_outcome(step.fingerprint, step.id)
+    if outcome is None:
+        outcome = expand_state(
+            root_so,
+            lexical_array_tail,
+            step_metadata,
+            pipeline.rule_handlers,
+            pipeline.generator_handlers,
+            derivation_actor,
+            previous_rule_results=recall_rule_results(step.previous_step_id),
+            prune=prune,
+        )
+
+    if outcome.status == DerivationStep.STATUS_WAITING:
+        # Park this step until its sub-derivation completes, instead of
+        # holding up the worker.
+        park_derivation_step(step, outcome.sub_derivation_id, derivation_actor)
+        logger.debug(
+            "DerivationStep {} waiting for sub-derivation {}.".format(
+                step.id, outcome.sub_derivation_id
+            )
+        )
+        return []
+
+    if outcome.status != DerivationStep.STATUS_PROCESSED:
+        # This Derivation chain has converged or reached a bad end.
+        with transaction.atomic():
+            if not claim_derivation_step(step, outcome.status):
+                return []
+            step.rule_errors_json = json.dumps(outcome.rule_errors)
+            step.crash_reason = outcome.crash_reason
+            step.processed_time = timezone.now()
+            step.save()
+            mark_derivation_chain_ended(
+                step, converged=outcome.status == DerivationStep.STATUS_CONVERGED
+            )
+            complete = count_finished_step(step.derivation, 0)
+        if complete:
+            complete_derivation(step.derivation_id, derivation_actor)
+        logger.debug(
+            "DerivationStep {} {}: {}".format(
+                step.id, outcome.status.lower(), outcome.crash_reason
+            )
+        )
+        return []
+
+    # (The error messages are saved to the DerivationStep in Phase 4)
+    step.rule_errors_json = json.dumps(outcome.rule_errors)
+    remember_rule_results(step.id, outcome.rule_results)
+
+    next_step_defs = outcome.next_step_defs
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Phase 3: Cleanup
+
+    # If our Generators provided at least one next step and our Rules didn't
+    # crash the Derivation, the show goes on.
+
+    # Create actual DerivationSteps for each of our next steps, all at once.
+    start_time = time.perf_counter()
+
+    # Identical states that other chains in this Derivation have already
+    # reached (at the same depth) are only processed once: We join the
+    # existing DerivationSteps instead of creating new ones.  Identical next steps from this step
+    # itself (e.g., from Internal-Merging copies that look the same) would
+    # only lead to identical chains, so all but the first are dropped.
+    fingerprints = [
+        get_fingerprint(
+            next_step_def.root_so,
+            next_step_def.lexical_array_tail,
+            pipeline.content_hash,
+            next_step_def.metadata,
+            prune,
+        )
+        for next_step_def in next_step_defs
+    ]
+    existing_step_ids = get_existing_step_ids(step, fingerprints)
+
+    next_steps: List[DerivationStep] = []
+    new_step_defs: List[NextStepDef] = []
+    joined_step_ids = []
+    seen_fingerprints = set()
+    for next_step_def, fingerprint in zip(next_step_defs, fingerprints):
+        if fingerprint in seen_fingerprints:
+            step.duplicate_count += 1
+            continue
+        seen_fingerprints.add(fingerprint)
+
+        if fingerprint in existing_step_ids:
+            joined_step_ids.append(existing_step_ids[fingerprint])
+            continue
+
+        # (Inheriting the Rules and Generators of this step)
+        next_step = DerivationStep(
+            derivation_id=step.derivation_id,
+            previous_step_id=step.id,
+            configuration_id=step.configuration_id,
+            fingerprint=fingerprint,
+            depth=step.depth + 1,
+        )
+
+        # Add metadata from generators
+        if next_step_def.metadata is not None:
+            next_step.generator_metadata_json = json.dumps(
+                dataclasses.asdict(next_step_def.metadata)
+            )
+
+        next_steps.append(next_step)
+        new_step_defs.append(next_step_def)
+
+    # The next steps are only saved by the worker that gets to finish this
+    # step, along with the step itself.
+    with transaction.atomic():
+        if not claim_derivation_step(step, DerivationStep.STATUS_PROCESSED):
+            return []
+
+        create_derivation_steps(
+            next_steps,
+            root_sos=[next_step_def.root_so for next_step_def in new_step_defs],
+            lexical_array_tails=[
+                next_step_def.lexical_array_tail for next_step_def in new_step_defs
+            ],
+        )
+        join_derivation_steps(
+            [(joined_step_id, step.id) for joined_step_id in joined_step_ids]
+        )
+        link_sub_derivations(
+            (step.id, sub_derivation_id)
+            for sub_derivation_id in get_sub_derivation_ids(next_step_defs)
+        )
+
+        step.processed_time = timezone.now()
+        step.save()
+        complete = count_finished_step(step.derivation, len(next_steps))
+
+    if step.duplicate_count:
+        logger.debug(
+            "Dropped {} duplicate next steps for DerivationStep {}.".format(
+                step.duplicate_count, step.id
+            )
+        )
+    logger.debug("Cleanup took {:.3f}s.".format(time.perf_counter() - start_time))
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Phase 4: Dispatch
+
+    # If all our next steps were joined, this may have been the last pending
+    # step in the Derivation.
+    if complete:
+        complete_derivation(step.derivation_id, derivation_actor)
+
+    # Return the next DerivationSteps for processing.
+    return next_steps
+
+
+def create_derivation_steps(
+    steps: List[DerivationStep],
+    root_sos: List[Optional[SONode]],
+    lexical_array_tails: List[Iterable[LexicalItem]],
+) -> None:
+    """
+    Saves the given (new) DerivationSteps, together with their root SOs and
+    lexical array offsets.
+
+    Everything is written with a handful of bulk queries within a single
+    transaction, rather than a few queries per step.  The steps' other
+    fields (including `configuration`) should already be set.  If any of the
+    steps refer to each other via `previous_step`, parents must come before
+    their children.
+
+    :param steps:
+    :param root_sos: The root SO for each step
+    :param lexical_array_tails: The lexical array tail for each step; must
+        be a suffix of the Derivation's lexical array
+    :return:
+    """
+    if not steps:
+        return
+
+    for step, lexical_array_tail in zip(steps, lexical_array_tails):
+        step.set_lexical_array_tail(lexical_array_tail)
+
+    with transaction.atomic():
+        # Root SOs go to the shared store first.
+        stored_ids = iter(
+            store_trees([root_so for root_so in root_sos if root_so is not None])
+        )
+        for step, root_so in zip(steps, root_sos):
+            if root_so is not None:
+                step.shared_root_so_id = next(stored_ids)
+
+        DerivationStep.objects.bulk_create(steps)
+
+
+def claim_derivation_step(step: DerivationStep, status: str) -> bool:
+    """
+    Atomically moves the given (pending) DerivationStep to the given status,
+    so that only one worker gets to finish processing it, even if it was
+    sent more than once (e.g., when re-processing a chain, or if a message
+    was delivered twice).
+    Should be run within a transaction, together with the rest of the
+    step's results and `count_finished_step()`.
+    :param step:
+    :param status:
+    :return: False if another worker has already finished the step
+    """
+    claimed = DerivationStep.objects.filter(
+        id=step.id, status=DerivationStep.STATUS_PENDING
+    ).update(status=status)
+    step.status = status
+    return claimed > 0
+
+
+def count_finished_step(derivation: Derivation, next_step_count: int) -> bool:
+    """
+    Atomically adds the given number of new DerivationSteps to the
+    Derivation's pending count, and moves the one that finished from its
+    pending count to its processed count.
+    Should be run within the same transaction as `claim_derivation_step()`,
+    so that every step is counted exactly once.
+
+    The given Derivation's counters (and `truncated` flag) are refreshed
+    from the database at the same time, for `check_step_budget()`.
+    :param derivation:
+    :param next_step_count:
+    :return: True if there are no more pending DerivationSteps in the
+        Derivation
+    """
+    Derivation.objects.filter(id=derivation.id).update(
+        created_count=F("created_count") + next_step_count,
+        processed_count=F("processed_count") + 1,
+        pending_count=F("pending_count") + next_step_count - 1,
+    )
+
+    # The update locks the Derivation's row until the end of the
+    # transaction, so the count we read back cannot have been changed by
+    # other workers in the meantime, and exactly one worker will see it
+    # reach zero.
+    (
+        derivation.created_count,
+        derivation.processed_count,
+        derivation.pending_count,
+        derivation.truncated,
+    ) = (
+        Derivation.objects.filter(id=derivation.id)
+        .values_list("created_count", "processed_count", "pending_count", "truncated")
+        .get()
+    )
+    return derivation.pending_count == 0
+
+
+def complete_derivation(derivation_id, derivation_actor) -> None:
+    """
+    Marks the given Derivation (and all its DerivationSteps) complete, once
+    all its chains have been processed.
+    :param derivation_id:
+    :param derivation_actor:
+    :return:
+    """
+    DerivationStep.objects.filter(derivation_id=derivation_id).update(complete=True)
+
+    # (Only save the fields we changed: The search counters may have been
+    # updated in the meantime.)
+    derivation: Derivation = Derivation.objects.get(id=derivation_id)
+    derivation.complete = True
+    update_fields = ["complete"]
+    if (
+        not derivation.truncated
+        and derivation.derivationstep_set.filter(
+            status=DerivationStep.STATUS_TRUNCATED
+        ).exists()
+    ):
+        # Some chains were cut off for being too long.
+        derivation.truncated = True
+        update_fields.append("truncated")
+    derivation.save(update_fields=update_fields)
+
+    # Continue any chains that were waiting for this Derivation as a
+    # sub-derivation.
+    resume_waiting_steps(derivation_id, derivation_actor)
+
+
+def reopen_derivation(derivation: Derivation, budget: Dict[str, int]) -> bool:
+    """
+    Reopens the given Derivation if its search was cut off, and the given
+    search budget is larger than the one it was searched with: Its
+    truncated DerivationSteps become pending again, so that the search
+    carries on from where it stopped (once the Derivation is started again).
+    :param derivation:
+    :param budget: The new limits, from `Derivation.BUDGET_FIELDS`
+    :return: True if the Derivation was reopened
+    """
+    current_budget = SearchBudget.for_derivation(derivation)
+    if not any(
+        getattr(current_budget, limit) is not None
+        and value > getattr(current_budget, limit)
+        for limit, value in budget.items()
+    ):
+        return False
+
+    with transaction.atomic():
+        # (Only one request gets to reopen the Derivation.)
+        reopened = Derivation.objects.filter(
+            id=derivation.id, complete=True, truncated=True
+        ).update(complete=False, truncated=False, start_time=None, **budget)
+        if not reopened:
+            return False
+
+        # Truncated steps were counted as processed; they will be counted
+        # again when they are actually processed.
+        reopened_count = DerivationStep.objects.filter(
+            derivation=derivation, status=DerivationStep.STATUS_TRUNCATED
+        ).update(
+            status=DerivationStep.STATUS_PENDING, crash_reason="", processed_time=None
+        )
+        DerivationStep.objects.filter(derivation=derivation).update(complete=False)
+        Derivation.objects.filter(id=derivation.id).update(
+            processed_count=F("processed_count") - reopened_count,
+            pending_count=reopened_count,
+        )
+
+    logger.info(
+        "Reopened Derivation {}: {} truncated steps".format(
+            derivation.id, reopened_count
+        )
+    )
+    derivation.refresh_from_db()
+    return True
+
+
+def park_derivation_step(
+    step: DerivationStep, sub_derivation_id, derivation_actor
+) -> None:
+    """
+    Parks the given DerivationStep until the given sub-derivation completes.
+    :param step:
+    :param sub_derivation_id:
+    :param derivation_actor:
+    :return:
+    """
+    # (A parked step is still pending as far as the Derivation is concerned,
+    # so the pending and processed counts are left alone.)
+    with transaction.atomic():
+        if not claim_derivation_step(step, DerivationStep.STATUS_WAITING):
+            return
+        # (The claim has already saved the new status.)
+        step.save(update_fields=["fingerprint"])
+        step.sub_derivations.add(sub_derivation_id)
+
+    # The sub-derivation may have completed while we were busy, in which case
+    # nobody else will resume the step.
+    if Derivation.objects.filter(id=sub_derivation_id, complete=True).exists():
+        resume_waiting_steps(sub_derivation_id, derivation_actor)
+
+
+def fail_derivation_step(
+    step: DerivationStep, crash_reason: str, derivation_actor
+) -> None:
+    """
+    Crashes the given DerivationStep without processing it, if processing it
+    raised an unexpected error, so that its Derivation can still complete.
+    The step is marked as `failed` rather than being counted as one of the
+    Derivation's crashed chains.
+    :param step:
+    :param crash_reason:
+    :param derivation_actor:
+    :return:
+    """
+    with transaction.atomic():
+        if not claim_derivation_step(step, DerivationStep.STATUS_CRASHED):
+            return
+        step.rule_errors_json = json.dumps([])
+        step.crash_reason = crash_reason
+        step.failed = True
+        step.processed_time = timezone.now()
+        step.save(
+            update_fields=[
+                "rule_errors_json",
+                "crash_reason",
+                "failed",
+                "processed_time",
+            ]
+        )
+        complete = count_finished_step(step.derivation, 0)
+    if complete:
+        complete_derivation(step.derivation_id, derivation_actor)
+
+
+def resume_waiting_steps(derivation_id, derivation_actor) -> None:
+    """
+    Sends the DerivationSteps that were waiting for the given (complete)
+    sub-derivation to be processed again.
+    :param derivation_id:
+    :param derivation_actor:
+    :return:
+    """
+    waiting_step_ids = DerivationStep.objects.filter(
+        sub_derivations=derivation_id, status=DerivationStep.STATUS_WAITING
+    ).values_list("id", flat=True)
+    for step_id in waiting_step_ids:
+        # Both the sub-derivation's last step and the parked step itself may
+        # try to resume the step, so it is claimed first.
+        claimed = DerivationStep.objects.filter(
+            id=step_id, status=DerivationStep.STATUS_WAITING
+        ).update(status=DerivationStep.STATUS_PENDING)
+        if claimed:
+            logger.debug("Resuming DerivationStep {}.".format(step_id))
+            derivation_actor.send(str(step_id))
+
+
+def get_existing_step_ids(step: DerivationStep, fingerprints: Iterable[str]) -> Dict:
+    """
+    Finds the DerivationSteps in the given step's Derivation that have any
+    of the given fingerprints, other than the given step's own next steps.
+    Only steps at the same depth as the given step's next steps are
+    considered, so that joined chains agree on the depth of every step (and
+    hence on where `SearchBudget.max_depth` cuts them off).
+    :param step:
+    :param fingerprints:
+    :return: A Dict mapping fingerprints to DerivationStep ids
+    """
+    return dict(
+        DerivationStep.objects.filter(
+            derivation_id=step.derivation_id,
+            fingerprint__in=set(fingerprints),
+            depth=step.depth + 1,
+        )
+        .exclude(previous_step_id=step.id)
+        .values_list("fingerprint", "id")
+    )
+
+
+def join_derivation_steps(links: Iterable[Tuple]) -> None:
+    """
+    Records additional previous steps for existing DerivationSteps (see
+    `DerivationStep.joined_previous_steps`).
+    :param links: (step_id, previous_step_id) pairs
+    :return:
+    """
+    through = DerivationStep.joined_previous_steps.through
+    through.objects.bulk_create(
+        [
+            through(from_derivationstep_id=step_id, to_derivationstep_id=previous_id)
+            for step_id, previous_id in links
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def link_sub_derivations(links: Iterable[Tuple]) -> None:
+    """
+    Records the sub-derivations that DerivationSteps have used or are
+    waiting for (see `DerivationStep.sub_derivations`).
+    :param links: (step_id, sub_derivation_id) pairs
+    :return:
+    """
+    through = DerivationStep.sub_derivations.through
+    through.objects.bulk_create(
+        [
+            through(derivationstep_id=step_id, derivation_id=sub_derivation_id)
+            for step_id, sub_derivation_id in links
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def get_sub_derivation_ids(next_step_defs: Iterable[NextStepDef]) -> Set[str]:
+    """
+    Returns the ids of the sub-derivations that the given next steps merged
+    SOs from (see `GeneratorMetadata.sub_derivation`).
+    :param next_step_defs:
+    :return:
+    """
+    return {
+        next_step_def.metadata.sub_derivation
+        for next_step_def in next_step_defs
+        if next_step_def.metadata is not None
+        and next_step_def.metadata.sub_derivation is not None
+    }
+
+
+@dataclass
+class StepOutcome:
+    """
+    The result of expanding a single derivation state (see `expand_state()`).
+    """
+
+    # One of the `DerivationStep.STATUS_*` values, other than
+    # STATUS_PENDING and STATUS_TRUNCATED.
+    status: str
+
+    # Any non-fatal Rule errors.
+    rule_errors: List[RuleNonFatalError] = field(default_factory=list)
+
+    # If the state crashed, the reason why.
+    crash_reason: str = ""
+
+    # If the state was processed, the definitions of the next states.
+    next_step_defs: List[NextStepDef] = field(default_factory=list)
+
+    # The results of any incremental Rules, by Rule class name, to be passed
+    # on when the next states are expanded.
+    rule_results: Dict[str, RuleResult] = field(default_factory=dict)
+
+    # If the state is waiting for a sub-derivation, its id.
+    sub_derivation_id: Optional[str] = None
+
+
+def remember_rule_results(step_id, rule_results: Dict[str, RuleResult]) -> None:
+    """
+    Keeps the given incremental Rule results for the DerivationStep with the
+    given id, for when its next steps are processed.
+    :param step_id:
+    :param rule_results:
+    :return:
+    """
+    if not rule_results:
+        return
+
+    with _recent_rule_results_lock:
+        _recent_rule_results[str(step_id)] = rule_results
+        while len(_recent_rule_results) > RECENT_RULE_RESULTS_SIZE:
+            _recent_rule_results.popitem(last=False)
+
+
+def recall_rule_results(step_id) -> Optional[Dict[str, RuleResult]]:
+    """
+    Returns the incremental Rule results for the DerivationStep with the
+    given id, if it was recently processed in this process.
+    :param step_id:
+    :return:
+    """
+    if step_id is None:
+        return None
+
+    with _recent_rule_results_lock:
+        return _recent_rule_results.get(str(step_id))
+
+
+def get_fingerprint(
+    root_so: Optional[SONode],
+    lexical_array_tail: Iterable[LexicalItem],
+    configuration_hash: str,
+    metadata: Optional[GeneratorMetadata],
+    prune: bool,
+) -> str:
+    """
+    Computes the canonical fingerprint for a derivation state: Two states
+    with the same fingerprint will be processed in exactly the same way.
+
+    Of the GeneratorMetadata, only `last_generator` is considered, since
+    the other attributes are informational.
+
+    The Features of the lexical items are not part of the state, so the
+    current lexicon generation (see `lexicon.registry`) is included
+    instead: States from before a change to the lexicon won't match any
+    states after it.
+    :param root_so:
+    :param lexical_array_tail:
+    :param configuration_hash: The `content_hash` of the GrammarConfiguration
+    :param metadata:
+    :param prune: The `prune` flag of the state's Derivation
+    :return:
+    """
+    content = json.dumps(
+        [
+            root_so.digest if root_so is not None else None,
+            [str(lexical_item.pk) for lexical_item in lexical_array_tail],
+            configuration_hash,
+            metadata.last_generator if metadata is not None else None,
+            prune,
+            feature_registry.generation,
+        ]
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+# DerivationSteps in these states have no outcome that could be reused.
+# (Neither do failed steps; see `DerivationStep.failed`)
+UNFINISHED_STATUSES = (
+    DerivationStep.STATUS_PENDING,
+    DerivationStep.STATUS_TRUNCATED,
+    DerivationStep.STATUS_WAITING,
+)
+
+# The maximum number of fingerprints to look up in a single query (cf. the
+# limit on query parameters in SQLite)
+MEMO_LOOKUP_BATCH_SIZE = 500
+
+
+def get_memoized_outcome(
+    fingerprint: str, exclude_step_id=None
+) -> Optional[StepOutcome]:
+    """
+    Retrieves the outcome of an already-processed DerivationStep with the
+    given fingerprint, if there is one.
+    :param fingerprint:
+    :param exclude_step_id: The id of the DerivationStep being processed,
+        which should not be considered
+    :return:
+    """
+    memo: DerivationStep = (
+        DerivationStep.objects.filter(fingerprint=fingerprint, failed=False)
+        .exclude(status__in=UNFINISHED_STATUSES)
+        .exclude(id=exclude_step_id)
+        .first()
+    )
+    if memo is None:
+        return None
+
+    logger.debug("Reusing results from DerivationStep {}.".format(memo.id))
+
+    outcome = StepOutcome(
+        status=memo.status,
+        rule_errors=json.loads(memo.rule_errors_json or "[]"),
+        crash_reason=memo.crash_reason,
+    )
+
+    if memo.status == DerivationStep.STATUS_PROCESSED:
+        next_steps: List[DerivationStep] = list(memo.next_steps.all()) + list(
+            memo.joined_next_steps.all()
+        )
+
+        # Load all the next root SOs in one go.
+        root_sos = load_root_sos(next_steps)
+
+        for next_step, root_so in zip(next_steps, root_sos):
+            metadata = None
+            if next_step.generator_metadata_json:
+                metadata = GeneratorMetadata(
+                    **json.loads(next_step.generator_metadata_json)
+                )
+
+            outcome.next_step_defs.append(
+                NextStepDef(
+                    lexical_array_tail=next_step.lexical_array_tail,
+                    root_so=root_so,
+                    metadata=metadata,
+                )
+            )
+
+    return outcome
+
+
+def get_memoized_fingerprints(fingerprints: Iterable[str]) -> Set[str]:
+    """
+    Returns the subset of the given fingerprints that belong to
+    already-processed DerivationSteps (i.e., the ones that
+    `get_memoized_outcome()` would find), with as few queries as possible.
+    :param fingerprints:
+    :return:
+    """
+    fingerprints = list(set(fingerprints))
+    memoized = set()
+    for idx in range(0, len(fingerprints), MEMO_LOOKUP_BATCH_SIZE):
+        memoized.update(
+            DerivationStep.objects.filter(
+                fingerprint__in=fingerprints[idx : idx + MEMO_LOOKUP_BATCH_SIZE],
+                failed=False,
+            )
+            .exclude(status__in=UNFINISHED_STATUSES)
+            .values_list("fingerprint", flat=True)
+        )
+    return memoized
+
+
+@dataclass
+class Pipeline:
+    """
+    The Rule and Generator classes for a GrammarConfiguration, in the order
+    that they are applied.
+    """
+
+    content_hash: str
+    rule_handlers: List[Type[Rule]]
+    generator_handlers: List[Type[Generator]]
+
+
+@functools.lru_cache(maxsize=128)
+def get_pipeline(configuration_id) -> Pipeline:
+    """
+    Returns the Rule and Generator classes for the GrammarConfiguration with
+    the given id.
+    GrammarConfigurations are immutable, so the result is cached for the
+    lifetime of the process.
+    :param configuration_id:
+    :return:
+    """
+    if configuration_id is None:
+        return Pipeline(
+            content_hash=GrammarConfiguration.get_content_hash([], []),
+            rule_handlers=[],
+            generator_handlers=[],
+        )
+
+    configuration = GrammarConfiguration.objects.get(id=configuration_id)
+    return Pipeline(
+        content_hash=configuration.content_hash,
+        rule_handlers=get_rule_handlers(configuration.rules.all()),
+        generator_handlers=get_generator_handlers(configuration.generators.all()),
+    )
+
+
+def get_rule_handlers(rules: Iterable[RuleDescription]) -> List[Type[Rule]]:
+    """
+    Returns the Rule classes for the given RuleDescriptions.
+    :param rules:
+    :return:
+    """
+    return [getattr(grammar.rules, rule.rule_class) for rule in rules]
+
+
+def get_generator_handlers(
+    generators: Iterable[GeneratorDescription],
+) -> List[Type[Generator]]:
+    """
+    Returns the Generator classes for the given GeneratorDescriptions.
+    :param generators:
+    :return:
+    """
+    return [
+        getattr(grammar.generators, generator.generator_class)
+        for generator in generators
+    ]
+
+
+@dataclass
+class SearchBudget:
+    """
+    Limits on how much of a Derivation's state space may be explored.
+    Limits that are None are not enforced.
+    """
+
+    # The number of DerivationSteps processed
+    max_steps: Optional[int] = None
+    # The length of any single chain (see `DerivationStep.depth`)
+    max_depth: Optional[int] = None
+    # The wall-clock time since the search was started
+    max_seconds: Optional[int] = None
+    # The number of DerivationSteps waiting to be processed
+    max_frontier: Optional[int] = None
+    # The number of converged chains to look for; the search stops once it
+    # has found them ("first N convergences")
+    max_converged: Optional[int] = None
+
+    @staticmethod
+    def for_derivation(derivation: Derivation) -> "SearchBudget":
+        """
+        Returns the budget for the given Derivation: Its own limits, if set,
+        or the global defaults from the DERIVATION_BUDGET setting.
+        :param derivation:
+        :return:
+        """
+        defaults = getattr(settings, "DERIVATION_BUDGET", {})
+        budget = SearchBudget()
+        for budget_field in dataclasses.fields(SearchBudget):
+            limit = getattr(derivation, budget_field.name)
+            if limit is None:
+                limit = defaults.get(budget_field.name)
+            setattr(budget, budget_field.name, limit)
+        return budget
+
+    def check_depth(self, depth: int) -> str:
+        """
+        Checks a single chain against the budget.
+        :param depth: The depth of the next step in the chain
+        :return: The reason the chain should be cut off, or "" if it may
+            continue
+        """
+        if self.max_depth is not None and depth > self.max_depth:
+            return "Search budget exceeded: More than {} steps in the chain.".format(
+                self.max_depth
+            )
+        return ""
+
+    def check(
+        self,
+        processed_count: int,
+        frontier_size: int,
+        start_time,
+        converged_count: int = 0,
+    ) -> str:
+        """
+        Checks the search as a whole against the budget.
+        :param processed_count: The number of steps processed so far,
+            including the next one
+        :param frontier_size: The number of steps waiting to be processed
+        :param start_time: When the search was started, if known
+        :param converged_count: The number of converged steps found so far
+        :return: The reason the search should be cut off, or "" if it may
+            continue
+        """
+        if self.max_converged is not None and converged_count >= self.max_converged:
+            return "Search budget exceeded: {} converged chains found.".format(
+                converged_count
+            )
+        if self.max_steps is not None and processed_count > self.max_steps:
+            return "Search budget exceeded: More than {} steps processed.".format(
+                self.max_steps
+            )
+        if self.max_frontier is not None and frontier_size > self.max_frontier:
+            return "Search budget exceeded: More than {} steps pending.".format(
+                self.max_frontier
+            )
+        if self.max_seconds is not None and start_time is not None:
+            elapsed = (timezone.now() - start_time).total_seconds()
+            if elapsed > self.max_seconds:
+                return "Search budget exceeded: More than {}s elapsed.".format(
+                    self.max_seconds
+                )
+        return ""
+
+
+def check_step_budget(step: DerivationStep) -> str:
+    """
+    Checks the given DerivationStep against its Derivation's search budget,
+    for when steps are processed by the broker.  (The step is only counted
+    as processed once it is claimed; see `count_finished_step()`.)
+
+    Once the budget for the Derivation as a whole has run out, every
+    remaining step is truncated, so that the Derivation completes with
+    whatever chains it has found so far.  (Chains that are too long are
+    truncated individually.)
+    :param step:
+    :return: The reason the step should be truncated, or "" if it may be
+        processed
+    """
+    # The counters are kept up to date by `count_finished_step()`, so there
+    # is no need to reload the Derivation for every step.  (With multiple
+    # workers, they may be slightly behind, which only means the budget
+    # can be overrun by a few steps.)
+    derivation = step.derivation
+
+    # Multiple workers may be processing this Derivation's steps, so the
+    # start time is only set if nobody else has set it yet.
+    if derivation.start_time is None:
+        start_time = timezone.now()
+        if Derivation.objects.filter(id=derivation.id, start_time=None).update(
+            start_time=start_time
+        ):
+            derivation.start_time = start_time
+        else:
+            derivation.start_time = (
+                Derivation.objects.filter(id=derivation.id)
+                .values_list("start_time", flat=True)
+                .get()
+            )
+
+    if derivation.truncated:
+        return "Search budget exceeded: The search was cut off."
+
+    # The counts include the current step.
+    budget = SearchBudget.for_derivation(derivation)
+    reason = budget.check(
+        derivation.processed_count + 1,
+        derivation.created_count - derivation.processed_count - 1,
+        derivation.start_time,
+        derivation.converged_count if budget.max_converged is not None else 0,
+    )
+    if reason:
+        Derivation.objects.filter(id=derivation.id, truncated=False).update(
+            truncated=True
+        )
+        derivation.truncated = True
+        return reason
+
+    return budget.check_depth(step.depth)
+
+
+def expand_state(
+    root_so: Optional[SONode],
+    lexical_array_tail: Deque[LexicalItem],
+    metadata: Optional[GeneratorMetadata],
+    rule_handlers: List[Type[Rule]],
+    generator_handlers: List[Type[Generator]],
+    derivation_actor,
+    previous_rule_results: Optional[Dict[str, RuleResult]] = None,
+    prune: bool = True,
+) -> StepOutcome:
+    """
+    Applies the given Rules and Generators to a single derivation state.
+
+    Does not write anything to the database, so it can be used both for
+    processing individual DerivationSteps (`process_derivation_step()`) and
+    for exploring whole derivations in memory (`.search`).
+
+    :param root_so: The currently built-up SO, if any
+    :param lexical_array_tail: The remainder of the lexical array; will not
+        be modified
+    :param metadata: The GeneratorMetadata for the state, if any
+    :param rule_handlers:
+    :param generator_handlers:
+    :param derivation_actor: Passed on to the Generators, for
+        sub-derivations
+    :param previous_rule_results: The `rule_results` from the outcome for
+        the previous state in the chain, if available
+    :param prune: Whether chains that can never converge should be cut short
+        (see `Derivation.prune`)
+    :return:
+    """
+
     # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
     # Phase 1: Rule checking
 
-    # Apply every active Rule to the current DerivationStep.  It should not
-    # matter what order the Rules are applied in; they are not allowed to
-    # mutate their input.
+    # Apply every active Rule to the current state.  It should not matter
+    # what order the Rules are applied in; they are not allowed to mutate
+    # their input.
 
     # If a Rule determines that a Derivation can *never* converge, it will
     # raise a DerivationFailed exception.
@@ -98,36 +1077,41 @@ def process_derivation_step(
     start_time = time.perf_counter()
 
     rule_errors: List[RuleNonFatalError] = []
+    rule_results: Dict[str, RuleResult] = {}
 
     try:
-        for rule in step.rules.all():
-            handler: Rule = getattr(grammar.rules, rule.rule_class)
-            this_rule_errors = handler.apply(step.root_so, step.lexical_array_tail)
+        # Cut the chain short if any Rule can tell that it will never
+        # converge.
+        if prune:
+            for handler in rule_handlers:
+                handler.prune(root_so, lexical_array_tail)
+
+        for handler in rule_handlers:
+            if handler.incremental:
+                # Incremental Rules update their result for the previous
+                # state, if we have it.
+                previous = None
+                if previous_rule_results is not None:
+                    previous = previous_rule_results.get(handler.__name__)
+                result = handler.apply_incremental(
+                    root_so, lexical_array_tail, previous
+                )
+                rule_results[handler.__name__] = result
+                this_rule_errors = result.errors
+            else:
+                this_rule_errors = handler.apply(root_so, lexical_array_tail)
             rule_errors = rule_errors + this_rule_errors
     except DerivationFailed as error:
         # This Derivation chain has reached a bad end.
-        step.status = DerivationStep.STATUS_CRASHED
-        step.crash_reason = str(error)
-        step.processed_time = timezone.now()
-        step.save()
-        mark_derivation_chain_ended(step, converged=False)
-        logger.debug("DerivationStep {} crashed: {}".format(step.id, error))
-        return []
-
-    # Save the error messages to the DerivationStep
-    step.rule_errors_json = json.dumps(rule_errors)
-    step.save()
+        return StepOutcome(
+            status=DerivationStep.STATUS_CRASHED, crash_reason=str(error)
+        )
 
     logger.debug("Rule checking took {:.3f}s.".format(time.perf_counter() - start_time))
 
     # Convergence check
-    if not len(step.lexical_array_tail) and not len(rule_errors):
-        step.status = DerivationStep.STATUS_CONVERGED
-        step.processed_time = timezone.now()
-        step.save()
-        mark_derivation_chain_ended(step, converged=True)
-        logger.debug("DerivationStep {} converged.".format(step.id))
-        return []
+    if not len(lexical_array_tail) and not len(rule_errors):
+        return StepOutcome(status=DerivationStep.STATUS_CONVERGED)
 
     # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
     # Phase 2: Generation
@@ -139,88 +1123,42 @@ def process_derivation_step(
 
     next_step_defs: List[NextStepDef] = []
 
-    step_metadata = None
-    if step.generator_metadata_json:
-        # Convert metadata: json -> dict -> GeneratorMetadata
-        step_metadata = json.loads(step.generator_metadata_json)
-        step_metadata = GeneratorMetadata(**step_metadata)
-
-    for generator in step.generators.all():
-        # Get next step definitions from each Generator.
-        handler: Generator = getattr(grammar.generators, generator.generator_class)
-        generator_defs: List[NextStepDef] = handler.generate(
-            derivation_actor, step.root_so, step.lexical_array_tail, step_metadata,
+    try:
+        for handler in generator_handlers:
+            # Get next step definitions from each Generator.  (Generators may
+            # consume their copy of the lexical array tail.)
+            generator_defs: List[NextStepDef] = handler.generate(
+                derivation_actor, root_so, deque(lexical_array_tail), metadata
+            )
+            next_step_defs = next_step_defs + generator_defs
+    except SubDerivationPending as pending:
+        # This state has to be expanded again once the sub-derivation is
+        # complete.
+        return StepOutcome(
+            status=DerivationStep.STATUS_WAITING,
+            sub_derivation_id=pending.derivation_id,
         )
-        next_step_defs = next_step_defs + generator_defs
 
     logger.debug("Generation took {:.3f}s.".format(time.perf_counter() - start_time))
 
     # Crash check: If we have no next steps generated but still have Rule
     # errors, we have crashed.
-    crash_reason = (
-        "No more potential steps in the derivation, but some rule checks are "
-        "still failing."
-    )
     if not len(next_step_defs) and len(rule_errors):
-        step.status = DerivationStep.STATUS_CRASHED
-        step.crash_reason = crash_reason
-        step.processed_time = timezone.now()
-        step.save()
-        mark_derivation_chain_ended(step, converged=False)
-        logger.debug("DerivationStep {} crashed: {}".format(step.id, crash_reason))
-        return []
-
-    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
-    # Phase 3: Cleanup
-
-    # If our Generators provided at least one next step and our Rules didn't
-    # crash the Derivation, the show goes on.
-
-    # Create actual DerivationSteps for each of our next steps.
-    # TODO: Change to get_or_create()-style retrieval
-    start_time = time.perf_counter()
-
-    next_steps: List[DerivationStep] = []
-    for next_step_def in next_step_defs:
-        next_step = DerivationStep.objects.create(root_so=next_step_def.root_so)
-
-        # Lexical array tail
-        for [idx, lexical_item] in enumerate(next_step_def.lexical_array_tail):
-            LexicalArrayItem.objects.create(
-                derivation_step=next_step, lexical_item=lexical_item, order=idx
-            )
-
-        # Corresponding derivation
-        next_step.derivation = step.derivation
-
-        # Inherit rules and generators
-        for rule in step.rules.all():
-            next_step.rules.add(rule)
-        for generator in step.generators.all():
-            next_step.generators.add(generator)
-
-        # Add metadata from generators
-        if next_step_def.metadata is not None:
-            next_step.generator_metadata_json = json.dumps(
-                dataclasses.asdict(next_step_def.metadata)
-            )
-
-        # Link to this step
-        next_step.previous_step = step
-        next_step.save()
-
-        next_steps.append(next_step)
-
-    logger.debug("Cleanup took {:.3f}s.".format(time.perf_counter() - start_time))
-
-    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
-    # Phase 4: Dispatch
+        return StepOutcome(
+            status=DerivationStep.STATUS_CRASHED,
+            rule_errors=rule_errors,
+            crash_reason=(
+                "No more potential steps in the derivation, but some rule "
+                "checks are still failing."
+            ),
+        )
 
-    # Return the next DerivationSteps for processing.
-    step.status = DerivationStep.STATUS_PROCESSED
-    step.processed_time = timezone.now()
-    step.save()
-    return next_steps
+    return StepOutcome(
+        status=DerivationStep.STATUS_PROCESSED,
+        rule_errors=rule_errors,
+        next_step_defs=next_step_defs,
+        rule_results=rule_results,
+    )
 
 
 def mark_derivation_chain_ended(
@@ -233,12 +1171,14 @@ def mark_derivation_chain_ended(
     If `converged` is False, the chain is marked as crashed instead.
     :return:
     """
+    # (Only saving the fields we changed: When re-processing, the step may
+    # have been marked complete in the meantime.)
     if converged:
         step.converged_derivation = step.derivation
+        step.save(update_fields=["converged_derivation"])
     else:
         step.crashed_derivation = step.derivation
-
-    step.save()
+        step.save(update_fields=["crashed_derivation"])
 
     # Also update the last chain completion time
     for derivation_request in step.derivation.derivation_requests.all():
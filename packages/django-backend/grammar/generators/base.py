@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 from typing import Deque, List, Optional
 
-from grammar.models import SyntacticObject
+from grammar.tree import SONode
 from lexicon.models import LexicalItem
 
 
@@ -13,7 +13,7 @@ class Generator:
     @staticmethod
     def generate(
         derivation_actor,
-        root_so: Optional[SyntacticObject],
+        root_so: Optional[SONode],
         lexical_array_tail: Deque[LexicalItem],
         metadata: Optional["GeneratorMetadata"] = None,
     ) -> List["NextStepDef"]:
@@ -30,6 +30,20 @@ class Generator:
     description = ""
 
 
+class SubDerivationPending(Exception):
+    """
+    Raised by Generators that need the results of a sub-derivation which is
+    not complete yet.  The DerivationStep is parked, and processed again
+    once the sub-derivation completes.
+    """
+
+    def __init__(self, derivation_id):
+        self.derivation_id = derivation_id
+
+    def __str__(self):
+        return "Waiting for sub-derivation: {}".format(self.derivation_id)
+
+
 @dataclass
 class NextStepDef:
     """
@@ -39,7 +53,7 @@ class NextStepDef:
     """
 
     lexical_array_tail: Deque[LexicalItem]
-    root_so: Optional[SyntacticObject] = None
+    root_so: Optional[SONode] = None
     metadata: Optional["GeneratorMetadata"] = None
 
 
@@ -53,5 +67,10 @@ class GeneratorMetadata:
     # The class name for the Generator that produced this step.
     last_generator: str
 
-    # The node ID of the last merged SyntacticObject
+    # The node ID of the last merged SyntacticObject (its `content_id`,
+    # which is set whether or not the node has been stored yet)
     last_merged_node: Optional[str] = None
+
+    # The ID of the sub-derivation that the last merged SyntacticObject came
+    # from, if any
+    sub_derivation: Optional[str] = None
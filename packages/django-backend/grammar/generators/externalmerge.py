@@ -1,15 +1,32 @@
 import logging
-import time
-from typing import Deque, List, Optional
-
-from grammar.generators.base import Generator, GeneratorMetadata, NextStepDef
+import threading
+from collections import OrderedDict
+from typing import Deque, List, Optional, Tuple
+
+from grammar.generators.base import (
+    Generator,
+    GeneratorMetadata,
+    NextStepDef,
+    SubDerivationPending,
+)
 from grammar.generators.unify.unify import unify
-from grammar.models import Derivation, SyntacticObject
+from grammar.tree import SONode, load_root_sos
 from grammar.util import get_derivation_by_lexical_array
 from lexicon.models import LexicalItem
+from lexicon.registry import feature_registry
 
 logger = logging.getLogger("cs-toolkit-grammar")
 
+# The ids and final root SOs of recently used (complete) sub-derivations, by
+# the pks of their LexicalItems, so that the same bracketed constituent can
+# be merged again without going back to the database.  SONodes are immutable
+# and share their common subtrees, so they are kept as-is.
+SUB_DERIVATION_CACHE_SIZE = 256
+_sub_derivation_sos: "OrderedDict[Tuple, Tuple[str, Tuple[SONode, ...]]]" = (
+    OrderedDict()
+)
+_sub_derivation_sos_lock = threading.Lock()
+
 
 class ExternalMerge(Generator):
     description = (
@@ -21,7 +38,7 @@ class ExternalMerge(Generator):
     @staticmethod
     def generate(
         derivation_actor,
-        root_so: Optional[SyntacticObject],
+        root_so: Optional[SONode],
         lexical_array_tail: Deque[LexicalItem],
         metadata: Optional[GeneratorMetadata] = None,
     ) -> List[NextStepDef]:
@@ -42,43 +59,20 @@ class ExternalMerge(Generator):
                 sub_lexical_array.append(next_item)
                 next_item = lexical_array_tail.popleft()
 
-            # Get a reference to the required Derivation and wait for it to
-            # complete.
-            sub_derivation = get_derivation_by_lexical_array(sub_lexical_array)
-            logger.info("Sub-derivation: {}".format(sub_derivation.id))
-
-            derivation_actor.send(str(sub_derivation.first_step.id))
-            complete = False
-            failsafe = 0
-            while (not complete) and failsafe < 100:
-                failsafe += 1
-                complete = (
-                    Derivation.objects.filter(id=sub_derivation.id).get().complete
-                )
-                time.sleep(0.1)
-
-            if not complete:
-                logger.error(
-                    "ERROR: Sub-derivation did not complete: {}".format(
-                        sub_derivation.id
-                    )
-                )
-
             # ExternalMerge all of the sub-derivation's final SO's
             next_steps = []
-            for sub_step in sub_derivation.converged_steps.all():
+            sub_derivation_id, sub_sos = get_sub_derivation_sos(
+                sub_lexical_array, derivation_actor
+            )
+            for sub_so in sub_sos:
                 if root_so is None:
-                    # This is the first step; we can just take clones of the
+                    # This is the first step; we can just take the
                     # sub-derivations' final SOs, no unification needed
-                    new_so = sub_step.root_so.create_clone()
+                    new_so = sub_so
                 else:
-                    # Create a new root SO, add clones of the sub-derivation's
-                    # SO and the current SO, and unify
-                    new_so = SyntacticObject.objects.create()
-                    sub_step.root_so.create_clone(new_parent=new_so)
-                    root_so.create_clone(new_parent=new_so)
-
-                    unify(new_so)
+                    # Create a new root SO over the sub-derivation's SO and
+                    # the current SO, and unify
+                    new_so = unify(SONode(children=(sub_so, root_so)))
 
                 next_steps.append(
                     NextStepDef(
@@ -86,58 +80,30 @@ class ExternalMerge(Generator):
                         lexical_array_tail=lexical_array_tail,
                         metadata=GeneratorMetadata(
                             last_generator="ExternalMerge",
-                            last_merged_node=str(sub_step.root_so.id),
-                        ),
-                    )
-                )
-
-            # Do the same for crashed steps, in case they crashed
-            # non-fatally and have a chance to survive in the full derivation
-            for sub_step in sub_derivation.crashed_steps.all():
-                if root_so is None:
-                    new_so = sub_step.root_so.create_clone()
-                else:
-                    new_so = SyntacticObject.objects.create()
-                    sub_step.root_so.create_clone(new_parent=new_so)
-                    root_so.create_clone(new_parent=new_so)
-
-                    unify(new_so)
-
-                next_steps.append(
-                    NextStepDef(
-                        root_so=new_so,
-                        lexical_array_tail=lexical_array_tail,
-                        metadata=GeneratorMetadata(
-                            last_generator="ExternalMerge",
-                            last_merged_node=str(sub_step.root_so.id),
+                            last_merged_node=sub_so.content_id,
+                            sub_derivation=sub_derivation_id,
                         ),
                     )
                 )
             return next_steps
 
         # Normal External Merge. Prepare the next root SO.
+        next_so = SONode(
+            text=next_item.text,
+            current_language=next_item.language,
+            features=feature_registry.mask_from_pks(
+                next_item.features.values_list("pk", flat=True)
+            ),
+        )
         if root_so is None:
             # There is no current root SO: The SO formed from the next LI
             # will be the root.  No unification needed.
-            root_so = SyntacticObject.objects.create(
-                text=next_item.text, current_language=next_item.language
-            )
-            root_so.features.set(next_item.features.all())
+            root_so = next_so
         else:
             # There is a current root SO: We need to create a new SO to
-            # serve as the new root, then add the new LI's SO and a clone of
-            # the current root as its children.
-            new_so = SyntacticObject.objects.create()
-            next_so: SyntacticObject = SyntacticObject.objects.create(
-                text=next_item.text, current_language=next_item.language, parent=new_so,
-            )
-            next_so.features.set(next_item.features.all())
-            root_so.create_clone(new_parent=new_so)
-
-            # The children of `root_so` are now freely mutable; unify to get
-            # the features on `root_so`.
-            root_so = new_so
-            unify(root_so)
+            # serve as the new root, with the new LI's SO and the current
+            # root as its children, then unify to get its features.
+            root_so = unify(SONode(children=(next_so, root_so)))
 
         return [
             NextStepDef(
@@ -146,3 +112,54 @@ class ExternalMerge(Generator):
                 metadata=GeneratorMetadata(last_generator="ExternalMerge"),
             )
         ]
+
+
+def get_sub_derivation_sos(
+    sub_lexical_array: List[LexicalItem], derivation_actor
+) -> Tuple[str, Tuple[SONode, ...]]:
+    """
+    Returns the id of the sub-derivation for the given lexical array,
+    together with its final root SOs: Those of its converged steps, then
+    those of its crashed steps (in case they crashed non-fatally and have a
+    chance to survive in the full derivation).
+
+    If the sub-derivation isn't complete yet, it is requested, and
+    SubDerivationPending is raised so that the current step can be processed
+    again once it is.  (When run in-process by the search engine, the
+    sub-derivation is completed by `.send()` itself.)
+    :param sub_lexical_array:
+    :param derivation_actor:
+    :return:
+    """
+    key = tuple(lexical_item.pk for lexical_item in sub_lexical_array)
+    with _sub_derivation_sos_lock:
+        cached = _sub_derivation_sos.get(key)
+        if cached is not None:
+            _sub_derivation_sos.move_to_end(key)
+            return cached
+
+    # Get a reference to the required Derivation.  Sub-derivations are not
+    # pruned: Chains that crash within them may still be rescued by the
+    # parent Derivation.
+    sub_derivation = get_derivation_by_lexical_array(sub_lexical_array, prune=False)
+    logger.info("Sub-derivation: {}".format(sub_derivation.id))
+
+    if not sub_derivation.complete:
+        derivation_actor.send(str(sub_derivation.first_step.id))
+        sub_derivation.refresh_from_db(fields=["complete"])
+        if not sub_derivation.complete:
+            raise SubDerivationPending(sub_derivation.id)
+
+    # Load all the final SOs in one go.
+    sub_steps = list(sub_derivation.converged_steps.all()) + list(
+        sub_derivation.crashed_steps.all()
+    )
+    result = str(sub_derivation.id), tuple(load_root_sos(sub_steps))
+
+    # Complete Derivations never change, so their results can be kept.
+    with _sub_derivation_sos_lock:
+        _sub_derivation_sos[key] = result
+        while len(_sub_derivation_sos) > SUB_DERIVATION_CACHE_SIZE:
+            _sub_derivation_sos.popitem(last=False)
+
+    return result
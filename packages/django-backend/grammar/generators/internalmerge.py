@@ -1,10 +1,11 @@
 import logging
-from typing import Deque, List, Optional
+from typing import Deque, List, Optional, Tuple
 
 from grammar.generators.base import Generator, GeneratorMetadata, NextStepDef
 from grammar.generators.unify.unify import unify
-from grammar.models import SyntacticObject
+from grammar.tree import NodePath, SONode
 from lexicon.models import LexicalItem
+from lexicon.registry import FeatureMask, feature_registry
 
 logger = logging.getLogger("cs-toolkit-grammar")
 
@@ -20,7 +21,7 @@ class InternalMerge(Generator):
     @staticmethod
     def generate(
         derivation_actor,
-        root_so: Optional[SyntacticObject],
+        root_so: Optional[SONode],
         lexical_array_tail: Deque[LexicalItem],
         metadata: Optional[GeneratorMetadata] = None,
     ) -> List[NextStepDef]:
@@ -36,69 +37,36 @@ class InternalMerge(Generator):
         # a phase head. (Anti-locality)
         # E.g.: `root_so` looks like [v*P [v*] [...]], where v* is a phase
         # head.
-        for root_child in root_so.get_children():
-            if root_child.has_feature("PhaseHead"):
-                return []
+        phase_head_mask = feature_registry.name_mask("PhaseHead")
+        if has_phase_head_child(root_so, phase_head_mask):
+            return []
 
-        # Recursively apply IM to descendants of `root_so`, adding the
-        # generated step definitions to `next_steps`.
+        # Find every descendant of `root_so` that can be IM-ed, in one pass
+        # over the in-memory tree.
+        # Does not IM the direct children of `root_so` (anti-locality)
+        candidates: List[Tuple[NodePath, SONode]] = []
+        for idx, root_child in enumerate(root_so.children):
+            collect_candidates(root_child, (idx,), phase_head_mask, candidates)
+
+        # Then, for each of them, create a new root SO over the IM-ed
+        # descendant and the current root (with the descendant's original
+        # position marked as a copy), and unify.  The new roots share every
+        # subtree of `root_so` that is off the path to the descendant.
         next_steps = []
-
-        def merge_children(so: SyntacticObject):
-            """
-            Recursively Internal-Merges the children of the given SO to the
-            top of `root_so`.
-
-            - Does not search into the domain of phase heads.  If at least
-            one of the children of the given `so` is a phase head, *none* of
-            the children are merged.
-
-            :param so:
-            :return:
-            """
-            # Look for phase heads in this node's children.  If we find any,
-            # this node is out of bounds to IM.
-            child: SyntacticObject
-            for child in so.get_children():
-                if child.has_feature("PhaseHead"):
-                    return
-
-            # If we are still here, IM each child and all its children.
-            for child in so.get_children():
-                # Don't re-merge copies
-                if child.is_copy:
-                    continue
-
-                # Create a new root SO, add clones of the current root and
-                # the IM-ed descendant as its children, and unify.
-                new_parent = SyntacticObject.objects.create()
-                child.create_clone(new_parent=new_parent)
-                root_so.create_clone(new_parent=new_parent, mark_copy=str(child.id))
-                new_parent.save()
-
-                unify(new_parent)
-
-                next_steps.append(
-                    NextStepDef(
-                        root_so=new_parent,
-                        lexical_array_tail=lexical_array_tail,
-                        metadata=GeneratorMetadata(
-                            last_generator="InternalMerge",
-                            last_merged_node=str(child.id),
-                        ),
-                    )
+        for path, child in candidates:
+            remainder = root_so.replace_nodes({path: child.evolve(is_copy=True)})
+            next_steps.append(
+                NextStepDef(
+                    root_so=unify(SONode(children=(child, remainder))),
+                    lexical_array_tail=lexical_array_tail,
+                    metadata=GeneratorMetadata(
+                        last_generator="InternalMerge",
+                        last_merged_node=child.content_id,
+                    ),
                 )
+            )
 
-                merge_children(child)
-
-        # Does not IM the direct children of `root_so` (anti-locality)
-        child_num = 0
-        for descendant in root_so.get_descendants().filter(level=root_so.level + 1):
-            child_num += 1
-            logger.info("Child_num: {}".format(child_num))
-            merge_children(descendant)
-
-        logger.info("IM generated: {} steps".format(len(next_steps)))
+        logger.debug("IM generated: {} steps".format(len(next_steps)))
 
         # top_child: SyntacticObject
         # for top_child in root_so.get_children():
@@ -127,3 +95,53 @@ class InternalMerge(Generator):
         #         )
 
         return next_steps
+
+
+def has_phase_head_child(so: SONode, phase_head_mask: FeatureMask) -> bool:
+    """
+    Checks if any of the direct children of the given SO is a phase head.
+    :param so:
+    :param phase_head_mask: The mask for the "PhaseHead" feature
+    :return:
+    """
+    # (No need to look if there are no phase heads in this subtree.)
+    if not so.subtree_features & phase_head_mask:
+        return False
+    return any(child.features & phase_head_mask for child in so.children)
+
+
+def collect_candidates(
+    so: SONode,
+    path: NodePath,
+    phase_head_mask: FeatureMask,
+    candidates: List[Tuple[NodePath, SONode]],
+) -> None:
+    """
+    Recursively collects the children of the given SO that can be
+    Internal-Merged to the top of the root SO, in pre-order.
+
+    - Does not search into the domain of phase heads.  If at least one of
+    the children of the given `so` is a phase head, *none* of the children
+    are collected.
+    - Does not collect copies (or search inside them).
+
+    :param so:
+    :param path: The position of `so` within the root SO
+    :param phase_head_mask: The mask for the "PhaseHead" feature
+    :param candidates: (path, node) pairs for the collected nodes
+    :return:
+    """
+    # Look for phase heads in this node's children.  If we find any, this
+    # node is out of bounds to IM.
+    if has_phase_head_child(so, phase_head_mask):
+        return
+
+    # If we are still here, collect each child and all its children.
+    for idx, child in enumerate(so.children):
+        # Don't re-merge copies
+        if child.is_copy:
+            continue
+
+        child_path = path + (idx,)
+        candidates.append((child_path, child))
+        collect_candidates(child, child_path, phase_head_mask, candidates)
@@ -1,9 +1,10 @@
-from grammar.models import SyntacticObject
+from typing import Tuple
 
+from grammar.tree import SONode
+from lexicon.registry import FeatureMask, feature_registry, lowest_bit
 
-def assign_case(
-    so_1: SyntacticObject, so_2: SyntacticObject, second_pass=False
-) -> None:
+
+def assign_case(so_1: SONode, so_2: SONode, second_pass=False) -> Tuple[SONode, SONode]:
     """
     Checks either SO for an active [Case] feature coupled with a [uPhi]
     feature.
@@ -17,87 +18,111 @@ def assign_case(
     feature coupled with a [uPhi, EPP] feature.  If one is found,
     deactivates the [Case], [uCase], and [uPhi, EPP] features.
 
+    SONodes are immutable, so the updated versions of both SOs are returned.
+
     :param so_1:
     :param so_2:
     :param second_pass:
-    :return:
+    :return: The updated (so_1, so_2)
     """
+    # All the feature checks are done on `FeatureMask`s; each of the
+    # `so_*_<Feature>` variables below holds (at most) a single feature.
+    uninterpretable = feature_registry.uninterpretable_mask
+    case = feature_registry.name_mask("Case")
+    phi = feature_registry.name_mask("Phi")
+    epp = feature_registry.property_mask("EPP")
+
     # Explicitly make sure so_1's Phi feature does not have an EPP property.
-    so_1_Case = so_1.features.filter(name__exact="Case")
-    so_1_uPhi = so_1.features.filter(name__exact="Phi").exclude(properties__name="EPP")
+    so_1_Case = lowest_bit(so_1.features & case)
+    so_1_uPhi = lowest_bit(so_1.features & phi & ~epp)
     if (
-        len(so_1_Case) > 0
-        and len(so_1_uPhi) > 0
-        and not so_1_Case.get().uninterpretable
-        and so_1_uPhi.get().uninterpretable
+        so_1_Case
+        and so_1_uPhi
+        and not so_1_Case & uninterpretable
+        and so_1_uPhi & uninterpretable
     ):
         # so_1 is a candidate case assigner.
-        for other_so in so_2.get_descendants(include_self=True):
-            other_so_uCase = other_so.features.filter(name__exact="Case")
-            other_so_Phi = other_so.features.filter(name__exact="Phi")
+        # Only the nodes that carry a [uCase] feature need to be checked, so
+        # the search skips every subtree without one (and the whole of so_2
+        # if it has no [Phi] features either).
+        candidates = ()
+        if so_2.subtree_features & phi & ~uninterpretable:
+            candidates = so_2.walk_features(case & uninterpretable)
+        for path, other_so in candidates:
+            other_so_uCase = lowest_bit(other_so.features & case)
+            other_so_Phi = lowest_bit(other_so.features & phi)
             if (
-                len(other_so_uCase) > 0
-                and len(other_so_Phi) > 0
-                and other_so_uCase.get().uninterpretable
-                and not other_so_Phi.get().uninterpretable
+                other_so_uCase
+                and other_so_Phi
+                and other_so_uCase & uninterpretable
+                and not other_so_Phi & uninterpretable
             ):
                 # Found a match
-                so_1_Case = so_1_Case.get()
-                so_1.features.remove(so_1_Case)
-                so_1.deleted_features.add(so_1_Case)
-
-                so_1_uPhi = so_1_uPhi.get()
-                so_1.features.remove(so_1_uPhi)
-                so_1.deleted_features.add(so_1_uPhi)
-
-                other_so_uCase = other_so_uCase.get()
-                other_so.features.remove(other_so_uCase)
-                other_so.deleted_features.add(other_so_uCase)
-
-                so_1.save()
-                other_so.save()
-
+                so_1 = so_1.delete_features(so_1_Case | so_1_uPhi)
+                so_2 = so_2.replace_nodes(
+                    {path: other_so.delete_features(other_so_uCase)}
+                )
                 break
 
-    so_1_uCase = so_1.features.filter(name__exact="Case")
-    so_1_Phi = so_1.features.filter(name__exact="Phi")
+    so_1_uCase = lowest_bit(so_1.features & case)
+    so_1_Phi = lowest_bit(so_1.features & phi)
     if (
-        len(so_1_uCase) > 0
-        and len(so_1_Phi) > 0
-        and so_1_uCase.get().uninterpretable
-        and not so_1_Phi.get().uninterpretable
+        so_1_uCase
+        and so_1_Phi
+        and so_1_uCase & uninterpretable
+        and not so_1_Phi & uninterpretable
     ):
         # so_1 has uninterpretable Case with interpretable Phi features --
         # Check for a case assigner with [uPhi,EPP] in the other SO
-        for other_so in so_2.children.all():
-            other_so_Case = other_so.features.filter(name__exact="Case")
-            other_so_uPhi = other_so.features.filter(name__exact="Phi").filter(
-                properties__name="EPP"
-            )
+        for idx, other_so in enumerate(so_2.children):
+            other_so_Case = lowest_bit(other_so.features & case)
+            other_so_uPhi = lowest_bit(other_so.features & phi & epp)
             if (
-                len(other_so_Case) > 0
-                and len(other_so_uPhi) > 0
-                and not other_so_Case.get().uninterpretable
-                and other_so_uPhi.get().uninterpretable
+                other_so_Case
+                and other_so_uPhi
+                and not other_so_Case & uninterpretable
+                and other_so_uPhi & uninterpretable
             ):
                 # Found a match
-                so_1_uCase = so_1_uCase.get()
-                so_1.features.remove(so_1_uCase)
-                so_1.deleted_features.add(so_1_uCase)
+                so_1 = so_1.delete_features(so_1_uCase)
+                so_2 = so_2.replace_nodes(
+                    {(idx,): other_so.delete_features(other_so_Case | other_so_uPhi)}
+                )
+                break
 
-                other_so_Case = other_so_Case.get()
-                other_so.features.remove(other_so_Case)
-                other_so.deleted_features.add(other_so_Case)
+    # Second pass failsafe
+    if not second_pass:
+        so_2, so_1 = assign_case(so_2, so_1, True)
 
-                other_so_uPhi = other_so_uPhi.get()
-                other_so.features.remove(other_so_uPhi)
-                other_so.deleted_features.add(other_so_uPhi)
+    return so_1, so_2
 
-                so_1.save()
-                other_so.save()
 
-                break
+def get_assignable_features(so: SONode, available: FeatureMask) -> FeatureMask:
+    """
+    Returns the uninterpretable features on the given node that Case
+    assignment (as in `assign_case()`) could still delete, if the node could
+    be unified with any SO that carries the `available` interpretable
+    features.
 
-    # Second pass failsafe
-    if not second_pass:
-        assign_case(so_2, so_1, True)
+    This is an over-estimate, for pruning derivations that can never
+    converge.
+    :param so:
+    :param available:
+    :return:
+    """
+    uninterpretable = feature_registry.uninterpretable_mask
+    case = feature_registry.name_mask("Case")
+    phi = feature_registry.name_mask("Phi")
+
+    assignable = 0
+
+    # A [uCase] is only deleted if it is coupled with a [Phi] feature bundle
+    # and there is a case assigner with [Case] somewhere.
+    if so.features & phi & ~uninterpretable and available & case & ~uninterpretable:
+        assignable |= so.features & case & uninterpretable
+
+    # A case assigner's [uPhi] is only deleted together with its own [Case].
+    if so.features & case & ~uninterpretable:
+        assignable |= so.features & phi & uninterpretable
+
+    return assignable
@@ -1,11 +1,16 @@
 import logging
 import time
+from typing import Dict, Iterable
 
-from grammar.models import SyntacticObject
-from .case import assign_case
+from grammar.tree import NodePath, SONode
+from lexicon.registry import FeatureMask, feature_registry
+from .case import assign_case, get_assignable_features
 
 logger = logging.getLogger("cs-toolkit-grammar")
 
+# Features that the generic unify handler leaves to the specific handlers
+EXCLUDE_GENERIC = ["Case"]
+
 
 class UnificationError(Exception):
     """
@@ -19,18 +24,18 @@ class UnificationError(Exception):
         return self.message
 
 
-def unify(parent_so: SyntacticObject) -> None:
+def unify(parent_so: SONode) -> SONode:
     """
     Takes a pre-formed SO with an indeterminate feature set.
     Assumes it has two children.
     Determines how the two child SOs are unified to produce its features.
     Deals with feature matching/valuation/deletion/etc. (Unify and Agree)
-    Assumes that the SO's children are freely mutable.
+    SONodes are immutable, so the unified SO is returned as a new tree.
     :return:
     """
     start_time = time.perf_counter()
 
-    children = list(parent_so.get_children())
+    children = parent_so.children
     if not len(children) == 2:
         logger.info(children)
         raise UnificationError("Unify called on non-binary-branching SO.")
@@ -39,44 +44,100 @@ def unify(parent_so: SyntacticObject) -> None:
 
     ######
     # Specific unify handlers
-    assign_case(so_1, so_2)
+    so_1, so_2 = assign_case(so_1, so_2)
 
     ######
     # Generic unify handler
     # Find uninterpretable features in the two SOs, except the ones named in
-    # `exclude_generic`
-    exclude_generic = ["Case"]
-
-    so: SyntacticObject
-    for so in so_1.get_descendants(include_self=True):
-        for feature in so.features.all():
-            if feature.uninterpretable and feature.name not in exclude_generic:
-                # This feature is uninterpretable.
-                for i_feature in so_2.features.all():
-                    if not i_feature.uninterpretable and i_feature.name == feature.name:
-                        so.features.remove(feature)
-                        so.deleted_features.add(feature)
-                        so.save()
-
-    for so in so_2.get_descendants(include_self=True):
-        for feature in so.features.all():
-            if feature.uninterpretable and feature.name not in exclude_generic:
-                # This feature is uninterpretable.
-                for i_feature in so_1.features.all():
-                    if not i_feature.uninterpretable and i_feature.name == feature.name:
-                        so.features.remove(feature)
-                        so.deleted_features.add(feature)
-                        so.save()
+    # `EXCLUDE_GENERIC`.
+    # The checks only depend on the (interpretable) features of the other
+    # SO's top node, which the generic handler never deletes, so the
+    # deletions for both SOs are worked out in one pass and applied with a
+    # single rebuild of the tree.
+    deletions: Dict[NodePath, FeatureMask] = {}
+    for idx, target, checker in [(0, so_1, so_2), (1, so_2, so_1)]:
+        for path, checked in get_checked_features(
+            target, checker, EXCLUDE_GENERIC
+        ).items():
+            deletions[(idx,) + path] = checked
 
     # Update the parent SO
     # TODO: Should defer to an explicit Labelling Algorithm, but for now,
     #  just use the text label from so_1
-    parent_so.text = so_1.text
-    parent_so.current_language = so_1.current_language
-    parent_so.save()
+    parent_so = parent_so.evolve(
+        text=so_1.text, current_language=so_1.current_language, children=(so_1, so_2)
+    )
+    parent_so = parent_so.replace_nodes(
+        {
+            path: parent_so.get_node(path).delete_features(checked)
+            for path, checked in deletions.items()
+        }
+    )
 
     logger.debug(
         "Unified {}: {}/{} ({:.3f}s)".format(
-            parent_so.text, so_1.text, so_2.text, time.perf_counter() - start_time,
+            parent_so.text, so_1.text, so_2.text, time.perf_counter() - start_time
         )
     )
+
+    return parent_so
+
+
+def get_checked_features(
+    target: SONode, checker: SONode, exclude: Iterable[str]
+) -> Dict[NodePath, FeatureMask]:
+    """
+    Finds the uninterpretable features anywhere within `target` that are
+    matched by an interpretable feature with the same name on `checker`.
+    Features named in `exclude` are left alone.
+    :param target:
+    :param checker:
+    :param exclude:
+    :return: A Dict mapping the paths of the affected nodes (relative to
+        `target`) to the features that should be deleted from them.
+    """
+    uninterpretable = feature_registry.uninterpretable_mask
+
+    # The uninterpretable features that share a name with one of the
+    # checker's interpretable features
+    checkable = (
+        feature_registry.same_name_mask(checker.features & ~uninterpretable)
+        & uninterpretable
+    )
+    for name in exclude:
+        checkable &= ~feature_registry.name_mask(name)
+
+    if not checkable:
+        return {}
+
+    return {
+        path: so.features & checkable for path, so in target.walk_features(checkable)
+    }
+
+
+def get_checkable_features(so: SONode, available: FeatureMask) -> FeatureMask:
+    """
+    Returns the uninterpretable features on the given node that some future
+    unification could still check, if the node could be unified with any
+    SO that carries the `available` interpretable features.
+
+    This is an over-estimate, for pruning derivations that can never
+    converge: A feature that is *not* returned can never be checked.
+    (Each of the unify handlers should be accounted for here.)
+    :param so:
+    :param available: All the interpretable features that might end up in
+        the same SO as `so`
+    :return:
+    """
+    uninterpretable = feature_registry.uninterpretable_mask
+
+    # Generic handler: Needs an interpretable feature with the same name
+    checkable = feature_registry.same_name_mask(available & ~uninterpretable)
+    for name in EXCLUDE_GENERIC:
+        checkable &= ~feature_registry.name_mask(name)
+    checkable &= so.features & uninterpretable
+
+    # Specific handlers
+    checkable |= get_assignable_features(so, available)
+
+    return checkable
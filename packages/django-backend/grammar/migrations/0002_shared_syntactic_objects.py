@@ -0,0 +1,83 @@
+# Generated by Django 2.1.7 on 2026-10-18 13:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("lexicon", "0002_auto_20190410_0924"), ("grammar", "0001_initial")]
+
+    operations = [
+        migrations.CreateModel(
+            name="SharedSyntacticObject",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4, primary_key=True, serialize=False
+                    ),
+                ),
+                ("text", models.CharField(max_length=100)),
+                ("current_language", models.CharField(max_length=50)),
+                ("is_copy", models.BooleanField(default=False)),
+                (
+                    "deleted_features",
+                    models.ManyToManyField(
+                        blank=True,
+                        related_name="shared_so_deleted_set",
+                        to="lexicon.Feature",
+                    ),
+                ),
+                (
+                    "features",
+                    models.ManyToManyField(
+                        blank=True, related_name="shared_so_set", to="lexicon.Feature"
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="derivationstep",
+            name="shared_root_so",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="grammar.SharedSyntacticObject",
+            ),
+        ),
+        migrations.CreateModel(
+            name="SharedSyntacticObjectChild",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("order", models.IntegerField()),
+                (
+                    "child",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="grammar.SharedSyntacticObject",
+                    ),
+                ),
+                (
+                    "parent",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="child_links",
+                        to="grammar.SharedSyntacticObject",
+                    ),
+                ),
+            ],
+            options={"ordering": ["order"], "unique_together": {("parent", "order")}},
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.1.7 on 2026-10-18 13:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0002_shared_syntactic_objects")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivationstep",
+            name="fingerprint",
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        )
+    ]
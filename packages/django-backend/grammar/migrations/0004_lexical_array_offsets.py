@@ -0,0 +1,79 @@
+# Generated by Django 2.1.7 on 2026-10-18 13:42
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def compact_lexical_arrays(apps, schema_editor):
+    """
+    Replaces the per-step copies of the lexical array tail with offsets into
+    the lexical array of the Derivation's first step.
+    """
+    DerivationStep = apps.get_model("grammar", "DerivationStep")
+    LexicalArrayItem = apps.get_model("grammar", "LexicalArrayItem")
+
+    array_lengths = dict(
+        DerivationStep.objects.filter(first_step_derivation__isnull=False)
+        .annotate(length=Count("lexical_array_items"))
+        .values_list("first_step_derivation_id", "length")
+    )
+
+    steps = (
+        DerivationStep.objects.filter(
+            first_step_derivation__isnull=True, derivation_id__in=array_lengths
+        )
+        .annotate(length=Count("lexical_array_items"))
+        .values_list("id", "derivation_id", "length")
+    )
+    for step_id, derivation_id, length in steps.iterator():
+        DerivationStep.objects.filter(id=step_id).update(
+            lexical_array_offset=array_lengths[derivation_id] - length
+        )
+
+    LexicalArrayItem.objects.filter(
+        derivation_step__first_step_derivation__isnull=True,
+        derivation_step__derivation_id__in=array_lengths,
+    ).delete()
+
+
+def expand_lexical_arrays(apps, schema_editor):
+    """
+    Restores the per-step copies of the lexical array tail.
+    """
+    DerivationStep = apps.get_model("grammar", "DerivationStep")
+    LexicalArrayItem = apps.get_model("grammar", "LexicalArrayItem")
+
+    lexical_arrays = {}
+    for lexical_array_item in LexicalArrayItem.objects.filter(
+        derivation_step__first_step_derivation__isnull=False
+    ).order_by("order"):
+        lexical_arrays.setdefault(
+            lexical_array_item.derivation_step.first_step_derivation_id, []
+        ).append(lexical_array_item.lexical_item_id)
+
+    lexical_array_items = []
+    for step in DerivationStep.objects.filter(
+        first_step_derivation__isnull=True, derivation_id__in=lexical_arrays
+    ).iterator():
+        tail = lexical_arrays[step.derivation_id][step.lexical_array_offset :]
+        lexical_array_items += [
+            LexicalArrayItem(
+                derivation_step_id=step.id, lexical_item_id=lexical_item_id, order=idx
+            )
+            for idx, lexical_item_id in enumerate(tail)
+        ]
+    LexicalArrayItem.objects.bulk_create(lexical_array_items)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0003_derivationstep_fingerprint")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivationstep",
+            name="lexical_array_offset",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(compact_lexical_arrays, expand_lexical_arrays),
+    ]
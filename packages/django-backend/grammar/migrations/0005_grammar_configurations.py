@@ -0,0 +1,133 @@
+# Generated by Django 2.1.7 on 2026-10-18 13:44
+
+import hashlib
+import json
+import uuid
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def get_content_hash(rule_ids, generator_ids):
+    # Cf. `GrammarConfiguration.get_content_hash()`
+    contents = [
+        sorted(str(rule_id) for rule_id in rule_ids),
+        sorted(str(generator_id) for generator_id in generator_ids),
+    ]
+    return hashlib.sha256(json.dumps(contents).encode("utf-8")).hexdigest()
+
+
+def create_configurations(apps, schema_editor):
+    """
+    Replaces the per-step Rule and Generator links with GrammarConfigurations.
+    """
+    DerivationStep = apps.get_model("grammar", "DerivationStep")
+    GrammarConfiguration = apps.get_model("grammar", "GrammarConfiguration")
+
+    rule_ids = {}
+    for step_id, rule_id in DerivationStep.rules.through.objects.values_list(
+        "derivationstep_id", "ruledescription_id"
+    ):
+        rule_ids.setdefault(step_id, set()).add(rule_id)
+    generator_ids = {}
+    for step_id, generator_id in DerivationStep.generators.through.objects.values_list(
+        "derivationstep_id", "generatordescription_id"
+    ):
+        generator_ids.setdefault(step_id, set()).add(generator_id)
+
+    configurations = {}
+    for step_id in DerivationStep.objects.values_list("id", flat=True).iterator():
+        step_rule_ids = rule_ids.get(step_id, set())
+        step_generator_ids = generator_ids.get(step_id, set())
+        content_hash = get_content_hash(step_rule_ids, step_generator_ids)
+
+        if content_hash not in configurations:
+            configuration = GrammarConfiguration.objects.create(
+                content_hash=content_hash
+            )
+            configuration.rules.set(step_rule_ids)
+            configuration.generators.set(step_generator_ids)
+            configurations[content_hash] = configuration
+
+        DerivationStep.objects.filter(id=step_id).update(
+            configuration=configurations[content_hash]
+        )
+
+
+def expand_configurations(apps, schema_editor):
+    """
+    Restores the per-step Rule and Generator links.
+    """
+    DerivationStep = apps.get_model("grammar", "DerivationStep")
+    GrammarConfiguration = apps.get_model("grammar", "GrammarConfiguration")
+    rules_through = DerivationStep.rules.through
+    generators_through = DerivationStep.generators.through
+
+    for configuration in GrammarConfiguration.objects.all():
+        step_ids = list(
+            DerivationStep.objects.filter(configuration=configuration).values_list(
+                "id", flat=True
+            )
+        )
+        rule_ids = list(configuration.rules.values_list("id", flat=True))
+        generator_ids = list(configuration.generators.values_list("id", flat=True))
+
+        rules_through.objects.bulk_create(
+            [
+                rules_through(derivationstep_id=step_id, ruledescription_id=rule_id)
+                for step_id in step_ids
+                for rule_id in rule_ids
+            ]
+        )
+        generators_through.objects.bulk_create(
+            [
+                generators_through(
+                    derivationstep_id=step_id, generatordescription_id=generator_id
+                )
+                for step_id in step_ids
+                for generator_id in generator_ids
+            ]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0004_lexical_array_offsets")]
+
+    operations = [
+        migrations.CreateModel(
+            name="GrammarConfiguration",
+            fields=[
+                (
+                    "id",
+                    models.UUIDField(
+                        default=uuid.uuid4, primary_key=True, serialize=False
+                    ),
+                ),
+                ("content_hash", models.CharField(max_length=64, unique=True)),
+                (
+                    "generators",
+                    models.ManyToManyField(
+                        blank=True, to="grammar.GeneratorDescription"
+                    ),
+                ),
+                (
+                    "rules",
+                    models.ManyToManyField(blank=True, to="grammar.RuleDescription"),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="derivationstep",
+            name="configuration",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="grammar.GrammarConfiguration",
+            ),
+        ),
+        migrations.RunPython(create_configurations, expand_configurations),
+        migrations.RemoveField(model_name="derivationstep", name="generators"),
+        migrations.RemoveField(model_name="derivationstep", name="rules"),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.1.7 on 2026-10-18 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0005_grammar_configurations")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivationstep",
+            name="joined_previous_steps",
+            field=models.ManyToManyField(
+                blank=True,
+                related_name="joined_next_steps",
+                to="grammar.DerivationStep",
+            ),
+        )
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 2.1.7 on 2026-10-18 13:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0006_derivationstep_joined_previous_steps")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivation",
+            name="created_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="derivation",
+            name="max_depth",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="derivation",
+            name="max_frontier",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="derivation",
+            name="max_seconds",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="derivation",
+            name="max_steps",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="derivation",
+            name="processed_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="derivation",
+            name="start_time",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="derivation",
+            name="truncated",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="derivationstep",
+            name="depth",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name="derivationstep",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("Pending", "Pending"),
+                    ("Processed", "Processed"),
+                    ("Converged", "Converged"),
+                    ("Crashed", "Crashed"),
+                    ("Truncated", "Truncated"),
+                ],
+                default="Pending",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.1.7 on 2026-10-18 13:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0007_search_budgets")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivation",
+            name="max_converged",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.1.7 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0008_derivation_max_converged")]
+
+    operations = [
+        migrations.AlterField(
+            model_name="derivationstep",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("Pending", "Pending"),
+                    ("Processed", "Processed"),
+                    ("Converged", "Converged"),
+                    ("Crashed", "Crashed"),
+                    ("Truncated", "Truncated"),
+                    ("Waiting", "Waiting"),
+                ],
+                default="Pending",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.1.7 on 2026-10-18 14:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0009_derivationstep_status_waiting")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivationstep",
+            name="duplicate_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
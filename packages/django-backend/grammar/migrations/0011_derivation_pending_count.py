@@ -0,0 +1,51 @@
+# Generated by Django 2.1.7 on 2026-10-18 14:15
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_pending_steps(apps, schema_editor):
+    """
+    Sets the pending count of incomplete Derivations from their unfinished
+    DerivationSteps.
+    Incomplete Derivations without any unfinished DerivationSteps would never
+    be completed by a worker, so they are marked complete here.
+    """
+    Derivation = apps.get_model("grammar", "Derivation")
+    DerivationStep = apps.get_model("grammar", "DerivationStep")
+
+    pending_counts = dict(
+        DerivationStep.objects.filter(
+            derivation__complete=False, status__in=["Pending", "Waiting"]
+        )
+        .values("derivation_id")
+        .annotate(count=Count("id"))
+        .values_list("derivation_id", "count")
+    )
+    for derivation_id, count in pending_counts.items():
+        Derivation.objects.filter(id=derivation_id).update(pending_count=count)
+
+    finished_ids = list(
+        Derivation.objects.filter(complete=False)
+        .exclude(id__in=pending_counts.keys())
+        .values_list("id", flat=True)
+    )
+    DerivationStep.objects.filter(derivation_id__in=finished_ids).update(complete=True)
+    Derivation.objects.filter(id__in=finished_ids).update(complete=True)
+    Derivation.objects.filter(
+        id__in=finished_ids, derivationstep__status="Truncated"
+    ).update(truncated=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0010_derivationstep_duplicate_count")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivation",
+            name="pending_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_pending_steps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.1.7 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0011_derivation_pending_count")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivation",
+            name="prune",
+            field=models.BooleanField(default=True),
+        )
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.1.7 on 2026-10-18 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0012_derivation_prune")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivationstep",
+            name="failed",
+            field=models.BooleanField(default=False),
+        )
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 2.1.7 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("grammar", "0013_derivationstep_failed")]
+
+    operations = [
+        migrations.AddField(
+            model_name="derivation",
+            name="running_since",
+            field=models.DateTimeField(blank=True, null=True),
+        )
+    ]
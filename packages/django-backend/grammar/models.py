@@ -24,18 +24,31 @@ Also contains the Django model used to represent syntactic objects.
 
 - DerivationSteps store a reference to the root node of the corresponding
   SyntacticObject tree.
+
+SyntacticObject trees are stored in two forms:
+
+- SharedSyntacticObjects are the primary store.  Nodes refer to their
+  children via ordered links rather than owning them, so a new tree can
+  refer to the unchanged subtrees of a previous one instead of copying them.
+
+- SyntacticObjects are `django-mptt` trees, created from the shared store
+  when a DerivationStep's root SO actually needs to be displayed.
 """
+import functools
+import hashlib
+import json
 import logging
 import uuid
 from collections import deque
-from typing import List
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.db.models import QuerySet
 from model_utils import FieldTracker
 from mptt.managers import TreeManager
 from mptt.models import MPTTModel, TreeForeignKey, TreeOneToOneField
 
+from lexicon.registry import feature_registry
 from notify.models import NotifyModel
 
 logger = logging.getLogger("cs-toolkit-grammar")
@@ -113,6 +126,53 @@ class Derivation(NotifyModel):
     # processed to a crash/convergence
     complete = models.BooleanField(default=False)
 
+    # If the search ran out of budget (see below), the Derivation is still
+    # marked complete, but only has the converged/crashed chains that were
+    # found before the search was cut off.
+    truncated = models.BooleanField(default=False)
+
+    # Whether chains that can never converge are cut short (see
+    # `.rules.base.Rule.prune`).  Sub-derivations are not pruned, since their
+    # crashed chains are still merged into the parent Derivation; they are
+    # kept apart from top-level Derivations over the same lexical array.
+    prune = models.BooleanField(default=True)
+
+    # Search budget for this Derivation; unset limits fall back to the
+    # global DERIVATION_BUDGET setting.  (See `.derive.SearchBudget`)
+    BUDGET_FIELDS = (
+        "max_steps",
+        "max_depth",
+        "max_seconds",
+        "max_frontier",
+        "max_converged",
+    )
+    max_steps = models.PositiveIntegerField(null=True, blank=True)
+    max_depth = models.PositiveIntegerField(null=True, blank=True)
+    max_seconds = models.PositiveIntegerField(null=True, blank=True)
+    max_frontier = models.PositiveIntegerField(null=True, blank=True)
+    max_converged = models.PositiveIntegerField(null=True, blank=True)
+
+    # Search progress, for checking the budget: When the first step was
+    # processed, and the number of DerivationSteps created and processed so
+    # far.  The counters are only ever changed with atomic updates, since
+    # the broker's workers may be processing steps in parallel.
+    start_time = models.DateTimeField(null=True, blank=True)
+    created_count = models.PositiveIntegerField(default=0)
+    processed_count = models.PositiveIntegerField(default=0)
+
+    # The number of DerivationSteps that have been created but not finished
+    # yet (including parked steps).  Each finished step adds its new next
+    # steps and subtracts itself in a single atomic update; the Derivation
+    # is complete when this reaches zero.  (See `.derive.count_finished_step`)
+    pending_count = models.PositiveIntegerField(default=0)
+
+    # When the in-process search engine (see `.search`) last claimed or
+    # checkpointed this Derivation, while a worker is searching it; only one
+    # worker searches a Derivation at a time.  A claim that has not been
+    # renewed for DERIVATION_ENGINE_LEASE seconds is presumed abandoned
+    # (e.g., if its worker was killed).
+    running_since = models.DateTimeField(null=True, blank=True)
+
     @property
     def converged_count(self):
         return self.converged_steps.count()
@@ -139,30 +199,103 @@ class Derivation(NotifyModel):
         """
         return Derivation.get_chains_from_steps(self.crashed_steps.all())
 
+    @staticmethod
+    def get_lexical_array(derivation_id) -> Tuple:
+        """
+        Returns the full lexical array for the Derivation with the given id,
+        as a tuple of LexicalItems.
+
+        The lexical array is stored on the Derivation's `first_step`; the
+        other DerivationSteps only record how much of it they have used up
+        (`DerivationStep.lexical_array_offset`).
+        Lexical arrays never change once the Derivation has been created,
+        but the Features of their LexicalItems might; they are cached until
+        the lexicon changes (see `lexicon.registry`).
+        :param derivation_id:
+        :return:
+        """
+        return Derivation._get_lexical_array(derivation_id, feature_registry.generation)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def _get_lexical_array(derivation_id, generation: Optional[str]) -> Tuple:
+        """
+        Loads the lexical array for `get_lexical_array()`.
+        :param derivation_id:
+        :param generation: The lexicon generation; only used as part of the
+            cache key
+        :return:
+        """
+        return tuple(
+            lexical_array_item.lexical_item
+            for lexical_array_item in LexicalArrayItem.objects.filter(
+                derivation_step__first_step_derivation_id=derivation_id
+            )
+            .select_related("lexical_item")
+            .prefetch_related("lexical_item__features")
+        )
+
     @staticmethod
     def get_chains_from_steps(end_steps):
         """
         From a given iterable of end DerivationSteps, retrieve all the
         corresponding full chains.
+        Since identical states within a Derivation are merged, a single end
+        step may be reached by more than one chain; every one of them is
+        returned.
         :param end_steps:
         :return:
         """
+        end_steps = list(end_steps)
+
+        # Load all the steps in the relevant Derivations, together with the
+        # links between them, in one go.
+        derivation_ids = {end_step.derivation_id for end_step in end_steps}
+        steps = {
+            step.id: step
+            for step in DerivationStep.objects.filter(derivation_id__in=derivation_ids)
+        }
+        steps.update({end_step.id: end_step for end_step in end_steps})
+
+        previous_step_ids: Dict[uuid.UUID, List[uuid.UUID]] = {
+            step.id: [step.previous_step_id] if step.previous_step_id else []
+            for step in steps.values()
+        }
+        joined_links = DerivationStep.joined_previous_steps.through.objects.filter(
+            from_derivationstep__derivation_id__in=derivation_ids
+        ).values_list("from_derivationstep_id", "to_derivationstep_id")
+        for step_id, previous_step_id in joined_links:
+            previous_step_ids[step_id].append(previous_step_id)
+
+        # Each DerivationStep may have multiple `next_steps`, and (if it was
+        # reached by more than one chain) multiple previous steps.  If we
+        # follow every path backward, we will get back to the `first_step`.
+        # (The partial chains leading to each step are only worked out
+        # once.)
+        partial_chains: Dict[uuid.UUID, List[List["DerivationStep"]]] = {}
+
+        def get_partial_chains(step_id) -> List[List["DerivationStep"]]:
+            if step_id not in partial_chains:
+                step = steps.get(step_id)
+                if step is None:
+                    step = steps[step_id] = DerivationStep.objects.get(id=step_id)
+                    previous_step_ids[step_id] = (
+                        [step.previous_step_id] if step.previous_step_id else []
+                    )
+
+                if not previous_step_ids[step_id]:
+                    partial_chains[step_id] = [[step]]
+                else:
+                    partial_chains[step_id] = [
+                        partial_chain + [step]
+                        for previous_step_id in previous_step_ids[step_id]
+                        for partial_chain in get_partial_chains(previous_step_id)
+                    ]
+            return partial_chains[step_id]
+
         chains = []
         for end_step in end_steps:
-            this_chain = [end_step]
-            this_step = end_step
-
-            # Each DerivationStep may have multiple `next_steps`, but only one
-            # `previous_step`.  If we follow the chain backward, we will get
-            # back to the `first_step`.
-            while this_step.previous_step:
-                this_chain.append(this_step.previous_step)
-                this_step = this_step.previous_step
-
-            # We now have a chain from last step to first -- Reverse it and
-            # append it to the list of all chains for this Derivation.
-            this_chain.reverse()
-            chains.append(this_chain)
+            chains += get_partial_chains(end_step.id)
 
         return chains
 
@@ -189,8 +322,8 @@ class DerivationStep(models.Model):
     - `root_so` representing the currently built-up SyntacticObject
     - `lexical_array_tail` representing the remainder of the input lexical
       array
-    - `rules` representing the Rules active for this derivation
-    - `generators` representing the Generators active for this derivation
+    - `configuration` representing the Rules and Generators active for this
+      derivation
 
     DerivationSteps go through a number of phases when processed:
     - Before processing (STATUS_PENDING).
@@ -205,17 +338,28 @@ class DerivationStep(models.Model):
     - If there are no more generated next DerivationSteps and the
       Rule checks still fail, the derivation is marked as crashed
       (STATUS_CRASHED)
+    - If the Derivation's search budget runs out before the DerivationStep
+      is processed, its chain is cut off there (STATUS_TRUNCATED)
+    - If a Generator needs the results of a sub-derivation that is not
+      complete yet, the DerivationStep is parked until it is
+      (STATUS_WAITING), then processed again
+    - If processing the DerivationStep raises an unexpected error, it is
+      crashed and marked as `failed` (STATUS_CRASHED)
     """
 
     STATUS_PENDING = "Pending"
     STATUS_PROCESSED = "Processed"
     STATUS_CONVERGED = "Converged"
     STATUS_CRASHED = "Crashed"
+    STATUS_TRUNCATED = "Truncated"
+    STATUS_WAITING = "Waiting"
     STATUSES = (
         (STATUS_PENDING, "Pending"),
         (STATUS_PROCESSED, "Processed"),
         (STATUS_CONVERGED, "Converged"),
         (STATUS_CRASHED, "Crashed"),
+        (STATUS_TRUNCATED, "Truncated"),
+        (STATUS_WAITING, "Waiting"),
     )
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
@@ -223,7 +367,8 @@ class DerivationStep(models.Model):
     status = models.CharField(max_length=10, choices=STATUSES, default=STATUS_PENDING)
 
     # Each DerivationStep is associated with only one Derivation...
-    # TODO: Maybe fingerprinting and memoisation of these in the future?
+    # (Steps in different Derivations may still share their processing
+    # results; see `fingerprint` below.)
     # CASCADE: When Derivations are deleted, delete all associated
     # DerivationSteps
     derivation = models.ForeignKey(
@@ -263,30 +408,70 @@ class DerivationStep(models.Model):
 
     # How the derivation proceeds depends on the remaining LexicalItems
     # within the input, and which rules/generators are currently active.
-    # - The rules and generators are set here
-    # - The lexical array tail is managed externally by the LexicalArrayItem
-    #   model, which tracks order as well.
-    rules = models.ManyToManyField("RuleDescription", blank=True)
-    generators = models.ManyToManyField("GeneratorDescription", blank=True)
+    # - The rules and generators are set via the GrammarConfiguration, which
+    #   is shared by every step that uses the same set of them.
+    # - The full lexical array is managed externally by the LexicalArrayItem
+    #   model (which tracks order as well), and is only stored for the first
+    #   step in the Derivation.  Subsequent steps record the number of
+    #   LexicalItems that have been used up from the front of the array.
+    lexical_array_offset = models.PositiveIntegerField(default=0)
+    # CASCADE: When the GrammarConfiguration is deleted, delete this
+    # DerivationStep too.
+    configuration = models.ForeignKey(
+        "GrammarConfiguration", on_delete=models.CASCADE, null=True, blank=True
+    )
 
     # Any Rule error messages or Generator metadata, as JSON data
     rule_errors_json = models.TextField(blank=True)
     generator_metadata_json = models.TextField(blank=True)
 
+    # A canonical hash of everything that determines how this step is
+    # processed (root SO, lexical array tail, grammar configuration and the
+    # relevant Generator metadata), set when the step is created or
+    # processed.
+    # Steps with the same fingerprint have the same outcome and next steps,
+    # so a step can reuse the results of an already-processed step with the
+    # same fingerprint.  (See `.derive.get_fingerprint()`)
+    # Within a single Derivation, each fingerprint should only appear once
+    # at each depth; see `joined_previous_steps` below.
+    fingerprint = models.CharField(max_length=64, blank=True, db_index=True)
+
     @property
-    def lexical_array_tail(self):
+    def lexical_array_tail(self) -> deque:
         """
         Convenience function to return the tail of LexicalItems left in this
         Derivation as a deque.
+        The tail is only retrieved once per instance; each call returns a new
+        deque, which the caller is free to modify.
         :return:
         """
-
-        return deque(
-            [
-                lexical_array_item.lexical_item
-                for lexical_array_item in self.lexical_array_items.all()
-            ]
-        )
+        if getattr(self, "_lexical_array_tail", None) is None:
+            if self.derivation_id is not None:
+                lexical_array = Derivation.get_lexical_array(self.derivation_id)
+                self._lexical_array_tail = lexical_array[self.lexical_array_offset :]
+            else:
+                # Not yet attached to a Derivation; only possible for first
+                # steps, which store their own lexical array.
+                self._lexical_array_tail = tuple(
+                    lexical_array_item.lexical_item
+                    for lexical_array_item in self.lexical_array_items.all()
+                )
+
+        return deque(self._lexical_array_tail)
+
+    def set_lexical_array_tail(self, lexical_array_tail) -> None:
+        """
+        Sets `lexical_array_offset` for this DerivationStep, given the
+        LexicalItems remaining in the lexical array.
+        (Generators only ever use up LexicalItems from the front of the
+        lexical array, so the tail is always a suffix of the full array.)
+        :param lexical_array_tail:
+        :return:
+        """
+        lexical_array_tail = tuple(lexical_array_tail)
+        lexical_array = Derivation.get_lexical_array(self.derivation_id)
+        self.lexical_array_offset = len(lexical_array) - len(lexical_array_tail)
+        self._lexical_array_tail = lexical_array_tail
 
     # If this isn't the first step in a Derivation, it should have a
     # reference to the previous step in the chain.
@@ -300,22 +485,60 @@ class DerivationStep(models.Model):
         related_name="next_steps",
     )
 
-    # If this DerivationStep crashed, we should provide a reason.
+    # If the same state is reached by different chains in a Derivation (at
+    # the same depth), it is only processed once: The first chain to reach
+    # it is its `previous_step`, and the steps in the other chains that led
+    # to it are kept here.  The Derivation then forms a DAG rather than a
+    # tree.
+    # (Cf. `Derivation.get_chains_from_steps()`)
+    joined_previous_steps = models.ManyToManyField(
+        "self", symmetrical=False, blank=True, related_name="joined_next_steps"
+    )
+
+    # The number of steps between the first step and this one (along the
+    # `previous_step` chain)
+    depth = models.PositiveIntegerField(default=0)
+
+    # The number of next steps that were dropped because they were identical
+    # to one of the others (see `fingerprint`)
+    duplicate_count = models.PositiveIntegerField(default=0)
+
+    # If this DerivationStep crashed (or was truncated), we should provide a
+    # reason.
     crash_reason = models.TextField(blank=True)
 
+    # Whether this DerivationStep crashed because processing it raised an
+    # error (e.g., a bug in a Rule or Generator, or a database outage that
+    # outlasted the task retries), rather than for grammatical reasons.
+    # Failed steps are not part of their Derivation's crashed chains, and
+    # their outcome is never reused for other steps.
+    failed = models.BooleanField(default=False)
+
     # Note the time when we first process this DerivationStep
     processed_time = models.DateTimeField(null=True, blank=True)
 
     # DerivationSteps are complete if they and all their next steps have
-    # been processed.
+    # been processed.  (Since all the steps in a Derivation are connected,
+    # they are marked complete together with the Derivation itself.)
     complete = models.BooleanField(default=False)
 
-    # Any sub-derivations that were triggered by this DerivationStep;
+    # Any sub-derivations that were used (or triggered) by this
+    # DerivationStep, whether or not they were already complete;
     # They will be added to the timeline display of this DerivationStep's chain
-    # TODO: Get these out from ExternalMerge
+    # (Steps in STATUS_WAITING are resumed when these complete.)
     sub_derivations = models.ManyToManyField("Derivation", related_name="trigger_steps")
 
-    # Each DerivationStep has one unique root SyntacticObject.
+    # Each DerivationStep has one root SyntacticObject in the shared store.
+    # Unchanged subtrees are shared with the root SOs of other
+    # DerivationSteps.
+    # CASCADE: When `shared_root_so` is deleted, delete this DerivationStep
+    # too.
+    shared_root_so: "SharedSyntacticObject" = models.ForeignKey(
+        "SharedSyntacticObject", on_delete=models.CASCADE, null=True, blank=True
+    )
+
+    # Each DerivationStep may also have one unique root SyntacticObject
+    # (MPTT) tree, which is only created when the root SO is displayed.
     # (SyntacticObjects encode specific hierarchical information and
     # different DerivationSteps have different hierarchies)
     # CASCADE: When `root_so` is deleted, delete this DerivationStep too.
@@ -323,16 +546,42 @@ class DerivationStep(models.Model):
         "SyntacticObject", on_delete=models.CASCADE, null=True, blank=True
     )
 
+    @property
+    def display_root_so(self) -> Optional["SyntacticObject"]:
+        """
+        Returns the MPTT SyntacticObject tree for this DerivationStep's root
+        SO, creating it from the shared store if necessary.
+        :return:
+        """
+        if self.root_so is None and self.shared_root_so_id is not None:
+            from grammar.tree import SONode
+
+            root_so = SONode.from_shared(self.shared_root_so_id).to_model()
+            updated = DerivationStep.objects.filter(
+                id=self.id, root_so__isnull=True
+            ).update(root_so=root_so)
+
+            if updated:
+                self.root_so = root_so
+            else:
+                # Someone else got here first.
+                root_so.delete()
+                self.root_so = DerivationStep.objects.get(id=self.id).root_so
+
+        return self.root_so
+
     def root_so_text(self):
         """
         Convenience function to return the label of the current root_so, if any
         :return:
         """
+        if self.shared_root_so:
+            return self.shared_root_so.text
         if self.root_so:
             return self.root_so.text
 
     root_so_text.short_description = "Root SO text"
-    root_so_text.admin_order_field = "root_so__text"
+    root_so_text.admin_order_field = "shared_root_so__text"
 
     def lexical_array_friendly(self):
         """
@@ -383,6 +632,74 @@ class AsyncSafeTreeManager(TreeManager):
     def _get_next_tree_id(self):
         return str(uuid.uuid4())
 
+    def bulk_insert_tree(
+        self,
+        rows: List["SyntacticObject"],
+        feature_ids: Dict[uuid.UUID, List[int]],
+        deleted_feature_ids: Dict[uuid.UUID, List[int]],
+        parent: "SyntacticObject" = None,
+    ) -> "SyntacticObject":
+        """
+        Inserts a whole new (sub)tree with a constant number of queries.
+
+        `rows` should contain unsaved nodes in tree order, with the root
+        first.  Their `lft`, `rght` and `level` values should be relative to
+        a root with `lft` 1 and `level` 0, and every node except the root
+        should already have its `parent_id` set.
+
+        If `parent` is given, the new tree is inserted as its last child;
+        otherwise, it becomes a new tree of its own.
+        :param rows:
+        :param feature_ids: Maps node ids to the ids of their `features`
+        :param deleted_feature_ids: Maps node ids to the ids of their
+            `deleted_features`
+        :param parent:
+        :return: The root of the new tree
+        """
+        root = rows[0]
+        if parent is None:
+            tree_id = self._get_next_tree_id()
+            lft_offset = 0
+            level_offset = 0
+        else:
+            # Make room after the parent's existing children.
+            size = root.rght - root.lft + 1
+            self._create_space(size, parent.rght - 1, parent.tree_id)
+            tree_id = parent.tree_id
+            lft_offset = parent.rght - 1
+            level_offset = parent.level + 1
+            root.parent = parent
+            parent.rght += size
+
+        for row in rows:
+            row.tree_id = tree_id
+            row.lft += lft_offset
+            row.rght += lft_offset
+            row.level += level_offset
+
+        features_through = self.model.features.through
+        deleted_features_through = self.model.deleted_features.through
+        with transaction.atomic():
+            self.bulk_create(rows)
+            features_through.objects.bulk_create(
+                [
+                    features_through(syntacticobject_id=so_id, feature_id=feature_id)
+                    for so_id, so_feature_ids in feature_ids.items()
+                    for feature_id in so_feature_ids
+                ]
+            )
+            deleted_features_through.objects.bulk_create(
+                [
+                    deleted_features_through(
+                        syntacticobject_id=so_id, feature_id=feature_id
+                    )
+                    for so_id, so_feature_ids in deleted_feature_ids.items()
+                    for feature_id in so_feature_ids
+                ]
+            )
+
+        return root
+
 
 class AsyncSafeMPTTModel(MPTTModel):
     objects = AsyncSafeTreeManager()
@@ -462,47 +779,6 @@ class SyntacticObject(AsyncSafeMPTTModel):
     # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
     # Model instance helpers and utilities
 
-    def create_clone(
-        self, new_parent: "SyntacticObject" = None, mark_copy: str = None
-    ) -> "SyntacticObject":
-        """
-        Utility function to create a clone of this SO, optionally changing
-        its parent.  Recursively clones the SO's children as well, setting
-        their new parents accordingly.
-        (cf. https://stackoverflow.com/questions/3879500/making-a-copy-of-a
-        -feincms-page-tree-using-django-mptt-changes-child-order)
-
-        Should be called between DerivationSteps if the SO is going to be
-        mutated, so that changes aren't inadvertently propagated to
-        previous DerivationSteps as well.
-
-        Optionally, if the id of one of the SO's children is passed as
-        `mark_copy`, the clone of that child SO will be marked as a copy
-        (i.e., `is_copy` will be set to True)
-
-        :param new_parent:
-        :param mark_copy:
-        :return:
-        """
-        # Clone the current SO
-        new_so: SyntacticObject = SyntacticObject.objects.create(
-            text=self.text,
-            current_language=self.current_language,
-            parent=new_parent,
-            is_copy=self.is_copy or str(self.id) == mark_copy,
-        )
-        new_so.features.set(self.features.all())
-        new_so.deleted_features.set(self.deleted_features.all())
-
-        # Clone children
-        children: List[SyntacticObject] = list(self.get_children())
-        for child in children:
-            child.create_clone(new_so, mark_copy)
-
-        new_so.save()
-
-        return new_so
-
     def has_feature(self, name):
         """
         Checks if this SO has an active feature with the given name.
@@ -522,6 +798,77 @@ class SyntacticObject(AsyncSafeMPTTModel):
         )
 
 
+class SharedSyntacticObject(models.Model):
+    """
+    A Django model for storing SyntacticObject trees with structural sharing.
+
+    Unlike `SyntacticObject`, nodes do not belong to a single tree: each node
+    refers to its children via ordered `SharedSyntacticObjectChild` links,
+    and a node may be the child of any number of parents.  Nodes are never
+    modified once created; changing any part of a tree means creating new
+    nodes for the changed part and the path above it, while the rest of the
+    tree is shared.
+
+    Nodes are hash-consed: their ids are derived from a canonical hash of
+    their contents (see `grammar.tree.SONode.digest`), so identical subtrees
+    are stored only once, across all DerivationSteps and Derivations.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+
+    text = models.CharField(max_length=100)
+    current_language = models.CharField(max_length=50)
+
+    features = models.ManyToManyField(
+        "lexicon.Feature", blank=True, related_name="shared_so_set"
+    )
+    deleted_features = models.ManyToManyField(
+        "lexicon.Feature", blank=True, related_name="shared_so_deleted_set"
+    )
+
+    is_copy = models.BooleanField(default=False)
+
+    # For the admin interface
+    def feature_string(self):
+        return ", ".join(
+            [str(feature) for feature in sorted(self.features.all(), key=str)]
+        )
+
+    def deleted_feature_string(self):
+        return ", ".join(
+            [str(feature) for feature in sorted(self.deleted_features.all(), key=str)]
+        )
+
+    feature_string.short_description = "Features"
+    deleted_feature_string.short_description = "Deleted Features"
+
+    def __str__(self):
+        return "{} ({}) {}".format(
+            self.text, self.current_language, self.feature_string()
+        )
+
+
+class SharedSyntacticObjectChild(models.Model):
+    """
+    An intermediary model for managing the ordered children of
+    SharedSyntacticObjects.
+
+    CASCADE: Deleting either the parent or the child deletes this link too.
+    """
+
+    parent = models.ForeignKey(
+        "SharedSyntacticObject", on_delete=models.CASCADE, related_name="child_links"
+    )
+    child = models.ForeignKey(
+        "SharedSyntacticObject", on_delete=models.CASCADE, related_name="+"
+    )
+    order = models.IntegerField()
+
+    class Meta:
+        unique_together = ("parent", "order")
+        ordering = ["order"]
+
+
 # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
 # Stub for describing syntactic rules so that the other models can reference
 # them -- Actual rule implementations are in `.rules`.
@@ -577,3 +924,80 @@ class GeneratorDescription(models.Model):
 
     def __str__(self):
         return self.name
+
+
+# -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
+# Sets of rules and generators that DerivationSteps are processed with
+class GrammarConfiguration(models.Model):
+    """
+    An immutable set of Rules and Generators.
+
+    GrammarConfigurations are identified by a hash of their contents, so
+    every DerivationStep (across all Derivations) that uses the same Rules
+    and Generators refers to the same GrammarConfiguration.
+    Because they never change once created, the workers can safely cache
+    the corresponding Rule and Generator classes by configuration.
+    (See `.derive.get_pipeline()`)
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+
+    # See `get_content_hash()`
+    content_hash = models.CharField(max_length=64, unique=True)
+
+    rules = models.ManyToManyField("RuleDescription", blank=True)
+    generators = models.ManyToManyField("GeneratorDescription", blank=True)
+
+    @staticmethod
+    def get_content_hash(rule_ids: Iterable, generator_ids: Iterable) -> str:
+        """
+        Returns the canonical hash for a set of Rules and Generators.
+        :param rule_ids: RuleDescription ids
+        :param generator_ids: GeneratorDescription ids
+        :return:
+        """
+        contents = [
+            sorted(str(rule_id) for rule_id in rule_ids),
+            sorted(str(generator_id) for generator_id in generator_ids),
+        ]
+        return hashlib.sha256(json.dumps(contents).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def get_for(
+        rules: Iterable["RuleDescription"], generators: Iterable["GeneratorDescription"]
+    ) -> "GrammarConfiguration":
+        """
+        Retrieves the GrammarConfiguration for the given Rules and
+        Generators, creating it if necessary.
+        :param rules:
+        :param generators:
+        :return:
+        """
+        rules = list(rules)
+        generators = list(generators)
+        content_hash = GrammarConfiguration.get_content_hash(
+            [rule.id for rule in rules], [generator.id for generator in generators]
+        )
+
+        try:
+            return GrammarConfiguration.objects.get(content_hash=content_hash)
+        except GrammarConfiguration.DoesNotExist:
+            pass
+
+        try:
+            with transaction.atomic():
+                configuration = GrammarConfiguration.objects.create(
+                    content_hash=content_hash
+                )
+                configuration.rules.set(rules)
+                configuration.generators.set(generators)
+            return configuration
+        except IntegrityError:
+            # Someone else got here first.
+            return GrammarConfiguration.objects.get(content_hash=content_hash)
+
+    def __str__(self):
+        return "; ".join(
+            [str(rule) for rule in self.rules.all()]
+            + [str(generator) for generator in self.generators.all()]
+        )
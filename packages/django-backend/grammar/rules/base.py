@@ -1,6 +1,7 @@
-from typing import Deque, List, Optional
+from dataclasses import dataclass
+from typing import Any, Deque, List, Optional
 
-from grammar.models import SyntacticObject
+from grammar.tree import SONode
 from lexicon.models import LexicalItem
 
 # Type aliases
@@ -14,9 +15,14 @@ class Rule:
 
     description = ""
 
+    #: Rules that can update their result for the previous DerivationStep in
+    #: the chain (rather than re-checking the whole state) should set this,
+    #: and implement `.apply_incremental()` instead of `.apply()`.
+    incremental = False
+
     @staticmethod
     def apply(
-        root_so: Optional[SyntacticObject], lexical_array_tail: Deque[LexicalItem],
+        root_so: Optional[SONode], lexical_array_tail: Deque[LexicalItem],
     ) -> List[RuleNonFatalError]:
         """
         Given the currently built-up syntactic object and the remainder of
@@ -37,6 +43,51 @@ class Rule:
         """
         pass
 
+    @staticmethod
+    def prune(
+        root_so: Optional[SONode], lexical_array_tail: Deque[LexicalItem],
+    ) -> None:
+        """
+        Checked before any Rules are applied and before any next steps are
+        generated: If the Rule can tell that the Derivation chain will
+        *never* converge from the given state, no matter which steps follow,
+        it should raise a DerivationFailed exception here so that the chain
+        is cut short.
+
+        Should be cheap, and must be sound -- Only states that really cannot
+        converge should be pruned.  By default, nothing is pruned.
+        (Sub-derivations are never pruned; see `Derivation.prune`.)
+        :return:
+        """
+        pass
+
+    @staticmethod
+    def apply_incremental(
+        root_so: Optional[SONode],
+        lexical_array_tail: Deque[LexicalItem],
+        previous: Optional["RuleResult"],
+    ) -> "RuleResult":
+        """
+        As with `.apply()`, but also given this Rule's result for the
+        previous DerivationStep in the chain, if it is available.
+
+        Generators build the next root SO out of the current one, and the
+        subtrees that they do not change are shared between the two (with
+        the same `digest`s).  An incremental Rule can therefore keep track
+        of its findings for each subtree in `RuleResult.state`, and only
+        check the parts of the new root SO that it has not seen before
+        (usually the newly merged item and the path from the root down to
+        any nodes whose features were changed).
+
+        Should raise DerivationFailed in the same situations as `.apply()`;
+        otherwise, returns the RuleNonFatalError messages for the given
+        DerivationStep together with any state needed for the next steps.
+
+        If `previous` is None, the whole state should be checked.
+        :return:
+        """
+        pass
+
 
 class DerivationFailed(Exception):
     """
@@ -49,3 +100,17 @@ class DerivationFailed(Exception):
 
     def __str__(self):
         return "{}: {}".format(self.rule_class, self.message)
+
+
+@dataclass
+class RuleResult:
+    """
+    The result of applying an incremental Rule to a DerivationStep, which
+    is passed back to the Rule for the next steps in the chain.
+    (Kept in memory only.)
+    """
+
+    errors: List[RuleNonFatalError]
+
+    # Anything else the Rule needs to update its result for the next steps
+    state: Any = None
@@ -1,7 +1,14 @@
-from typing import List
+from collections import ChainMap
+from typing import List, Tuple
 
-from grammar.models import SyntacticObject
-from .base import Rule, DerivationFailed, RuleNonFatalError
+from grammar.generators.unify.unify import get_checkable_features
+from grammar.tree import SONode
+from lexicon.registry import feature_registry
+from .base import Rule, DerivationFailed, RuleNonFatalError, RuleResult
+
+# The maximum number of steps' worth of maps in the `CoreNoUninterpretable`
+# state before they are collapsed into one (see `.apply_incremental()`)
+KNOWN_ERRORS_MAX_DEPTH = 8
 
 
 class CoreNoUninterpretable(Rule):
@@ -9,27 +16,100 @@ class CoreNoUninterpretable(Rule):
         "There should be no uninterpretable values left on the syntactic " "object."
     )
 
+    incremental = True
+
+    @staticmethod
+    def prune(root_so, lexical_array_tail) -> None:
+        if not root_so or root_so.uninterpretable_count == 0:
+            return
+
+        # Features are never added to SOs, only deleted.  So any feature that
+        # might yet check one of our uninterpretable features must already be
+        # somewhere in `root_so` (and could be Internal-Merged), or on one of
+        # the remaining LexicalItems (and could be External-Merged).
+        available = root_so.subtree_features
+        for lexical_item in lexical_array_tail:
+            available |= feature_registry.mask(lexical_item.features.all())
+
+        uninterpretable_mask = feature_registry.uninterpretable_mask
+        unchecked = []
+        this_so: SONode
+        for _, this_so in root_so.walk_features(uninterpretable_mask):
+            # Copies don't need to be checked
+            if this_so.is_copy:
+                continue
+
+            features = (this_so.features & uninterpretable_mask) & ~(
+                get_checkable_features(this_so, available)
+            )
+            unchecked += [
+                "{} on {}".format(feature, this_so)
+                for feature in feature_registry.features(features)
+            ]
+
+        if unchecked:
+            raise DerivationFailed(
+                "CoreNoUninterpretable",
+                "Uninterpretable features can never be checked: {}.".format(
+                    "; ".join(unchecked)
+                ),
+            )
+
     @staticmethod
     def apply(root_so, lexical_array_tail) -> List[RuleNonFatalError]:
+        return CoreNoUninterpretable.apply_incremental(
+            root_so, lexical_array_tail, None
+        ).errors
+
+    @staticmethod
+    def apply_incremental(root_so, lexical_array_tail, previous) -> RuleResult:
+        # The error messages for each subtree (by digest) that we have
+        # checked so far in this chain, including in previous steps.
+        # Lookups go through the map for every step, and each map keeps the
+        # ones before it alive, so the maps are collapsed every few steps.
+        if previous is None:
+            known_errors = ChainMap()
+        elif len(previous.state.maps) >= KNOWN_ERRORS_MAX_DEPTH:
+            known_errors = ChainMap({}, dict(previous.state))
+        else:
+            known_errors = previous.state.new_child()
+
         if not root_so:
             # No SyntacticObject built up yet.
-            return []
+            return RuleResult(errors=[], state=known_errors)
+
+        uninterpretable_mask = feature_registry.uninterpretable_mask
 
-        # Check all features of all nodes in `root_so`.
-        uninterpretable_features = []
-        this_so: SyntacticObject
-        for this_so in root_so.get_descendants(include_self=True):
+        def check(so: SONode) -> Tuple[RuleNonFatalError, ...]:
+            """
+            Returns the error messages for all the nodes in the given
+            subtree, in pre-order.
+            :param so:
+            :return:
+            """
+            # Skip the subtrees that have no uninterpretable features left.
+            if so.uninterpretable_count == 0:
+                return ()
+
+            # Subtrees that were carried over from previous steps unchanged
+            # have already been checked.
+            errors = known_errors.get(so.digest)
+            if errors is not None:
+                return errors
+
+            errors = ()
             # No need to check copies
-            if this_so.is_copy:
-                continue
+            if not so.is_copy:
+                errors += tuple(
+                    "Uninterpretable feature {} on {}.".format(feature, so)
+                    for feature in feature_registry.features(
+                        so.features & uninterpretable_mask
+                    )
+                )
+            for child in so.children:
+                errors += check(child)
 
-            for feature in this_so.features.all():
-                interp = feature.properties.filter(name__exact="interpretable")
-                if len(interp) > 0:
-                    if not interp[0].value:
-                        # This feature is uninterpretable.
-                        uninterpretable_features.append(
-                            "Uninterpretable feature {} on {}.".format(feature, this_so)
-                        )
+            known_errors[so.digest] = errors
+            return errors
 
-        return uninterpretable_features
+        return RuleResult(errors=list(check(root_so)), state=known_errors)
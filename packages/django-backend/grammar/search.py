@@ -0,0 +1,766 @@
+"""
+An in-process engine for exploring the whole state space of a Derivation.
+
+In the default ("broker") mode, every DerivationStep is a separate task:
+it is loaded from the database, processed, and its next steps are written
+back and re-sent to the broker.  For small and medium lexical arrays, this
+overhead dwarfs the actual grammar work.
+
+In the "dfs", "bfs" and "best" modes, a single worker explores the whole
+Derivation instead, expanding in-memory states (`.derive.expand_state()`)
+depth-first, breadth-first or best-first.  (Best-first search expands the
+most promising states first, according to the heuristic set by
+`DERIVATION_HEURISTIC`; see `HEURISTICS` below.  Together with the
+`max_converged` search budget, it finds the first few converged chains
+without exploring the rest of the state space.)  The resulting
+DerivationSteps are written to the
+database in bulk, at checkpoints (every `DERIVATION_ENGINE_CHECKPOINT`
+processed steps) and when the search is done.  Sub-derivations triggered by
+ExternalMerge are run in-process as well.
+
+Only one worker searches a Derivation at a time (see `claim_derivation()`).
+If a sub-derivation is already being searched by another worker, the steps
+that need it are parked until it completes, and the search for the parent
+Derivation is resumed then.
+
+The pending frontier is written out at each checkpoint too, so an
+interrupted search can be resumed from the database.
+
+Both modes respect the Derivation's search budget (`.derive.SearchBudget`);
+if it runs out, the pending steps are truncated and the Derivation is
+completed with the chains that were found so far.
+"""
+import dataclasses
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from grammar.derive import (
+    Pipeline,
+    SearchBudget,
+    create_derivation_steps,
+    expand_state,
+    get_fingerprint,
+    get_memoized_fingerprints,
+    get_memoized_outcome,
+    get_pipeline,
+    get_sub_derivation_ids,
+    join_derivation_steps,
+    link_sub_derivations,
+)
+from grammar.generators.base import GeneratorMetadata
+from grammar.models import Derivation, DerivationRequest, DerivationStep
+from grammar.rules.base import RuleResult
+from grammar.tree import SONode, load_root_so
+from lexicon.models import LexicalItem
+
+logger = logging.getLogger("cs-toolkit-grammar")
+
+# Engine modes
+ENGINE_BROKER = "broker"
+ENGINE_DFS = "dfs"
+ENGINE_BFS = "bfs"
+ENGINE_BEST = "best"
+SEARCH_STRATEGIES = (ENGINE_DFS, ENGINE_BFS, ENGINE_BEST)
+
+
+def get_engine_mode() -> str:
+    """
+    Returns the configured derivation engine mode.
+    :return:
+    """
+    return getattr(settings, "DERIVATION_ENGINE", ENGINE_BROKER)
+
+
+class SearchNode:
+    """
+    A single state within an in-memory derivation search, together with the
+    (possibly not yet saved) DerivationStep that records it.
+    """
+
+    __slots__ = (
+        "step",
+        "root_so",
+        "lexical_array_tail",
+        "metadata",
+        "pipeline",
+        "previous_rule_results",
+        "saved",
+    )
+
+    def __init__(
+        self,
+        step: DerivationStep,
+        root_so: Optional[SONode],
+        lexical_array_tail: Deque[LexicalItem],
+        metadata: Optional[GeneratorMetadata],
+        pipeline: Pipeline,
+        previous_rule_results: Optional[Dict[str, RuleResult]] = None,
+        saved: bool = False,
+    ):
+        self.step = step
+        self.root_so = root_so
+        self.lexical_array_tail = lexical_array_tail
+        self.metadata = metadata
+        # The Rules and Generators for the step's GrammarConfiguration
+        self.pipeline = pipeline
+        # The incremental Rule results for the previous state, if any
+        self.previous_rule_results = previous_rule_results
+        # Whether `step` has been written to the database yet
+        self.saved = saved
+
+    @staticmethod
+    def from_step(step: DerivationStep) -> "SearchNode":
+        """
+        Loads the state recorded in the given (saved) DerivationStep.
+        :param step:
+        :return:
+        """
+        metadata = None
+        if step.generator_metadata_json:
+            metadata = GeneratorMetadata(**json.loads(step.generator_metadata_json))
+
+        return SearchNode(
+            step=step,
+            root_so=load_root_so(step),
+            lexical_array_tail=step.lexical_array_tail,
+            metadata=metadata,
+            pipeline=get_pipeline(step.configuration_id),
+            saved=True,
+        )
+
+
+# -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
+# Heuristics for best-first search.
+# Each heuristic scores a (not yet processed) search node; nodes with lower
+# scores are expanded first.
+def shortest_tail(node: SearchNode) -> float:
+    """
+    Prefers states with fewer LexicalItems left to Merge.
+    :param node:
+    :return:
+    """
+    return len(node.lexical_array_tail)
+
+
+def fewest_rule_errors(node: SearchNode) -> float:
+    """
+    Prefers states with fewer uninterpretable features left, i.e., fewer
+    errors from the `CoreNoUninterpretable` Rule.
+    :param node:
+    :return:
+    """
+    if node.root_so is None:
+        return 0
+    return node.root_so.uninterpretable_count
+
+
+def closest_to_convergence(node: SearchNode) -> float:
+    """
+    Prefers states with fewer LexicalItems left to Merge and fewer
+    uninterpretable features left to check.
+    :param node:
+    :return:
+    """
+    return shortest_tail(node) + fewest_rule_errors(node)
+
+
+HEURISTICS: Dict[str, Callable[[SearchNode], float]] = {
+    "shortest-tail": shortest_tail,
+    "fewest-rule-errors": fewest_rule_errors,
+    "closest-to-convergence": closest_to_convergence,
+}
+
+
+def get_heuristic(name: Optional[str] = None) -> Callable[[SearchNode], float]:
+    """
+    Returns the heuristic for best-first search with the given name (from
+    `HEURISTICS`), or at the given dotted path, for custom heuristics.
+    :param name: Defaults to the `DERIVATION_HEURISTIC` setting
+    :return:
+    """
+    if name is None:
+        name = getattr(settings, "DERIVATION_HEURISTIC", "closest-to-convergence")
+    if name in HEURISTICS:
+        return HEURISTICS[name]
+    return import_string(name)
+
+
+class Frontier:
+    """
+    The search nodes waiting to be processed, in the order in which the
+    search strategy expands them.
+    """
+
+    def __init__(
+        self, strategy: str, heuristic: Optional[Callable[[SearchNode], float]]
+    ):
+        self.strategy = strategy
+        self.heuristic = heuristic
+
+        # For depth-first and breadth-first search
+        self._queue: Deque[SearchNode] = deque()
+
+        # For best-first search: (score, order, node) entries.  Among nodes
+        # with the same score, the newest one is expanded first, so that
+        # the search still heads towards the end of a chain.
+        self._heap: List[Tuple[float, int, SearchNode]] = []
+        self._order = itertools.count()
+
+    def extend(self, nodes: Iterable[SearchNode]) -> None:
+        """
+        Adds the given sibling nodes to the frontier.
+        :param nodes:
+        :return:
+        """
+        if self.strategy == ENGINE_BEST:
+            for node in nodes:
+                heapq.heappush(
+                    self._heap, (self.heuristic(node), -next(self._order), node)
+                )
+        elif self.strategy == ENGINE_DFS:
+            # Depth-first: The first sibling should be the next one popped.
+            self._queue.extend(reversed(list(nodes)))
+        else:
+            self._queue.extend(nodes)
+
+    def pop(self) -> SearchNode:
+        """
+        Removes and returns the next node to be processed.
+        :return:
+        """
+        if self.strategy == ENGINE_BEST:
+            return heapq.heappop(self._heap)[2]
+        elif self.strategy == ENGINE_DFS:
+            return self._queue.pop()
+        else:
+            return self._queue.popleft()
+
+    def clear(self) -> None:
+        self._queue.clear()
+        self._heap.clear()
+
+    def __len__(self):
+        return len(self._queue) + len(self._heap)
+
+    def __iter__(self) -> Iterator[SearchNode]:
+        yield from self._queue
+        for _, _, node in self._heap:
+            yield node
+
+
+class InProcessDispatcher:
+    """
+    Stands in for the Dramatiq actor when Generators are run by the search
+    engine: Sub-derivations that Generators `.send()` are run to completion
+    in the current process instead of being sent to the broker.
+
+    If another worker is already searching the sub-derivation, it is left
+    alone; the step that needs it is parked until it completes.
+    """
+
+    def __init__(self, engine_actor, strategy: str):
+        self.engine_actor = engine_actor
+        self.strategy = strategy
+
+    def send(self, step_id: str):
+        step = DerivationStep.objects.select_related("derivation").get(id=step_id)
+        if not step.derivation.complete:
+            run_derivation(step.derivation, self.engine_actor, self.strategy)
+
+
+def run_derivation(
+    derivation: Derivation,
+    engine_actor,
+    strategy: Optional[str] = None,
+    checkpoint_size: Optional[int] = None,
+) -> None:
+    """
+    Explores the whole state space of the given Derivation in the current
+    process (see `search_derivation()`), unless another worker is already
+    doing so.
+    :param derivation:
+    :param engine_actor: The Dramatiq actor for searching Derivations, for
+        resuming Derivations that were waiting for this one
+    :param strategy: "dfs", "bfs" or "best"; defaults to the configured
+        engine mode
+    :param checkpoint_size: The number of steps to process between
+        database writes; defaults to `DERIVATION_ENGINE_CHECKPOINT`
+    :return:
+    """
+    if strategy is None:
+        strategy = get_engine_mode()
+    if strategy not in SEARCH_STRATEGIES:
+        raise ValueError("Unknown search strategy: {}".format(strategy))
+    if checkpoint_size is None:
+        checkpoint_size = getattr(settings, "DERIVATION_ENGINE_CHECKPOINT", 500)
+
+    if not claim_derivation(derivation):
+        logger.debug("Derivation {} is already being searched.".format(derivation.id))
+        return
+
+    try:
+        # (Another worker may have made progress since the Derivation was
+        # loaded.)
+        derivation.refresh_from_db()
+        waiting = search_derivation(
+            derivation,
+            InProcessDispatcher(engine_actor, strategy),
+            strategy,
+            checkpoint_size,
+        )
+    finally:
+        release_derivation(derivation)
+
+    if derivation.complete:
+        resume_waiting_derivations(derivation.id, engine_actor)
+        return
+
+    # Some steps are waiting for sub-derivations that other workers are
+    # searching.  Those sub-derivations may have completed while we were
+    # busy, in which case nobody else will resume the steps; the search
+    # is picked up again if there is anything left to do.
+    for step_id, sub_derivation_id in waiting:
+        if Derivation.objects.filter(id=sub_derivation_id, complete=True).exists():
+            DerivationStep.objects.filter(
+                id=step_id, status=DerivationStep.STATUS_WAITING
+            ).update(status=DerivationStep.STATUS_PENDING)
+    if DerivationStep.objects.filter(
+        derivation=derivation, status=DerivationStep.STATUS_PENDING
+    ).exists():
+        engine_actor.send(str(derivation.id))
+
+
+def claim_derivation(derivation: Derivation) -> bool:
+    """
+    Atomically claims the given (incomplete) Derivation for the current
+    worker, so that no other worker searches it at the same time.
+    Claims that have not been renewed for DERIVATION_ENGINE_LEASE seconds
+    can be taken over.
+    :param derivation:
+    :return: False if the Derivation is complete or being searched already
+    """
+    now = timezone.now()
+    lease = getattr(settings, "DERIVATION_ENGINE_LEASE", 600)
+    claimed = (
+        Derivation.objects.filter(id=derivation.id, complete=False)
+        .filter(
+            Q(running_since=None)
+            | Q(running_since__lt=now - datetime.timedelta(seconds=lease))
+        )
+        .update(running_since=now)
+    )
+    return claimed > 0
+
+
+def release_derivation(derivation: Derivation) -> None:
+    """
+    Releases the current worker's claim on the given Derivation.
+    :param derivation:
+    :return:
+    """
+    Derivation.objects.filter(id=derivation.id).update(running_since=None)
+
+
+def resume_waiting_derivations(sub_derivation_id, engine_actor) -> None:
+    """
+    Resumes the search for the Derivations with DerivationSteps that were
+    waiting for the given (complete) sub-derivation.
+    (Cf. `.derive.resume_waiting_steps()`)
+    :param sub_derivation_id:
+    :param engine_actor:
+    :return:
+    """
+    waiting_steps = DerivationStep.objects.filter(
+        sub_derivations=sub_derivation_id, status=DerivationStep.STATUS_WAITING
+    )
+    derivation_ids = set(waiting_steps.values_list("derivation_id", flat=True))
+    DerivationStep.objects.filter(
+        id__in=list(waiting_steps.values_list("id", flat=True)),
+        status=DerivationStep.STATUS_WAITING,
+    ).update(status=DerivationStep.STATUS_PENDING)
+    for derivation_id in derivation_ids:
+        logger.debug("Resuming Derivation {}.".format(derivation_id))
+        engine_actor.send(str(derivation_id))
+
+
+def search_derivation(
+    derivation: Derivation,
+    dispatcher: InProcessDispatcher,
+    strategy: str,
+    checkpoint_size: int,
+) -> List[Tuple]:
+    """
+    Explores the whole state space of the given (claimed) Derivation,
+    starting from its pending DerivationSteps (usually just the first step,
+    unless a previous search was interrupted or had to wait for a
+    sub-derivation).
+    :param derivation:
+    :param dispatcher:
+    :param strategy: "dfs", "bfs" or "best"
+    :param checkpoint_size: The number of steps to process between
+        database writes
+    :return: (step_id, sub_derivation_id) pairs for the DerivationSteps
+        that were parked until their sub-derivations complete
+    """
+    start_time = time.perf_counter()
+
+    budget = SearchBudget.for_derivation(derivation)
+    if derivation.start_time is None:
+        derivation.start_time = timezone.now()
+    truncated = False
+
+    # The frontier starts with whatever was left pending in the database.
+    pending_steps = list(
+        DerivationStep.objects.filter(
+            derivation=derivation, status=DerivationStep.STATUS_PENDING
+        )
+    )
+    frontier = Frontier(strategy, get_heuristic() if strategy == ENGINE_BEST else None)
+    frontier.extend(SearchNode.from_step(step) for step in pending_steps)
+
+    # Transposition table: Identical states that are reached by different
+    # chains at the same depth are only processed once, and the chains are
+    # joined instead.  (Cf. `.derive.get_existing_step_ids()`)
+    # Maps (fingerprint, depth) pairs to the ids of the corresponding
+    # DerivationSteps.
+    known_states: Dict[Tuple[str, int], uuid.UUID] = {
+        (fingerprint, depth): step_id
+        for fingerprint, depth, step_id in DerivationStep.objects.filter(
+            derivation=derivation
+        )
+        .exclude(fingerprint="")
+        .values_list("fingerprint", "depth", "id")
+    }
+
+    # States that already have a reusable outcome in the database (possibly
+    # from other Derivations) are looked up in batches: When the search
+    # reaches a state that hasn't been checked yet, every other unchecked
+    # state on the frontier is checked along with it.  (New states that are
+    # reached again in this search are joined via `known_states` instead.)
+    memoized_fingerprints: Set[str] = set()
+    checked_fingerprints: Set[str] = set()
+    unchecked_fingerprints: Set[str] = set()
+
+    # Nodes created since the last checkpoint, nodes that were already
+    # saved but have been processed since the last checkpoint, and
+    # (step_id, previous_step_id) links between joined chains.
+    unsaved: List[SearchNode] = []
+    updated: List[SearchNode] = []
+    joins: List[Tuple] = []
+    # (step_id, sub_derivation_id) pairs for the sub-derivations that nodes
+    # have used or are waiting for, and for parked nodes alone
+    sub_derivation_links: List[Tuple] = []
+    waiting: List[Tuple] = []
+    created_count = 0
+    processed_count = 0
+    converged_count = 0
+    if budget.max_converged is not None:
+        converged_count = derivation.converged_count
+
+    while frontier:
+        node = frontier.pop()
+        step = node.step
+
+        # Stop searching if we are out of budget.  (The frontier does not
+        # include the current node any more.)
+        truncate_reason = budget.check(
+            derivation.processed_count + processed_count + 1,
+            len(frontier),
+            derivation.start_time,
+            converged_count,
+        )
+        if truncate_reason:
+            truncated = True
+            for pending_node in [node, *frontier]:
+                truncate_node(pending_node, truncate_reason, updated)
+            # (Truncated steps count as processed, as in broker mode; see
+            # `.derive.reopen_derivation()`)
+            processed_count += len(frontier) + 1
+            frontier.clear()
+            break
+
+        processed_count += 1
+
+        # Chains that are too long are cut off individually.
+        truncate_reason = budget.check_depth(step.depth)
+        if truncate_reason:
+            truncated = True
+            truncate_node(node, truncate_reason, updated)
+            continue
+
+        # Reuse the results of identical, already-saved steps if possible.
+        step.fingerprint = get_fingerprint(
+            node.root_so,
+            node.lexical_array_tail,
+            node.pipeline.content_hash,
+            node.metadata,
+            derivation.prune,
+        )
+        known_states.setdefault((step.fingerprint, step.depth), step.id)
+        if step.fingerprint not in checked_fingerprints:
+            unchecked_fingerprints.add(step.fingerprint)
+            memoized_fingerprints.update(
+                get_memoized_fingerprints(unchecked_fingerprints)
+            )
+            checked_fingerprints.update(unchecked_fingerprints)
+            unchecked_fingerprints.clear()
+        outcome = None
+        if step.fingerprint in memoized_fingerprints:
+            outcome = get_memoized_outcome(step.fingerprint, step.id)
+        if outcome is None:
+            outcome = expand_state(
+                node.root_so,
+                node.lexical_array_tail,
+                node.metadata,
+                node.pipeline.rule_handlers,
+                node.pipeline.generator_handlers,
+                dispatcher,
+                previous_rule_results=node.previous_rule_results,
+                prune=derivation.prune,
+            )
+
+        if outcome.status == DerivationStep.STATUS_WAITING:
+            # Another worker is searching the sub-derivation (see
+            # `InProcessDispatcher`), so this step is parked until it
+            # completes, and will be processed again then.
+            processed_count -= 1
+            step.status = DerivationStep.STATUS_WAITING
+            waiting.append((step.id, outcome.sub_derivation_id))
+            sub_derivation_links.append((step.id, outcome.sub_derivation_id))
+            if node.saved:
+                updated.append(node)
+            continue
+
+        step.status = outcome.status
+        step.rule_errors_json = json.dumps(outcome.rule_errors)
+        step.crash_reason = outcome.crash_reason
+        step.processed_time = timezone.now()
+        if outcome.status == DerivationStep.STATUS_CONVERGED:
+            step.converged_derivation_id = derivation.id
+            converged_count += 1
+        elif outcome.status == DerivationStep.STATUS_CRASHED:
+            step.crashed_derivation_id = derivation.id
+
+        if node.saved:
+            updated.append(node)
+        sub_derivation_links += [
+            (step.id, sub_derivation_id)
+            for sub_derivation_id in get_sub_derivation_ids(outcome.next_step_defs)
+        ]
+
+        children = []
+        seen_fingerprints = set()
+        for next_step_def in outcome.next_step_defs:
+            fingerprint = get_fingerprint(
+                next_step_def.root_so,
+                next_step_def.lexical_array_tail,
+                node.pipeline.content_hash,
+                next_step_def.metadata,
+                derivation.prune,
+            )
+            # Identical siblings would only lead to identical chains (cf.
+            # the dedupe pass in `.derive.process_derivation_step()`)
+            if fingerprint in seen_fingerprints:
+                step.duplicate_count += 1
+                continue
+            seen_fingerprints.add(fingerprint)
+
+            if (fingerprint, step.depth + 1) in known_states:
+                joins.append((known_states[(fingerprint, step.depth + 1)], step.id))
+                continue
+
+            metadata_json = ""
+            if next_step_def.metadata is not None:
+                metadata_json = json.dumps(dataclasses.asdict(next_step_def.metadata))
+
+            child = SearchNode(
+                step=DerivationStep(
+                    derivation_id=derivation.id,
+                    previous_step_id=step.id,
+                    configuration_id=step.configuration_id,
+                    generator_metadata_json=metadata_json,
+                    fingerprint=fingerprint,
+                    depth=step.depth + 1,
+                ),
+                root_so=next_step_def.root_so,
+                lexical_array_tail=deque(next_step_def.lexical_array_tail),
+                metadata=next_step_def.metadata,
+                pipeline=node.pipeline,
+                previous_rule_results=outcome.rule_results,
+            )
+            children.append(child)
+            unsaved.append(child)
+            known_states.setdefault((fingerprint, child.step.depth), child.step.id)
+            unchecked_fingerprints.add(fingerprint)
+
+        frontier.extend(children)
+        created_count += len(children)
+
+        if processed_count % checkpoint_size == 0:
+            save_search_nodes(derivation, unsaved, updated, joins, sub_derivation_links)
+            save_search_progress(derivation, created_count, processed_count)
+            unsaved = []
+            updated = []
+            joins = []
+            sub_derivation_links = []
+
+    save_search_nodes(derivation, unsaved, updated, joins, sub_derivation_links)
+
+    # Unless some steps (possibly from a previous search) are still waiting
+    # for their sub-derivations, every chain in the Derivation has been
+    # processed (or cut off).
+    derivation.created_count += created_count
+    derivation.processed_count += processed_count
+    derivation.pending_count = DerivationStep.objects.filter(
+        derivation=derivation, status=DerivationStep.STATUS_WAITING
+    ).count()
+    if derivation.pending_count == 0:
+        DerivationStep.objects.filter(derivation=derivation).update(complete=True)
+        derivation.complete = True
+    derivation.truncated = derivation.truncated or truncated
+    derivation.save(
+        update_fields=[
+            "start_time",
+            "created_count",
+            "processed_count",
+            "pending_count",
+            "complete",
+            "truncated",
+        ]
+    )
+
+    logger.info(
+        "Searched Derivation {} ({}) in {:.3f}s: {} steps".format(
+            derivation.id, strategy, time.perf_counter() - start_time, processed_count
+        )
+    )
+    return waiting
+
+
+def truncate_node(node: SearchNode, reason: str, updated: List[SearchNode]) -> None:
+    """
+    Cuts off the chain at the given (unprocessed) search node.
+    :param node:
+    :param reason:
+    :param updated: Nodes whose (saved) DerivationSteps need to be updated
+    :return:
+    """
+    node.step.status = DerivationStep.STATUS_TRUNCATED
+    node.step.crash_reason = reason
+    node.step.processed_time = timezone.now()
+    if node.saved:
+        updated.append(node)
+
+
+def save_search_progress(
+    derivation: Derivation, created_count: int, processed_count: int
+) -> None:
+    """
+    Records the search progress for the given Derivation, for resuming the
+    search with the same budget, and renews the current worker's claim on
+    it (see `claim_derivation()`).
+    :param derivation:
+    :param created_count: The number of DerivationSteps created since the
+        search was (re)started
+    :param processed_count: The number of DerivationSteps processed since
+        the search was (re)started
+    :return:
+    """
+    Derivation.objects.filter(id=derivation.id).update(
+        start_time=derivation.start_time,
+        created_count=derivation.created_count + created_count,
+        processed_count=derivation.processed_count + processed_count,
+        running_since=timezone.now(),
+    )
+
+
+def save_search_nodes(
+    derivation: Derivation,
+    unsaved: List[SearchNode],
+    updated: List[SearchNode],
+    joins: List[Tuple],
+    sub_derivation_links: List[Tuple],
+) -> None:
+    """
+    Writes the given search nodes to the database in one batched transaction.
+    :param derivation:
+    :param unsaved: Nodes whose DerivationSteps have not been saved yet;
+        parents must come before their children.
+    :param updated: Nodes whose (saved) DerivationSteps have been processed
+        since they were saved.
+    :param joins: (step_id, previous_step_id) pairs for joined chains
+    :param sub_derivation_links: (step_id, sub_derivation_id) pairs for the
+        sub-derivations that steps have used or are waiting for
+    :return:
+    """
+    if not unsaved and not updated and not joins and not sub_derivation_links:
+        return
+
+    start_time = time.perf_counter()
+
+    with transaction.atomic():
+        create_derivation_steps(
+            [node.step for node in unsaved],
+            root_sos=[node.root_so for node in unsaved],
+            lexical_array_tails=[node.lexical_array_tail for node in unsaved],
+        )
+        for node in unsaved:
+            node.saved = True
+        join_derivation_steps(joins)
+        link_sub_derivations(sub_derivation_links)
+
+        DerivationStep.objects.bulk_update(
+            [node.step for node in updated],
+            [
+                "status",
+                "rule_errors_json",
+                "crash_reason",
+                "processed_time",
+                "converged_derivation",
+                "crashed_derivation",
+                "fingerprint",
+                "duplicate_count",
+            ],
+        )
+
+        # Cf. `.derive.mark_derivation_chain_ended()`
+        chains_ended = any(
+            node.step.status != DerivationStep.STATUS_PENDING
+            and node.step.status != DerivationStep.STATUS_PROCESSED
+            for node in unsaved + updated
+        )
+        if chains_ended:
+            for derivation_request in DerivationRequest.objects.filter(
+                derivations=derivation
+            ):
+                derivation_request.last_completion_time = timezone.now()
+                derivation_request.save()
+
+    logger.debug(
+        "Saved {} new and {} updated DerivationSteps in {:.3f}s.".format(
+            len(unsaved), len(updated), time.perf_counter() - start_time
+        )
+    )
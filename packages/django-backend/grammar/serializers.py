@@ -30,6 +30,12 @@ class DerivationInputSerializer(serializers.Serializer):
         child=serializers.DictField(child=serializers.CharField())
     )
 
+    # Optional search budget for the requested Derivations, with any of the
+    # limits in `Derivation.BUDGET_FIELDS`
+    budget = serializers.DictField(
+        child=serializers.IntegerField(min_value=1), required=False
+    )
+
     @staticmethod
     def validate_derivation_input(value):
         if not value:
@@ -48,6 +54,16 @@ class DerivationInputSerializer(serializers.Serializer):
 
         return value
 
+    @staticmethod
+    def validate_budget(value):
+        for limit in value:
+            if limit not in Derivation.BUDGET_FIELDS:
+                raise serializers.ValidationError(
+                    "Unknown search budget limit: {}".format(limit)
+                )
+
+        return value
+
 
 class DerivationRequestSerializer(serializers.ModelSerializer):
     """
@@ -108,12 +124,13 @@ class DerivationStepSerializer(serializers.ModelSerializer):
             "root_so",
             "lexical_array_tail",
             "crash_reason",
+            "failed",
             "rule_errors",
             "generator_metadata",
         ]
 
     id = serializers.UUIDField()
-    root_so = SyntacticObjectSerializer()
+    root_so = SyntacticObjectSerializer(source="display_root_so")
     lexical_array_tail = serializers.ListField(child=LexicalItemSerializer())
     crash_reason = serializers.CharField(required=False)
 
@@ -152,8 +169,12 @@ class DerivationStepSerializer(serializers.ModelSerializer):
         data = super().to_representation(obj)
         # data is your serialized instance
 
-        # Only add `crash_reason` if the DerivationStep is actually crashed.
-        if obj.status != DerivationStep.STATUS_CRASHED:
+        # Only add `crash_reason` if the DerivationStep is actually crashed
+        # (or truncated).
+        if obj.status not in (
+            DerivationStep.STATUS_CRASHED,
+            DerivationStep.STATUS_TRUNCATED,
+        ):
             data.pop("crash_reason")
 
         return data
@@ -175,6 +196,7 @@ class DerivationSerializer(serializers.ModelSerializer):
             "converged_chains",
             "crashed_chains",
             "complete",
+            "truncated",
         ]
 
     id = serializers.UUIDField()
@@ -3,16 +3,71 @@ Dramatiq actors for processing derivations.
 """
 import logging
 import time
+import uuid
+from typing import Dict, List
 
 import dramatiq
+from django.conf import settings
+from django.db import InterfaceError, OperationalError
+from dramatiq.errors import BrokerError
+from dramatiq.middleware import CurrentMessage, Retries
 
-from grammar.derive import process_derivation_step
-from grammar.models import DerivationStep
+from grammar.derive import fail_derivation_step, process_derivation_step
+from grammar.models import Derivation, DerivationStep
+from grammar.search import ENGINE_BROKER, get_engine_mode, run_derivation
+from grammar.tree import load_root_sos
+from lexicon.registry import feature_registry
 
 logger = logging.getLogger("cs-toolkit-grammar")
 
+# Errors that may well go away if the task is retried (e.g., if the database
+# or the broker is briefly unavailable)
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, BrokerError)
+
+# Retry options for the DerivationStep actors
+RETRY_OPTIONS = {
+    "max_retries": getattr(settings, "DERIVATION_MAX_RETRIES", 5),
+    "min_backoff": getattr(settings, "DERIVATION_MIN_BACKOFF", 1000),
+}
+
+
+def start_derivation(derivation: Derivation):
+    """
+    Requests processing of the given Derivation, according to the
+    configured engine mode (see `.search`).
+    :param derivation:
+    :return:
+    """
+    if get_engine_mode() == ENGINE_BROKER:
+        derivation_actor.send(str(derivation.first_step.id))
+    else:
+        derivation_engine_actor.send(str(derivation.id))
+
 
 @dramatiq.actor
+def derivation_engine_actor(derivation_id: str):
+    """
+    Task for exploring a whole Derivation in a single worker, using the
+    in-process search engine in `.search`.
+    :param derivation_id:
+    :return:
+    """
+    try:
+        derivation: Derivation = Derivation.objects.get(id=derivation_id)
+    except Derivation.DoesNotExist:
+        logger.warning("Could not find Derivation: {}".format(derivation_id))
+        return
+
+    if derivation.complete:
+        return
+
+    # Pick up any changes made to the lexicon by other processes.
+    feature_registry.refresh_if_changed()
+
+    run_derivation(derivation, derivation_engine_actor)
+
+
+@dramatiq.actor(**RETRY_OPTIONS)
 def derivation_actor(step_id: str):
     """
     Main task for processing DerivationSteps.
@@ -20,59 +75,121 @@ def derivation_actor(step_id: str):
     Arguments must be serializable, so we need to send the string
     representation of the DerivationStep's UUID rather than the raw
     DerivationStep itself.
+
+    Used to start processing a chain (e.g., for the first step in a
+    Derivation or sub-derivation, or for a parked step); the rest of the
+    chain is processed in batches by `derivation_batch_actor`.
     :param step_id:
     :return:
     """
+    process_derivation_steps([step_id])
+
+
+@dramatiq.actor(**RETRY_OPTIONS)
+def derivation_batch_actor(step_ids: List[str]):
+    """
+    As with `derivation_actor`, but for a batch of DerivationSteps, so that
+    the broker and the database are only hit once per batch rather than
+    once per step.
+    :param step_ids:
+    :return:
+    """
+    process_derivation_steps(step_ids)
+
+
+def process_derivation_steps(step_ids: List[str]):
+    """
+    Processes the given DerivationSteps, then sends all their next steps
+    off for processing, in batches of `DERIVATION_BATCH_SIZE`.
+    :param step_ids:
+    :return:
+    """
     start_time = time.perf_counter()
 
-    try:
-        step: DerivationStep = DerivationStep.objects.get(id=step_id)
-    except DerivationStep.DoesNotExist:
-        logger.warning("Could not find DerivationStep: {}".format(step_id))
-        return
+    # Load the steps and their root SOs in one go.
+    steps: List[DerivationStep] = list(
+        DerivationStep.objects.filter(id__in=step_ids).select_related("derivation")
+    )
+    if len(steps) < len(step_ids):
+        found_ids = {str(step.id) for step in steps}
+        for step_id in step_ids:
+            if step_id not in found_ids:
+                logger.warning("Could not find DerivationStep: {}".format(step_id))
+    root_sos = load_root_sos(steps)
+
+    # Steps from the same Derivation share a single instance, so that its
+    # counters stay up to date across the batch (see
+    # `.derive.check_step_budget()`).
+    derivations: Dict[uuid.UUID, Derivation] = {}
+    for step in steps:
+        step.derivation = derivations.setdefault(step.derivation_id, step.derivation)
 
-    # Process the DerivationStep and continue the chain.
-    next_steps = process_derivation_step(step, derivation_actor)
+    # Pick up any changes made to the lexicon by other processes.
+    feature_registry.refresh_if_changed()
+
+    # Process the DerivationSteps and continue their chains.
+    # (The Derivations are marked complete by whichever worker finishes
+    # their last pending step; see `.derive.count_finished_step()`)
+    # A step that fails unexpectedly is crashed on its own, so that it
+    # doesn't take the rest of the batch (and their next steps) with it.
+    # Transient errors are left to the broker to retry instead, until the
+    # retries run out.  (When the batch is retried, the steps that were
+    # already finished are not processed again, but their next steps are
+    # sent again; see `.derive.process_derivation_step()`)
+    all_next_steps: List[DerivationStep] = []
+    for step, root_so in zip(steps, root_sos):
+        try:
+            all_next_steps += process_derivation_step(
+                step, derivation_actor, root_so=root_so
+            )
+        except Exception as error:
+            if isinstance(error, TRANSIENT_ERRORS) and not is_last_attempt():
+                raise
+            logger.exception("Error processing DerivationStep: {}".format(step.id))
+            fail_derivation_step(
+                step, "{}: {}".format(type(error).__name__, error), derivation_actor
+            )
 
     # Performance logging
     logger.info(
-        "Processed a DerivationStep in {:.3f}s: {} next steps".format(
-            time.perf_counter() - start_time, len(next_steps)
+        "Processed {} DerivationSteps in {:.3f}s: {} next steps".format(
+            len(steps), time.perf_counter() - start_time, len(all_next_steps)
         )
     )
 
-    # Continue chain
-    for next_step in next_steps:
-        derivation_actor.send(str(next_step.id))
-
-    if len(next_steps) == 0:
-        check_completion(step_id)
+    # Continue chains
+    if len(all_next_steps) > 0:
+        batch_size = getattr(settings, "DERIVATION_BATCH_SIZE", 16)
+        next_step_ids = [str(next_step.id) for next_step in all_next_steps]
+        dramatiq.group(
+            derivation_batch_actor.message(next_step_ids[idx : idx + batch_size])
+            for idx in range(0, len(next_step_ids), batch_size)
+        ).run()
 
 
-def check_completion(step_id: str):
+def is_last_attempt() -> bool:
     """
-    When DerivationStep chains reach their conclusion, the last
-    DerivationStep is marked complete.  This function then checks whether
-    every DerivationStep in the chain is complete (i.e., it and all its
-    descendants are complete)
-    :param step_id:
+    Checks whether the message that the current actor is processing will
+    not be retried if it fails (cf. `dramatiq.middleware.Retries`).
+    Needs the `CurrentMessage` middleware; without it, every attempt is
+    taken to be the last.
     :return:
     """
-    # Check subsequent steps
-    step: DerivationStep = DerivationStep.objects.get(id=step_id)
-    complete = True
-    for next_step in step.next_steps.all():
-        if not next_step.complete:
-            complete = False
-
-    # If this step is complete, check its predecessor
-    if complete:
-        step.complete = True
-        step.save()
-
-        if step.previous_step:
-            check_completion(str(step.previous_step.id))
-        else:
-            # This is the first step in a Derivation
-            step.derivation.complete = True
-            step.derivation.save()
+    message = CurrentMessage.get_current_message()
+    if message is None:
+        return True
+
+    broker = dramatiq.get_broker()
+    retries = [
+        middleware
+        for middleware in broker.middleware
+        if isinstance(middleware, Retries)
+    ]
+    if not retries:
+        return True
+
+    actor = broker.get_actor(message.actor_name)
+    max_retries = message.options.get("max_retries") or actor.options.get(
+        "max_retries", retries[0].max_retries
+    )
+    return max_retries is not None and message.options.get("retries", 0) >= max_retries
@@ -1,3 +1,696 @@
-from django.test import TestCase
+import json
+import os
+from typing import Dict, List, Optional, Set, Tuple
+from unittest import mock
 
-# Create your tests here.
+import dramatiq
+from django.db import OperationalError
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+from dramatiq import Worker
+from rest_framework.test import APIClient
+
+from grammar import derive, search, tasks
+from grammar.generators import externalmerge
+from grammar.models import Derivation, DerivationStep
+from grammar.search import ENGINE_BEST, ENGINE_BFS, ENGINE_DFS
+from grammar.serializers import DerivationChainSerializer
+from grammar.util import create_derivation, get_derivation_by_lexical_array
+from lexicon.models import LexicalItem
+from lexicon.registry import feature_registry
+
+
+class DerivationTestCase(TransactionTestCase):
+    """
+    Runs Derivations to completion with an in-process worker (the test
+    settings use Dramatiq's StubBroker).
+    """
+
+    fixtures = ["lexicon", "rules", "generators"]
+
+    def setUp(self):
+        self.broker = dramatiq.get_broker()
+        self.broker.flush_all()
+        self.worker = Worker(self.broker, worker_threads=1)
+        self.worker.start()
+
+        # Sub-derivation results are cached per process, but the database is
+        # reset for every test.
+        externalmerge._sub_derivation_sos.clear()
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def get_derivation(self, words: str) -> Derivation:
+        """
+        Retrieves the Derivation for a space-separated lexical array of
+        "text/language" items.
+        :param words:
+        :return:
+        """
+        lexical_array: List[LexicalItem] = []
+        for word in words.split():
+            text, language = word.split("/")
+            lexical_array.append(LexicalItem.objects.get(text=text, language=language))
+        return get_derivation_by_lexical_array(lexical_array)
+
+    def derive(self, words: str, **budget) -> Derivation:
+        """
+        Runs the Derivation for the given lexical array to completion, and
+        returns it.
+        :param words:
+        :param budget: Search budget limits for the Derivation, if any
+        :return:
+        """
+        derivation = self.get_derivation(words)
+        if budget:
+            Derivation.objects.filter(id=derivation.id).update(**budget)
+        return self.complete(derivation)
+
+    def complete(self, derivation: Derivation) -> Derivation:
+        """
+        Runs the given Derivation to completion, and returns it.
+        :param derivation:
+        :return:
+        """
+        tasks.start_derivation(derivation)
+        self.broker.join(tasks.derivation_actor.queue_name)
+        self.worker.join()
+        derivation.refresh_from_db()
+        return derivation
+
+    def reset_derivations(self):
+        """
+        Deletes every Derivation, so that the next ones are derived from
+        scratch (without reusing the results of earlier steps).
+        :return:
+        """
+        DerivationStep.objects.all().delete()
+        Derivation.objects.all().delete()
+        externalmerge._sub_derivation_sos.clear()
+
+    @staticmethod
+    def get_results(derivation: Derivation) -> Tuple[Set, Set]:
+        """
+        Returns the converged and crashed chains of the given Derivation, as
+        sequences of root SO ids and statuses (which do not depend on how
+        the Derivation was processed).
+        :param derivation:
+        :return:
+        """
+        return tuple(
+            {
+                tuple((step.shared_root_so_id, step.status) for step in chain)
+                for chain in chains
+            }
+            for chains in (derivation.converged_chains, derivation.crashed_chains)
+        )
+
+
+class EngineTests(DerivationTestCase):
+    """
+    The in-process search engines should find the same chains as the
+    broker.
+    """
+
+    lexical_arrays = (
+        "John/en loves/en v*/func Mary/en T/func C/func",
+        "Mary/en loves/en v*/func [/sys John/en who/en ]/sys T/func C/func",
+    )
+
+    def assertSameResults(self, engine: str):
+        expected = [
+            self.get_results(self.derive(words)) for words in self.lexical_arrays
+        ]
+        self.reset_derivations()
+
+        with override_settings(DERIVATION_ENGINE=engine):
+            for words, (converged, crashed) in zip(self.lexical_arrays, expected):
+                derivation = self.derive(words)
+                self.assertTrue(derivation.complete)
+                self.assertEqual(self.get_results(derivation), (converged, crashed))
+                self.assertTrue(converged)
+
+    def test_dfs(self):
+        self.assertSameResults(ENGINE_DFS)
+
+    def test_bfs(self):
+        self.assertSameResults(ENGINE_BFS)
+
+    def test_best(self):
+        self.assertSameResults(ENGINE_BEST)
+
+
+class JoinTests(DerivationTestCase):
+    def create_step(self, previous_step: DerivationStep, fingerprint: str):
+        return DerivationStep.objects.create(
+            derivation_id=previous_step.derivation_id,
+            previous_step=previous_step,
+            configuration_id=previous_step.configuration_id,
+            fingerprint=fingerprint,
+            depth=previous_step.depth + 1,
+        )
+
+    def test_join_at_same_depth(self):
+        # One chain reaches states A, B and C in turn; another branches off
+        # after A.
+        derivation = self.get_derivation(
+            "John/en loves/en v*/func Mary/en T/func C/func"
+        )
+        step_a = self.create_step(derivation.first_step, "A")
+        step_b = self.create_step(step_a, "B")
+        step_c = self.create_step(step_b, "C")
+        other_step = self.create_step(step_a, "D")
+
+        # The other chain can only be joined to states at the same depth as
+        # its next steps.
+        self.assertEqual(
+            derive.get_existing_step_ids(other_step, ["A", "B", "C"]), {"C": step_c.id},
+        )
+
+
+@override_settings(DERIVATION_ENGINE=ENGINE_DFS)
+class EngineClaimTests(DerivationTestCase):
+    """
+    Only one worker should search a Derivation at a time.
+    """
+
+    lexical_array = "Mary/en loves/en v*/func [/sys John/en who/en ]/sys T/func C/func"
+
+    def assertCounted(self, derivation: Derivation):
+        self.assertTrue(derivation.complete)
+        self.assertIsNone(derivation.running_since)
+        self.assertEqual(derivation.pending_count, 0)
+        step_count = derivation.derivationstep_set.count()
+        self.assertEqual(derivation.created_count, step_count)
+        self.assertEqual(derivation.processed_count, step_count)
+
+    def test_concurrent_search(self):
+        derivation = self.get_derivation(self.lexical_array)
+        expand_state = search.expand_state
+        searches = []
+
+        def expand_state_and_search(*args, **kwargs):
+            # Another worker tries to search the same Derivation in the middle
+            # of this search.
+            if not searches:
+                searches.append(derivation.id)
+                tasks.derivation_engine_actor(str(derivation.id))
+            return expand_state(*args, **kwargs)
+
+        with mock.patch("grammar.search.expand_state", expand_state_and_search):
+            derivation = self.complete(derivation)
+        self.assertTrue(searches)
+        self.assertCounted(derivation)
+        self.assertEqual(derivation.converged_count, 3)
+
+        # Once the Derivation is complete, searching it again does nothing.
+        tasks.derivation_engine_actor.send(str(derivation.id))
+        tasks.derivation_engine_actor.send(str(derivation.id))
+        self.broker.join(tasks.derivation_engine_actor.queue_name)
+        self.worker.join()
+        derivation.refresh_from_db()
+        self.assertCounted(derivation)
+
+    def test_waiting_for_sub_derivation(self):
+        # Another worker is busy with the sub-derivation.
+        sub_derivation = get_derivation_by_lexical_array(
+            [
+                LexicalItem.objects.get(text="John", language="en"),
+                LexicalItem.objects.get(text="who", language="en"),
+            ],
+            prune=False,
+        )
+        Derivation.objects.filter(id=sub_derivation.id).update(
+            running_since=timezone.now()
+        )
+
+        # The steps that need it are parked, and the rest of the search goes
+        # on without them.
+        derivation = self.derive(self.lexical_array)
+        self.assertFalse(derivation.complete)
+        self.assertIsNone(derivation.running_since)
+        waiting_steps = derivation.derivationstep_set.filter(
+            status=DerivationStep.STATUS_WAITING
+        )
+        self.assertTrue(waiting_steps.exists())
+        self.assertEqual(derivation.pending_count, waiting_steps.count())
+        for step in waiting_steps:
+            self.assertEqual(list(step.sub_derivations.all()), [sub_derivation])
+
+        # They are resumed once the sub-derivation is complete.
+        Derivation.objects.filter(id=sub_derivation.id).update(running_since=None)
+        tasks.derivation_engine_actor.send(str(sub_derivation.id))
+        self.broker.join(tasks.derivation_engine_actor.queue_name)
+        self.worker.join()
+        derivation.refresh_from_db()
+        self.assertCounted(derivation)
+        self.assertEqual(derivation.converged_count, 3)
+
+
+class BudgetTests(DerivationTestCase):
+    lexical_array = "John/en loves/en v*/func Mary/en T/func C/func"
+
+    def assertTruncated(self, derivation: Derivation):
+        self.assertTrue(derivation.complete)
+        self.assertTrue(derivation.truncated)
+        self.assertTrue(
+            derivation.derivationstep_set.filter(
+                status=DerivationStep.STATUS_TRUNCATED
+            ).exists()
+        )
+        self.assertFalse(derivation.derivationstep_set.filter(complete=False).exists())
+
+    def test_max_steps(self):
+        derivation = self.derive(self.lexical_array, max_steps=5)
+        self.assertTruncated(derivation)
+        self.assertEqual(
+            derivation.derivationstep_set.filter(
+                status=DerivationStep.STATUS_PROCESSED
+            ).count(),
+            5,
+        )
+
+    def test_max_steps_in_process(self):
+        with override_settings(DERIVATION_ENGINE=ENGINE_DFS):
+            derivation = self.derive(self.lexical_array, max_steps=5)
+        self.assertTruncated(derivation)
+        self.assertEqual(
+            derivation.derivationstep_set.filter(
+                status=DerivationStep.STATUS_PROCESSED
+            ).count(),
+            5,
+        )
+
+    def test_max_depth(self):
+        derivation = self.derive(self.lexical_array, max_depth=3)
+        self.assertTruncated(derivation)
+        self.assertFalse(derivation.derivationstep_set.filter(depth__gt=4).exists())
+
+    def request_derivation(self, **budget) -> Derivation:
+        """
+        Requests the Derivation for the lexical array through the API, with
+        the given search budget, and returns it once it is complete.
+        :param budget:
+        :return:
+        """
+        derivation_input = [
+            dict(zip(("text", "language"), word.split("/")))
+            for word in self.lexical_array.split()
+        ]
+        response = APIClient().post(
+            "/api/grammar/",
+            {"derivation_input": derivation_input, "budget": budget},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.broker.join(tasks.derivation_actor.queue_name)
+        self.worker.join()
+        return self.get_derivation(self.lexical_array)
+
+    def assertReopened(self):
+        results = self.get_results(self.derive(self.lexical_array))
+        self.reset_derivations()
+
+        derivation = self.request_derivation(max_steps=5)
+        self.assertTruncated(derivation)
+
+        # The same budget (or a smaller one) gets the same results.
+        derivation = self.request_derivation(max_steps=3)
+        self.assertTruncated(derivation)
+        self.assertEqual(derivation.max_steps, 5)
+
+        # A larger one carries on with the search.
+        derivation = self.request_derivation(max_steps=1000)
+        self.assertTrue(derivation.complete)
+        self.assertFalse(derivation.truncated)
+        self.assertEqual(derivation.max_steps, 1000)
+        self.assertEqual(self.get_results(derivation), results)
+        step_count = derivation.derivationstep_set.count()
+        self.assertEqual(derivation.processed_count, step_count)
+        self.assertEqual(derivation.pending_count, 0)
+
+    def test_larger_budget(self):
+        self.assertReopened()
+
+    def test_larger_budget_in_process(self):
+        with override_settings(DERIVATION_ENGINE=ENGINE_DFS):
+            self.assertReopened()
+
+
+class RedeliveryTests(DerivationTestCase):
+    """
+    Broker messages may be delivered more than once; every step should
+    still only be processed (and counted) once.
+    """
+
+    lexical_array = "Mary/en loves/en v*/func [/sys John/en who/en ]/sys T/func C/func"
+
+    def assertCounted(self, derivation: Derivation):
+        self.assertTrue(derivation.complete)
+        self.assertEqual(derivation.pending_count, 0)
+        step_count = derivation.derivationstep_set.count()
+        self.assertEqual(derivation.created_count, step_count)
+        self.assertEqual(derivation.processed_count, step_count)
+
+    def test_duplicate_delivery(self):
+        process_derivation_steps = tasks.process_derivation_steps
+
+        def process_twice(step_ids):
+            process_derivation_steps(step_ids)
+            process_derivation_steps(step_ids)
+
+        with mock.patch("grammar.tasks.process_derivation_steps", process_twice):
+            derivation = self.derive(self.lexical_array)
+        self.assertCounted(derivation)
+        self.assertEqual(derivation.converged_count, 3)
+        self.assertFalse(derivation.truncated)
+
+    def test_redelivery_after_completion(self):
+        derivation = self.derive(self.lexical_array)
+        self.assertCounted(derivation)
+        results = self.get_results(derivation)
+
+        # Send every step again, as if the messages had been redelivered.
+        step_ids = [
+            str(step_id)
+            for step_id in DerivationStep.objects.values_list("id", flat=True)
+        ]
+        tasks.derivation_batch_actor.send(step_ids)
+        self.broker.join(tasks.derivation_actor.queue_name)
+        self.worker.join()
+
+        # (Including the sub-derivation's.)
+        for each_derivation in Derivation.objects.all():
+            self.assertCounted(each_derivation)
+        derivation.refresh_from_db()
+        self.assertEqual(self.get_results(derivation), results)
+        self.assertFalse(
+            DerivationStep.objects.filter(status=DerivationStep.STATUS_PENDING).exists()
+        )
+
+
+class MemoTests(DerivationTestCase):
+    """
+    Identical states in different Derivations share their outcomes (see
+    `.derive.get_memoized_outcome()`).
+    """
+
+    lexical_array = "John/en loves/en v*/func Mary/en T/func C/func"
+
+    def derive_again(self, derivation: Derivation, **kwargs) -> Derivation:
+        """
+        Runs a second Derivation over the same lexical array as the given
+        one, and returns it.
+        :param derivation:
+        :param kwargs: Passed on to `create_derivation()`
+        :return:
+        """
+        lexical_array = list(Derivation.get_lexical_array(derivation.id))
+        return self.complete(create_derivation(lexical_array, **kwargs))
+
+    def test_outcomes_are_reused(self):
+        derivation = self.derive(self.lexical_array)
+
+        with mock.patch(
+            "grammar.derive.expand_state", wraps=derive.expand_state
+        ) as expand_state:
+            second_derivation = self.derive_again(derivation)
+        expand_state.assert_not_called()
+        self.assertEqual(
+            second_derivation.derivationstep_set.count(),
+            derivation.derivationstep_set.count(),
+        )
+        self.assertEqual(
+            self.get_results(second_derivation), self.get_results(derivation)
+        )
+
+    def test_outcomes_are_not_reused_after_lexicon_change(self):
+        derivation = self.derive(self.lexical_array)
+        feature_registry.invalidate()
+
+        with mock.patch(
+            "grammar.derive.expand_state", wraps=derive.expand_state
+        ) as expand_state:
+            second_derivation = self.derive_again(derivation)
+        self.assertEqual(
+            expand_state.call_count, second_derivation.derivationstep_set.count()
+        )
+        self.assertEqual(
+            self.get_results(second_derivation), self.get_results(derivation)
+        )
+
+    def test_pruning(self):
+        # Pruning only cuts off chains that could never converge.
+        derivation = self.derive(
+            "Mary/en loves/en v*/func [/sys John/en who/en ]/sys T/func C/func"
+        )
+        unpruned_derivation = self.derive_again(derivation, prune=False)
+        self.assertTrue(derivation.converged_count)
+        self.assertEqual(
+            self.get_results(derivation)[0], self.get_results(unpruned_derivation)[0]
+        )
+
+        # (Without v*, nothing can check the object's Case feature.)
+        derivation = self.derive("John/en loves/en Mary/en T/func C/func")
+        unpruned_derivation = self.derive_again(derivation, prune=False)
+        self.assertEqual(unpruned_derivation.converged_count, 0)
+        self.assertLess(
+            derivation.derivationstep_set.count(),
+            unpruned_derivation.derivationstep_set.count(),
+        )
+
+
+class LexicalArrayTests(DerivationTestCase):
+    def test_lexical_array_after_lexicon_change(self):
+        derivation = self.get_derivation(
+            "John/en loves/en v*/func Mary/en T/func C/func"
+        )
+        lexical_item = Derivation.get_lexical_array(derivation.id)[0]
+        feature = lexical_item.features.all()[0]
+
+        LexicalItem.objects.get(id=lexical_item.id).features.remove(feature)
+        feature_registry.refresh_if_changed()
+        lexical_item = Derivation.get_lexical_array(derivation.id)[0]
+        self.assertNotIn(feature, lexical_item.features.all())
+
+
+class SubDerivationTests(DerivationTestCase):
+    def test_sub_derivations_are_not_pruned(self):
+        # The sub-derivation's final SOs still have their uninterpretable
+        # Case features, which are only checked in the parent Derivation.
+        derivation = self.derive(
+            "Mary/en loves/en v*/func [/sys John/en who/en ]/sys T/func C/func"
+        )
+        self.assertTrue(derivation.complete)
+        self.assertEqual(derivation.converged_count, 3)
+
+        sub_derivation = Derivation.objects.get(prune=False)
+        self.assertTrue(sub_derivation.complete)
+        self.assertEqual(sub_derivation.converged_count, 0)
+        self.assertGreater(sub_derivation.crashed_count, 0)
+
+    def assertSubDerivationsRecorded(self):
+        derivation = self.derive(
+            "Mary/en loves/en v*/func [/sys John/en who/en ]/sys T/func C/func"
+        )
+        sub_derivation = Derivation.objects.get(prune=False)
+        lexical_array = list(Derivation.get_lexical_array(derivation.id))
+
+        # The sub-derivation is recorded whether it had to be derived first,
+        # was already cached, or was used by a memoized step.
+        derivations = [
+            derivation,
+            self.complete(create_derivation(lexical_array, prune=False)),
+            self.complete(create_derivation(lexical_array)),
+        ]
+        for each_derivation in derivations:
+            trigger_steps = sub_derivation.trigger_steps.filter(
+                derivation=each_derivation
+            )
+            self.assertTrue(trigger_steps.exists())
+            for step in trigger_steps:
+                self.assertEqual(list(step.sub_derivations.all()), [sub_derivation])
+                self.assertTrue(
+                    all(
+                        json.loads(next_step.generator_metadata_json)["sub_derivation"]
+                        == str(sub_derivation.id)
+                        for next_step in step.next_steps.all()
+                    )
+                )
+
+    def test_sub_derivations_are_recorded(self):
+        self.assertSubDerivationsRecorded()
+
+    def test_sub_derivations_are_recorded_in_process(self):
+        with override_settings(DERIVATION_ENGINE=ENGINE_DFS):
+            self.assertSubDerivationsRecorded()
+
+
+class StepFailureTests(DerivationTestCase):
+    lexical_array = "John/en loves/en v*/func Mary/en T/func C/func"
+
+    def derive_with_errors(self, error: Exception, attempts: int) -> Derivation:
+        """
+        Derives the lexical array, with the given error raised for the first
+        few attempts at processing its third state.
+        :param error:
+        :param attempts: The number of attempts that should fail
+        :return:
+        """
+        expand_state = derive.expand_state
+        states = []
+        self.failed_attempts = 0
+
+        def flaky_expand_state(root_so, lexical_array_tail, *args, **kwargs):
+            state = (root_so, len(lexical_array_tail))
+            if state not in states:
+                states.append(state)
+            if states.index(state) == 2 and self.failed_attempts < attempts:
+                self.failed_attempts += 1
+                raise error
+            return expand_state(root_so, lexical_array_tail, *args, **kwargs)
+
+        with mock.patch("grammar.derive.expand_state", flaky_expand_state):
+            return self.derive(self.lexical_array)
+
+    def test_failed_step_is_crashed(self):
+        derivation = self.derive_with_errors(RuntimeError("Unexpected error"), 1)
+
+        # The failed step ends its chain, and the Derivation still completes.
+        self.assertEqual(self.failed_attempts, 1)
+        self.assertTrue(derivation.complete)
+        self.assertEqual(derivation.pending_count, 0)
+        failed_step = derivation.derivationstep_set.get(failed=True)
+        self.assertEqual(failed_step.status, DerivationStep.STATUS_CRASHED)
+        self.assertEqual(failed_step.crash_reason, "RuntimeError: Unexpected error")
+
+        # It isn't one of the Derivation's (grammatically) crashed chains.
+        self.assertFalse(derivation.crashed_steps.filter(failed=True).exists())
+
+    def test_transient_error_is_retried(self):
+        results = self.get_results(self.derive(self.lexical_array))
+        self.reset_derivations()
+
+        derivation = self.derive_with_errors(OperationalError("Connection lost"), 2)
+        self.assertEqual(self.failed_attempts, 2)
+        self.assertTrue(derivation.complete)
+        self.assertFalse(derivation.derivationstep_set.filter(failed=True).exists())
+        self.assertEqual(self.get_results(derivation), results)
+
+    def test_transient_error_after_last_retry(self):
+        derivation = self.derive_with_errors(OperationalError("Connection lost"), 100)
+        self.assertEqual(self.failed_attempts, tasks.RETRY_OPTIONS["max_retries"] + 1)
+        self.assertTrue(derivation.complete)
+        failed_step = derivation.derivationstep_set.get(failed=True)
+        self.assertEqual(failed_step.crash_reason, "OperationalError: Connection lost")
+
+    def test_failed_step_is_not_reused(self):
+        results = self.get_results(self.derive(self.lexical_array))
+        self.reset_derivations()
+        derivation = self.derive_with_errors(RuntimeError("Unexpected error"), 1)
+
+        # A second Derivation over the same lexical array goes through the
+        # same states, but should process the failed one again.
+        second_derivation = self.complete(
+            create_derivation(list(Derivation.get_lexical_array(derivation.id)))
+        )
+        self.assertFalse(
+            second_derivation.derivationstep_set.filter(failed=True).exists()
+        )
+        self.assertEqual(self.get_results(second_derivation), results)
+
+
+class BaselineTests(DerivationTestCase):
+    """
+    Compares the converged and crashed chains of a range of lexical arrays
+    with the ones recorded in `test_data/baseline_derivations.json`, which
+    were derived (without pruning) before Unify, Case, InternalMerge and the
+    core Rules were rewritten to use feature masks.
+    """
+
+    baseline_file = os.path.join(
+        os.path.dirname(__file__), "test_data", "baseline_derivations.json"
+    )
+
+    def setUp(self):
+        super().setUp()
+        with open(self.baseline_file, encoding="utf-8") as f:
+            self.baseline = json.load(f)
+
+    def get_chain_data(self, words: str, prune: bool) -> Dict[str, List]:
+        """
+        Derives the given lexical array from scratch, and returns its
+        serialised converged and crashed chains in the same form as the
+        baseline data.
+        :param words:
+        :param prune:
+        :return:
+        """
+        lexical_array: List[LexicalItem] = []
+        for word in words.split():
+            text, language = word.rsplit("/", 1)
+            lexical_array.append(LexicalItem.objects.get(text=text, language=language))
+        derivation = self.complete(create_derivation(lexical_array, prune=prune))
+        self.assertTrue(derivation.complete)
+
+        data = DerivationChainSerializer(derivation).data
+        return {
+            key: sorted(
+                ([self.step_repr(step) for step in chain] for chain in data[key]),
+                key=lambda chain: json.dumps(chain, sort_keys=True, ensure_ascii=False),
+            )
+            for key in ("converged_chains", "crashed_chains")
+        }
+
+    @classmethod
+    def step_repr(cls, step: Dict) -> Dict:
+        """
+        Reduces a serialised DerivationStep to the fields that the baseline
+        data records.
+        :param step:
+        :return:
+        """
+        return {
+            "status": step["status"],
+            "root_so": cls.so_repr(step["root_so"]),
+            "crash_reason": step.get("crash_reason") or "",
+            "rule_errors": step["rule_errors"],
+            "last_generator": (step["generator_metadata"] or {}).get("last_generator"),
+        }
+
+    @classmethod
+    def so_repr(cls, so: Optional[Dict]) -> Optional[str]:
+        """
+        Flattens a serialised SO tree into a single string, e.g.:
+        "T{Tense|}(John{N|Case}(...) ...)"
+        :param so:
+        :return:
+        """
+        if so is None:
+            return None
+        result = "{}{}{{{}|{}}}".format(
+            so["text"],
+            "*" if so["is_copy"] else "",
+            so["feature_string"],
+            so["deleted_feature_string"],
+        )
+        children = so.get("children") or []
+        if children:
+            result += "({})".format(" ".join(cls.so_repr(child) for child in children))
+        return result
+
+    def test_baseline_chains(self):
+        for words, expected in self.baseline.items():
+            with self.subTest(words=words):
+                self.assertEqual(self.get_chain_data(words, prune=False), expected)
+                self.reset_derivations()
+
+    def test_baseline_converged_chains_with_pruning(self):
+        for words, expected in self.baseline.items():
+            with self.subTest(words=words):
+                results = self.get_chain_data(words, prune=True)
+                self.assertEqual(
+                    results["converged_chains"], expected["converged_chains"]
+                )
+                self.reset_derivations()
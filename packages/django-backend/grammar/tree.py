@@ -0,0 +1,665 @@
+"""
+An in-memory representation of SyntacticObject trees.
+
+Generators, Rules and the unification procedures all operate on `SONode`
+trees rather than on `SyntacticObject` model instances, so that building up
+and checking candidate structures is a CPU-bound operation instead of a
+database-bound one.
+
+- A DerivationStep's root SO is loaded into an `SONode` tree once, at the
+  start of processing (`load_root_so()`).
+
+- SONodes are immutable.  Operations that would mutate a SyntacticObject
+  (e.g., moving features to `deleted_features` during unification) return
+  new SONodes instead.  Only the changed nodes (and the paths above them)
+  are copied; unchanged subtrees are shared between the old and new trees.
+
+- The same sharing carries over to the database: new trees are written to
+  the shared store (`store_trees()`) when the next DerivationSteps are
+  created, and only the nodes that are not already stored are written.
+
+- Features are held as bitmasks over the worker's `FeatureRegistry`, so
+  checking, deleting and moving features are bit operations.
+
+- Every SONode has a canonical content hash (`digest`), computed from its
+  own properties and the digests of its children.  Structurally identical
+  SONodes compare equal in O(1), and are stored as a single
+  SharedSyntacticObject.
+
+- Every SONode also carries summaries of the features within its subtree
+  (`subtree_features`, `uninterpretable_count`), computed from those of its
+  children when it is built, so that searches can skip subtrees that
+  cannot contain what they are looking for.
+
+- MPTT `SyntacticObject` trees are only created (`SONode.to_model()`) when a
+  root SO actually needs to be displayed.
+"""
+import hashlib
+import json
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.db import connection, transaction
+
+from grammar.models import (
+    DerivationStep,
+    SharedSyntacticObject,
+    SharedSyntacticObjectChild,
+    SyntacticObject,
+)
+from lexicon.registry import FeatureMask, feature_registry
+
+# Type aliases
+# The position of a node within some tree, as a sequence of child indices
+# starting from the root.
+NodePath = Tuple[int, ...]
+
+
+class SONode:
+    """
+    An immutable, in-memory SyntacticObject (sub)tree.
+
+    Mirrors the inherent properties of the `SyntacticObject` model; features
+    are held as `FeatureMask`s (see `lexicon.registry`), and children as a
+    tuple of SONodes.
+
+    SONodes compare equal if they are structurally identical, i.e., if they
+    have the same `digest`.
+    """
+
+    __slots__ = (
+        "text",
+        "current_language",
+        "features",
+        "deleted_features",
+        "is_copy",
+        "children",
+        "stored_id",
+        "digest",
+        "subtree_features",
+        "uninterpretable_count",
+    )
+
+    def __init__(
+        self,
+        text: str = "",
+        current_language: str = "",
+        features: FeatureMask = 0,
+        deleted_features: FeatureMask = 0,
+        is_copy: bool = False,
+        children: Tuple["SONode", ...] = (),
+        stored_id: Optional[str] = None,
+    ):
+        set_attr = object.__setattr__
+        set_attr(self, "text", text)
+        set_attr(self, "current_language", current_language)
+        set_attr(self, "features", features)
+        set_attr(self, "deleted_features", deleted_features)
+        set_attr(self, "is_copy", is_copy)
+        set_attr(self, "children", tuple(children))
+        # The id of the SharedSyntacticObject this node was loaded from or
+        # stored as, if any.
+        set_attr(self, "stored_id", stored_id)
+        set_attr(self, "digest", self._compute_digest())
+
+        # Summaries of the features within this subtree, for pruning searches
+        subtree_features = features
+        uninterpretable_count = (
+            0
+            if is_copy
+            else bin(features & feature_registry.uninterpretable_mask).count("1")
+        )
+        for child in self.children:
+            subtree_features |= child.subtree_features
+            uninterpretable_count += child.uninterpretable_count
+        # All the active features on this node and its descendants
+        set_attr(self, "subtree_features", subtree_features)
+        # The number of active uninterpretable features on this node and its
+        # descendants, not counting those on copies
+        set_attr(self, "uninterpretable_count", uninterpretable_count)
+
+    def _compute_digest(self) -> str:
+        """
+        Computes the canonical content hash for this node, from its text,
+        language, active and deleted features, copy status, and (in order)
+        the digests of its children.
+        :return:
+        """
+        content = json.dumps(
+            [
+                self.text,
+                self.current_language,
+                feature_registry.pks(self.features),
+                feature_registry.pks(self.deleted_features),
+                self.is_copy,
+                [child.digest for child in self.children],
+            ]
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @property
+    def content_id(self) -> str:
+        """
+        The id that this node is stored under in the shared store, derived
+        from its digest.
+        :return:
+        """
+        return str(uuid.UUID(hex=self.digest[:32]))
+
+    def __eq__(self, other):
+        return isinstance(other, SONode) and self.digest == other.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("SONodes are immutable; use `.evolve()` instead.")
+
+    def __delattr__(self, key):
+        raise AttributeError("SONodes are immutable.")
+
+    def evolve(self, **changes) -> "SONode":
+        """
+        Returns a copy of this node with the given attributes changed.
+        The new node is not associated with any SharedSyntacticObject, but
+        its unchanged children are shared with this node.
+        :param changes:
+        :return:
+        """
+        attrs = {
+            "text": self.text,
+            "current_language": self.current_language,
+            "features": self.features,
+            "deleted_features": self.deleted_features,
+            "is_copy": self.is_copy,
+            "children": self.children,
+        }
+        attrs.update(changes)
+        return SONode(**attrs)
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Traversal
+
+    def walk(self, path: NodePath = ()) -> Iterator[Tuple[NodePath, "SONode"]]:
+        """
+        Yields (path, node) pairs for this node and all its descendants,
+        in pre-order (i.e., the same order as the MPTT tree).
+        :param path: The path to this node, if it is not the root.
+        :return:
+        """
+        stack = [(path, self)]
+        while stack:
+            this_path, node = stack.pop()
+            yield this_path, node
+            for idx in range(len(node.children) - 1, -1, -1):
+                stack.append((this_path + (idx,), node.children[idx]))
+
+    def walk_features(
+        self, features: FeatureMask, path: NodePath = ()
+    ) -> Iterator[Tuple[NodePath, "SONode"]]:
+        """
+        As with `.walk()`, but only yields the nodes that carry any of the
+        given active features.  Subtrees that do not contain any of them
+        are skipped entirely.
+        :param features:
+        :param path: The path to this node, if it is not the root.
+        :return:
+        """
+        stack = [(path, self)]
+        while stack:
+            this_path, node = stack.pop()
+            if not node.subtree_features & features:
+                continue
+            if node.features & features:
+                yield this_path, node
+            for idx in range(len(node.children) - 1, -1, -1):
+                stack.append((this_path + (idx,), node.children[idx]))
+
+    def get_node(self, path: NodePath) -> "SONode":
+        """
+        Returns the descendant of this node at the given path.
+        :param path:
+        :return:
+        """
+        node = self
+        for idx in path:
+            node = node.children[idx]
+        return node
+
+    def replace_nodes(self, replacements: Dict[NodePath, "SONode"]) -> "SONode":
+        """
+        Returns a new tree with the nodes at the given paths replaced.
+
+        Nodes are addressed by position rather than identity, since the same
+        SONode may legitimately appear in more than one position within a
+        tree (e.g., after Internal Merge).
+        :param replacements: A Dict mapping paths to their new nodes.
+        :return:
+        """
+        # Replacements for descendants are applied on top of any replacement
+        # for this node itself.
+        base = replacements.get((), self)
+
+        # Group the remaining replacements by the child they fall under.
+        by_child: Dict[int, Dict[NodePath, SONode]] = {}
+        for path, node in replacements.items():
+            if path:
+                by_child.setdefault(path[0], {})[path[1:]] = node
+
+        if not by_child:
+            return base
+
+        children = list(base.children)
+        for idx, child_replacements in by_child.items():
+            children[idx] = children[idx].replace_nodes(child_replacements)
+        return base.evolve(children=tuple(children))
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Feature helpers
+
+    def delete_features(self, features: FeatureMask) -> "SONode":
+        """
+        Returns a copy of this node with the given features moved from
+        `features` to `deleted_features`.
+        :param features:
+        :return:
+        """
+        if not features:
+            return self
+        return self.evolve(
+            features=self.features & ~features,
+            deleted_features=self.deleted_features | features,
+        )
+
+    # For rule messages and debugging; matches `SyntacticObject`
+    def feature_string(self):
+        return ", ".join(
+            [
+                str(feature)
+                for feature in sorted(feature_registry.features(self.features), key=str)
+            ]
+        )
+
+    def deleted_feature_string(self):
+        return ", ".join(
+            [
+                str(feature)
+                for feature in sorted(
+                    feature_registry.features(self.deleted_features), key=str
+                )
+            ]
+        )
+
+    def __str__(self):
+        return "{} ({}) {}".format(
+            self.text, self.current_language, self.feature_string()
+        )
+
+    def __repr__(self):
+        return "<SONode: {}>".format(self)
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Database interaction
+
+    @staticmethod
+    def from_shared(shared_so_id) -> "SONode":
+        """
+        Loads the tree rooted at the SharedSyntacticObject with the given id
+        into memory.
+        :param shared_so_id:
+        :return:
+        """
+        return SONode.from_shared_many([shared_so_id])[0]
+
+    @staticmethod
+    def from_shared_many(shared_so_ids: Iterable) -> List["SONode"]:
+        """
+        Loads the trees rooted at the SharedSyntacticObjects with the given
+        ids into memory.
+
+        The child links for all the trees are retrieved with a single
+        recursive query, and the nodes themselves with one more (plus one
+        query each for the `features` and `deleted_features` links).
+        Subtrees that are shared in the database are shared in memory as
+        well, within and between the trees.
+        :param shared_so_ids:
+        :return: The root SONodes, in the same order as `shared_so_ids`
+        """
+        root_ids = [uuid.UUID(str(shared_so_id)) for shared_so_id in shared_so_ids]
+        if not root_ids:
+            return []
+        links = _get_subtree_links(root_ids)
+
+        child_ids: Dict[uuid.UUID, List[uuid.UUID]] = {
+            root_id: [] for root_id in root_ids
+        }
+        for parent_id, child_id, _ in sorted(links, key=lambda link: link[2]):
+            child_ids.setdefault(parent_id, []).append(child_id)
+            child_ids.setdefault(child_id, [])
+
+        rows = SharedSyntacticObject.objects.filter(id__in=child_ids.keys())
+        rows = {row.id: row for row in rows}
+        features = _get_feature_masks(
+            SharedSyntacticObject.features.through,
+            "sharedsyntacticobject_id",
+            child_ids.keys(),
+        )
+        deleted_features = _get_feature_masks(
+            SharedSyntacticObject.deleted_features.through,
+            "sharedsyntacticobject_id",
+            child_ids.keys(),
+        )
+
+        nodes: Dict[uuid.UUID, SONode] = {}
+
+        def build(node_id: uuid.UUID) -> SONode:
+            if node_id not in nodes:
+                row = rows[node_id]
+                nodes[node_id] = SONode(
+                    text=row.text,
+                    current_language=row.current_language,
+                    features=features.get(node_id, 0),
+                    deleted_features=deleted_features.get(node_id, 0),
+                    is_copy=row.is_copy,
+                    children=tuple(build(child_id) for child_id in child_ids[node_id]),
+                    stored_id=str(node_id),
+                )
+            return nodes[node_id]
+
+        return [build(root_id) for root_id in root_ids]
+
+    @staticmethod
+    def from_model(so: SyntacticObject) -> "SONode":
+        """
+        Loads the MPTT SyntacticObject tree rooted at the given SO into memory.
+        The whole tree is retrieved with a single MPTT range query (plus one
+        query each for the `features` and `deleted_features` links).
+
+        The resulting nodes are not associated with the shared store.
+        :param so:
+        :return:
+        """
+        rows: List[SyntacticObject] = list(so.get_descendants(include_self=True))
+        row_ids = [row.id for row in rows]
+        features = _get_feature_masks(
+            SyntacticObject.features.through, "syntacticobject_id", row_ids
+        )
+        deleted_features = _get_feature_masks(
+            SyntacticObject.deleted_features.through, "syntacticobject_id", row_ids
+        )
+
+        # The rows come back in tree order, so every child is listed after its
+        # parent, and siblings are listed in order.
+        child_ids: Dict[str, List[str]] = {row.id: [] for row in rows}
+        for row in rows:
+            if row.parent_id in child_ids and row.id != so.id:
+                child_ids[row.parent_id].append(row.id)
+
+        # Build the nodes bottom-up.
+        nodes: Dict[str, SONode] = {}
+        for row in reversed(rows):
+            nodes[row.id] = SONode(
+                text=row.text,
+                current_language=row.current_language,
+                features=features.get(row.id, 0),
+                deleted_features=deleted_features.get(row.id, 0),
+                is_copy=row.is_copy,
+                children=tuple(nodes[child_id] for child_id in child_ids[row.id]),
+            )
+
+        return nodes[so.id]
+
+    def to_model(self, parent: SyntacticObject = None) -> SyntacticObject:
+        """
+        Writes this tree to the database as a new MPTT SyntacticObject tree,
+        optionally under the given parent.
+        The whole tree is written with a constant number of bulk queries.
+        :param parent:
+        :return: The SyntacticObject corresponding to this node.
+        """
+        rows: List[SyntacticObject] = []
+        feature_ids: Dict[uuid.UUID, List[int]] = {}
+        deleted_feature_ids: Dict[uuid.UUID, List[int]] = {}
+
+        # Number the nodes in tree order, as MPTT would.
+        counter = 1
+
+        def add_row(node: SONode, parent_id: Optional[uuid.UUID], level: int):
+            nonlocal counter
+            row = SyntacticObject(
+                id=uuid.uuid4(),
+                text=node.text,
+                current_language=node.current_language,
+                parent_id=parent_id,
+                is_copy=node.is_copy,
+                lft=counter,
+                level=level,
+            )
+            counter += 1
+            rows.append(row)
+            feature_ids[row.id] = feature_registry.pks(node.features)
+            deleted_feature_ids[row.id] = feature_registry.pks(node.deleted_features)
+
+            for child in node.children:
+                add_row(child, row.id, level + 1)
+
+            row.rght = counter
+            counter += 1
+
+        add_row(self, None, 0)
+
+        return SyntacticObject.objects.bulk_insert_tree(
+            rows, feature_ids, deleted_feature_ids, parent=parent
+        )
+
+
+# -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,
+# Shared store helpers
+
+
+def load_root_so(step: DerivationStep) -> Optional[SONode]:
+    """
+    Loads the root SO of the given DerivationStep into memory, if it has one.
+    :param step:
+    :return:
+    """
+    if step.shared_root_so_id is not None:
+        return SONode.from_shared(step.shared_root_so_id)
+    if step.root_so_id is not None:
+        # DerivationSteps created before the shared store was introduced
+        return SONode.from_model(step.root_so)
+    return None
+
+
+def load_root_sos(steps: Iterable[DerivationStep]) -> List[Optional[SONode]]:
+    """
+    As with `load_root_so()`, but for several DerivationSteps at once: The
+    root SOs in the shared store are loaded in one go.
+    :param steps:
+    :return: The root SO for each step, in the same order as `steps`
+    """
+    steps = list(steps)
+    shared_sos = iter(
+        SONode.from_shared_many(
+            [
+                step.shared_root_so_id
+                for step in steps
+                if step.shared_root_so_id is not None
+            ]
+        )
+    )
+    return [
+        next(shared_sos) if step.shared_root_so_id is not None else load_root_so(step)
+        for step in steps
+    ]
+
+
+def store_trees(roots: Iterable[SONode]) -> List[str]:
+    """
+    Writes the given trees to the shared store.
+
+    Nodes are stored under their content ids, so identical subtrees are only
+    ever stored once, no matter which derivation or worker produced them.
+    Only the nodes that are not already in the store are written; all the
+    new nodes, feature links and child links are created in a handful of
+    bulk queries.
+    :param roots:
+    :return: The ids of the SharedSyntacticObjects for the given roots.
+    """
+    roots = list(roots)
+
+    # Collect the nodes that are not associated with a stored node yet,
+    # children first.
+    unstored: List[SONode] = []
+    new_nodes: Dict[str, SONode] = {}
+
+    def collect(node: SONode):
+        if node.stored_id is not None:
+            return
+        unstored.append(node)
+        if node.content_id in new_nodes:
+            return
+        for child in node.children:
+            collect(child)
+        new_nodes[node.content_id] = node
+
+    for root in roots:
+        collect(root)
+
+    # Identical nodes may already have been stored, by this worker or by
+    # another.
+    existing = {
+        str(node_id)
+        for node_id in SharedSyntacticObject.objects.filter(
+            id__in=new_nodes.keys()
+        ).values_list("id", flat=True)
+    }
+    new_nodes = {
+        content_id: node
+        for content_id, node in new_nodes.items()
+        if content_id not in existing
+    }
+
+    if new_nodes:
+        features_through = SharedSyntacticObject.features.through
+        deleted_features_through = SharedSyntacticObject.deleted_features.through
+
+        rows = []
+        feature_links = []
+        deleted_feature_links = []
+        child_links = []
+        for node_id, node in new_nodes.items():
+            rows.append(
+                SharedSyntacticObject(
+                    id=node_id,
+                    text=node.text,
+                    current_language=node.current_language,
+                    is_copy=node.is_copy,
+                )
+            )
+            feature_links += [
+                features_through(sharedsyntacticobject_id=node_id, feature_id=pk)
+                for pk in feature_registry.pks(node.features)
+            ]
+            deleted_feature_links += [
+                deleted_features_through(
+                    sharedsyntacticobject_id=node_id, feature_id=pk
+                )
+                for pk in feature_registry.pks(node.deleted_features)
+            ]
+            child_links += [
+                SharedSyntacticObjectChild(
+                    parent_id=node_id,
+                    child_id=child.stored_id or child.content_id,
+                    order=idx,
+                )
+                for idx, child in enumerate(node.children)
+            ]
+
+        # Other workers may be storing some of the same nodes concurrently;
+        # since the ids are content-derived, their rows are identical to ours.
+        with transaction.atomic():
+            SharedSyntacticObject.objects.bulk_create(rows, ignore_conflicts=True)
+            features_through.objects.bulk_create(feature_links, ignore_conflicts=True)
+            deleted_features_through.objects.bulk_create(
+                deleted_feature_links, ignore_conflicts=True
+            )
+            SharedSyntacticObjectChild.objects.bulk_create(
+                child_links, ignore_conflicts=True
+            )
+
+    # The nodes are now associated with their stored versions.
+    for node in unstored:
+        object.__setattr__(node, "stored_id", node.content_id)
+
+    return [root.stored_id for root in roots]
+
+
+def _get_subtree_links(root_ids: List) -> List[Tuple[uuid.UUID, uuid.UUID, int]]:
+    """
+    Retrieves all the (parent_id, child_id, order) links within the trees
+    rooted at the given SharedSyntacticObjects, with a single recursive
+    query.
+    :param root_ids:
+    :return:
+    """
+    qn = connection.ops.quote_name
+    table = qn(SharedSyntacticObjectChild._meta.db_table)
+    parent = qn(SharedSyntacticObjectChild._meta.get_field("parent").column)
+    child = qn(SharedSyntacticObjectChild._meta.get_field("child").column)
+    order = qn("order")
+
+    sql = (
+        "WITH RECURSIVE subtree (parent_id, child_id, child_order) AS ("
+        "  SELECT {parent}, {child}, {order} FROM {table}"
+        "  WHERE {parent} IN ({placeholders})"
+        "  UNION"
+        "  SELECT link.{parent}, link.{child}, link.{order} FROM {table} link"
+        "  INNER JOIN subtree ON link.{parent} = subtree.child_id"
+        ") SELECT parent_id, child_id, child_order FROM subtree"
+    ).format(
+        table=table,
+        parent=parent,
+        child=child,
+        order=order,
+        placeholders=", ".join(["%s"] * len(root_ids)),
+    )
+
+    parent_field = SharedSyntacticObjectChild._meta.get_field("parent")
+    with connection.cursor() as cursor:
+        cursor.execute(
+            sql,
+            [
+                parent_field.get_db_prep_value(root_id, connection)
+                for root_id in root_ids
+            ],
+        )
+        return [
+            (uuid.UUID(str(parent_id)), uuid.UUID(str(child_id)), child_order)
+            for parent_id, child_id, child_order in cursor.fetchall()
+        ]
+
+
+def _get_feature_masks(through, column: str, ids) -> Dict:
+    """
+    Retrieves the FeatureMasks for the given objects from the given M2M
+    through table, with a single query.
+    :param through: The through model of a `features`/`deleted_features` field
+    :param column: The name of the through model's field for the object's id
+    :param ids:
+    :return: A Dict mapping object ids to FeatureMasks; objects without any
+        features are omitted.
+    """
+    pks: Dict = {}
+    for object_id, feature_id in through.objects.filter(
+        **{column + "__in": list(ids)}
+    ).values_list(column, "feature_id"):
+        pks.setdefault(object_id, []).append(feature_id)
+
+    feature_registry.ensure(
+        {feature_id for feature_ids in pks.values() for feature_id in feature_ids}
+    )
+    return {
+        object_id: feature_registry.mask_from_pks(feature_ids)
+        for object_id, feature_ids in pks.items()
+    }
@@ -10,16 +10,20 @@ from .models import (
     Derivation,
     DerivationStep,
     GeneratorDescription,
+    GrammarConfiguration,
     LexicalArrayItem,
     RuleDescription,
 )
 
 
-def get_derivation_by_lexical_array(lexical_array: List[LexicalItem]) -> Derivation:
+def get_derivation_by_lexical_array(
+    lexical_array: List[LexicalItem], prune: bool = True
+) -> Derivation:
     """
     Creates or retrieves the Derivation associated with a unique array of
     LexicalItems.
     :param lexical_array:
+    :param prune: False for sub-derivations (see `Derivation.prune`)
     :return:
     """
     # We have to add `.filter()` once per lexical item/order pair,
@@ -29,7 +33,7 @@ def get_derivation_by_lexical_array(lexical_array: List[LexicalItem]) -> Derivat
     # but whose lexical arrays continue after.
     existing = Derivation.objects.annotate(
         count=Count("first_step__lexical_array_items")
-    ).filter(count=len(lexical_array))
+    ).filter(count=len(lexical_array), prune=prune)
     for [idx, lexical_item] in enumerate(lexical_array):
         existing = existing.filter(
             first_step__lexical_array_items__lexical_item=lexical_item,
@@ -39,13 +43,16 @@ def get_derivation_by_lexical_array(lexical_array: List[LexicalItem]) -> Derivat
     if len(existing) > 0:
         return existing.get()
     else:
-        return create_derivation(lexical_array)
+        return create_derivation(lexical_array, prune)
 
 
-def create_derivation(lexical_array: List[LexicalItem]) -> Derivation:
+def create_derivation(
+    lexical_array: List[LexicalItem], prune: bool = True
+) -> Derivation:
     """
     Given an array of LexicalItems, create a corresponding Derivation
     :param lexical_array:
+    :param prune: False for sub-derivations (see `Derivation.prune`)
     :return:
     """
     # Start with a DerivationStep
@@ -56,16 +63,20 @@ def create_derivation(lexical_array: List[LexicalItem]) -> Derivation:
         )
 
     # For now, add all rules and generators
-    first_step.rules.set(RuleDescription.objects.all())
-    first_step.generators.set(GeneratorDescription.objects.all())
+    first_step.configuration = GrammarConfiguration.get_for(
+        RuleDescription.objects.all(), GeneratorDescription.objects.all()
+    )
 
     # External merge only variant
-    # first_step.generators.add(
-    #     GeneratorDescription.objects.get(name="external-merge")
+    # first_step.configuration = GrammarConfiguration.get_for(
+    #     RuleDescription.objects.all(),
+    #     GeneratorDescription.objects.filter(name="external-merge"),
     # )
 
     # Create and return a Derivation
-    derivation = Derivation.objects.create(first_step=first_step)
+    derivation = Derivation.objects.create(
+        first_step=first_step, created_count=1, pending_count=1, prune=prune
+    )
     first_step.derivation = derivation
     first_step.save()
 
@@ -9,6 +9,7 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from lexicon.models import LexicalItem
+from .derive import reopen_derivation
 from .models import Derivation, DerivationRequest, SyntacticObject
 from .serializers import (
     DerivationInputSerializer,
@@ -17,7 +18,7 @@ from .serializers import (
     SyntacticObjectSerializer,
     DerivationChainSerializer,
 )
-from .tasks import derivation_actor
+from .tasks import start_derivation
 from .util import get_derivation_by_lexical_array
 
 logger = logging.getLogger("cs-toolkit")
@@ -39,6 +40,7 @@ class GenerateDerivation(APIView):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
         derivation_input = serializer.validated_data["derivation_input"]
+        budget = serializer.validated_data.get("budget", {})
 
         # Find fully specified LexicalItems for the given input array.
         lexical_item_sets = []
@@ -79,10 +81,18 @@ class GenerateDerivation(APIView):
             created_by=username,
         )
 
-        # Request processing of all the Derivations.
+        # Request processing of all the Derivations.  (The latest search
+        # budget applies to any Derivations that are still in progress, and
+        # Derivations that were cut off by a smaller budget are reopened.)
         for derivation in derivations:
             derivation_request.derivations.add(derivation)
-            derivation_actor.send(str(derivation.first_step.id))
+            if budget and not derivation.complete:
+                for limit, value in budget.items():
+                    setattr(derivation, limit, value)
+                derivation.save(update_fields=list(budget))
+            elif budget and derivation.truncated:
+                reopen_derivation(derivation, budget)
+            start_derivation(derivation)
 
         # Serialise and return DerivationRequest
         serializer = DerivationRequestSerializer(derivation_request)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class LexiconConfig(AppConfig):
     name = "lexicon"
+
+    def ready(self):
+        # noinspection PyUnresolvedReferences
+        import lexicon.signals
@@ -0,0 +1,22 @@
+# Generated by Django 2.1.7 on 2026-10-18 15:02
+
+from django.core.management import call_command
+from django.db import migrations
+
+
+def create_cache_table(apps, schema_editor):
+    """
+    Creates the table for the database cache backend (see `CACHES` in the
+    project settings), which the Feature registry uses to signal lexicon
+    changes to the task workers.  Does nothing if the table already exists.
+    """
+    call_command(
+        "createcachetable", database=schema_editor.connection.alias, verbosity=0
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("lexicon", "0002_auto_20190410_0924")]
+
+    operations = [migrations.RunPython(create_cache_table, migrations.RunPython.noop)]
@@ -16,6 +16,7 @@ directly, you should ensure that the data you are touching remains clean.
   (e.g., {name: T}, {interpretable: False}, {EPP: True})
 """
 import uuid
+from typing import Iterable
 
 from django.db import models
 from model_utils import FieldTracker
@@ -100,28 +101,36 @@ class Feature(models.Model):
         - The feature has a value of "False" if its `raw_value` is anything
           else.
 
+        Resolved from the worker-local `FeatureRegistry` (see `.registry`).
+
         :param name:
         :param value:
         :return:
         """
-        boolean_props = self.properties.filter(name=name, type="Boolean")
-        if value:
-            return boolean_props.filter(raw_value="True").exists()
-        else:
-            return boolean_props.exclude(raw_value="True").exists()
+        from .registry import feature_registry
+
+        return feature_registry.has_boolean_prop(self.pk, name, value)
 
     # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
     # Bespoke helpers (theory-internal, optional)
     @property
     def uninterpretable(self):
         """
-        Convenience function to hit the database and check whether or not this
-        feature is explicitly uninterpretable.
+        Convenience function to check whether or not this feature is
+        explicitly uninterpretable.
         :return:
         """
         return self.has_boolean_prop("interpretable", False)
 
-    def __str__(self):
+    @staticmethod
+    def build_string(name: str, properties: Iterable["FeatureProperty"]) -> str:
+        """
+        Builds the display string for a Feature with the given name and
+        FeatureProperties.
+        :param name:
+        :param properties:
+        :return:
+        """
         # Prefix/suffix will be attached to the Feature's name directly.
         # Members of additional will be displayed as a comma-separated list
         # after the Feature's name.
@@ -130,7 +139,7 @@ class Feature(models.Model):
         additional = []
 
         # Prefix: Interpretable/uninterpretable
-        interp = self.properties.filter(name="interpretable")
+        interp = [prop for prop in properties if prop.name == "interpretable"]
         if len(interp) > 0:
             if interp[0].value:
                 prefix = "i"
@@ -138,7 +147,7 @@ class Feature(models.Model):
                 prefix = "u"
 
         # Additional
-        others = self.properties.exclude(name="interpretable")
+        others = [prop for prop in properties if prop.name != "interpretable"]
         for prop in others:
             if prop.type == "Boolean":
                 if prop.value:
@@ -149,9 +158,18 @@ class Feature(models.Model):
                 additional.append("{}:{}".format(prop.name, prop.value))
 
         # Join the main feature name with any additional features
-        additional.insert(0, "{}{}{}".format(prefix, self.name, suffix))
+        additional.insert(0, "{}{}{}".format(prefix, name, suffix))
         return "[{}]".format(", ".join(additional))
 
+    def __str__(self):
+        if self.pk is None:
+            # Not saved yet, so the registry won't know about it.
+            return self.build_string(self.name, [])
+
+        from .registry import feature_registry
+
+        return feature_registry.display_string(self.pk)
+
 
 class FeatureProperty(models.Model):
     """
@@ -170,7 +188,7 @@ class FeatureProperty(models.Model):
     #: A few standard types for the FeatureProperty, for cleaning/validation
     type = models.CharField(
         max_length=10,
-        choices=[["Boolean", "Boolean"], ["Text", "Text"], ["Integer", "Integer"],],
+        choices=[["Boolean", "Boolean"], ["Text", "Text"], ["Integer", "Integer"]],
     )
 
     #: The raw value associated with this FeatureProperty.
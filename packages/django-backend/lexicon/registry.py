@@ -0,0 +1,332 @@
+"""
+A worker-local registry of Features, for use in the derivation hot path.
+
+All the Features and FeatureProperties are loaded into memory once (with
+two queries), after which a Feature's name, properties, interpretability and
+display string can be resolved without touching the database.
+
+Each Feature is also interned to a small integer index, so that a set of
+Features can be represented as an int bitmask (bit `n` set if the Feature
+with index `n` is in the set).  Checking, removing and moving features then
+becomes a matter of bit operations rather than database queries.
+
+The indices are only meaningful within the current process; anything that
+is stored or sent elsewhere should use Feature primary keys instead.  They
+are also stable for the lifetime of the process: when the registry is
+reloaded, existing Features keep their indices, so masks held by in-flight
+derivations remain valid.
+
+The registry is reloaded when a Feature or FeatureProperty changes (see
+`.signals`).  Changes made in other processes are picked up via a
+generation token kept in the Django cache, which is shared between the web
+server and the workers (see `CACHES` in the project settings).  With a
+per-process cache backend (e.g., the default `LocMemCache`), the workers
+would never see changes made through the web server.
+"""
+import logging
+import threading
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.core.cache import cache
+
+from .models import Feature
+
+logger = logging.getLogger("cs-toolkit")
+
+# Type aliases
+# A set of interned Features, as a bitmask of their indices.
+FeatureMask = int
+# A FeatureProperty, as a (name, type, raw_value) tuple.
+PropertyTuple = Tuple[str, str, str]
+
+#: The cache key for the registry generation token.
+GENERATION_KEY = "lexicon:feature_registry:generation"
+
+
+def iter_bits(mask: FeatureMask) -> Iterator[int]:
+    """
+    Yields the indices of the bits that are set in the given mask, lowest
+    first.
+    :param mask:
+    :return:
+    """
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+def lowest_bit(mask: FeatureMask) -> FeatureMask:
+    """
+    Returns a mask with only the lowest set bit of the given mask (i.e.,
+    the single Feature with the lowest index), or 0 if the mask is empty.
+    :param mask:
+    :return:
+    """
+    return mask & -mask
+
+
+class FeatureRegistry:
+    """
+    Holds the metadata for every Feature in memory, together with the
+    masks (over their interned indices) that the derivation procedures need.
+
+    Everything is (re)loaded lazily, the first time it is needed after the
+    registry is created or invalidated.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._generation: Optional[str] = None
+
+        # Index -> Feature, and Feature pk -> index.  Indices are never
+        # reassigned.
+        self._features: List[Feature] = []
+        self._indices: Dict[int, int] = {}
+
+        # Feature pk -> metadata.  Entries for deleted Features are kept, so
+        # that masks which still refer to them can be displayed.
+        self._properties: Dict[int, List[PropertyTuple]] = {}
+        self._strings: Dict[int, str] = {}
+
+        # Feature name -> mask of all the Features with that name
+        self._name_masks: Dict[str, FeatureMask] = {}
+        # FeatureProperty name -> mask of all the Features with that property
+        self._property_masks: Dict[str, FeatureMask] = {}
+        # All the Features that are explicitly uninterpretable
+        self._uninterpretable_mask: FeatureMask = 0
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Loading and invalidation
+
+    def _load(self) -> None:
+        """
+        (Re)loads every Feature, together with its properties, and rebuilds
+        the metadata and masks.
+        :return:
+        """
+        with self._lock:
+            features = list(Feature.objects.prefetch_related("properties"))
+
+            properties = dict(self._properties)
+            strings = dict(self._strings)
+            name_masks = {}
+            property_masks = {}
+            uninterpretable_mask = 0
+
+            for feature in features:
+                if feature.pk in self._indices:
+                    index = self._indices[feature.pk]
+                    self._features[index] = feature
+                else:
+                    index = len(self._features)
+                    self._features.append(feature)
+                    self._indices[feature.pk] = index
+                bit = 1 << index
+
+                feature_properties = list(feature.properties.all())
+                properties[feature.pk] = [
+                    (prop.name, prop.type, prop.raw_value)
+                    for prop in feature_properties
+                ]
+                strings[feature.pk] = Feature.build_string(
+                    feature.name, feature_properties
+                )
+
+                name_masks[feature.name] = name_masks.get(feature.name, 0) | bit
+                for prop in feature_properties:
+                    property_masks[prop.name] = property_masks.get(prop.name, 0) | bit
+
+                    # Cf. `Feature.uninterpretable`
+                    if (
+                        prop.name == "interpretable"
+                        and prop.type == "Boolean"
+                        and prop.raw_value != "True"
+                    ):
+                        uninterpretable_mask |= bit
+
+            self._properties = properties
+            self._strings = strings
+            self._name_masks = name_masks
+            self._property_masks = property_masks
+            self._uninterpretable_mask = uninterpretable_mask
+            self._loaded = True
+
+        logger.debug("Loaded {} Features into the registry.".format(len(features)))
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self._load()
+
+    def invalidate(self) -> None:
+        """
+        Marks the registry as stale in this process, and lets other processes
+        know (via the generation token) that they should reload theirs.
+        :return:
+        """
+        with self._lock:
+            self._loaded = False
+            self._generation = uuid.uuid4().hex
+            cache.set(GENERATION_KEY, self._generation, None)
+
+    @property
+    def generation(self) -> Optional[str]:
+        """
+        The generation token that this registry last saw; changes whenever
+        the lexicon does.  (None if the lexicon has not changed since the
+        cache was cleared.)
+        :return:
+        """
+        return self._generation
+
+    def refresh_if_changed(self) -> None:
+        """
+        Marks the registry as stale if some other process has invalidated
+        the registry since we last checked.
+        Meant to be called once per unit of work (e.g., at the start of each
+        DerivationStep), rather than on every lookup.
+        :return:
+        """
+        generation = cache.get(GENERATION_KEY)
+        if generation != self._generation:
+            with self._lock:
+                self._loaded = False
+                self._generation = generation
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Per-Feature metadata
+
+    def properties(self, pk: int) -> List[PropertyTuple]:
+        """
+        Returns the properties of the Feature with the given pk, as
+        (name, type, raw_value) tuples.
+        :param pk:
+        :return:
+        """
+        self.ensure([pk])
+        return self._properties.get(pk, [])
+
+    def has_boolean_prop(self, pk: int, name: str, value: bool) -> bool:
+        """
+        Checks whether the Feature with the given pk has a boolean property
+        that has been *explicitly* set to the given value.
+        (Cf. `Feature.has_boolean_prop`)
+        :param pk:
+        :param name:
+        :param value:
+        :return:
+        """
+        for prop_name, prop_type, raw_value in self.properties(pk):
+            if prop_name == name and prop_type == "Boolean":
+                if (raw_value == "True") == value:
+                    return True
+        return False
+
+    def display_string(self, pk: int) -> str:
+        """
+        Returns the display string for the Feature with the given pk.
+        :param pk:
+        :return:
+        """
+        self.ensure([pk])
+        return self._strings[pk]
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Conversions
+
+    def ensure(self, pks: Iterable[int]) -> None:
+        """
+        Makes sure that the Features with the given pks have been loaded,
+        reloading the registry (once) if any of them are new.
+        :param pks:
+        :return:
+        """
+        self._ensure_loaded()
+        if any(pk not in self._strings for pk in pks):
+            self._load()
+
+    def mask_from_pks(self, pks: Iterable[int]) -> FeatureMask:
+        """
+        Returns the mask for the Features with the given pks.
+        :param pks:
+        :return:
+        """
+        pks = set(pks)
+        self.ensure(pks)
+        mask = 0
+        for pk in pks:
+            mask |= 1 << self._indices[pk]
+        return mask
+
+    def mask(self, features: Iterable[Feature]) -> FeatureMask:
+        """
+        Returns the mask for the given Features.
+        :param features:
+        :return:
+        """
+        return self.mask_from_pks(feature.pk for feature in features)
+
+    def features(self, mask: FeatureMask) -> List[Feature]:
+        """
+        Returns the Features in the given mask.
+        :param mask:
+        :return:
+        """
+        return [self._features[index] for index in iter_bits(mask)]
+
+    def pks(self, mask: FeatureMask) -> List[int]:
+        """
+        Returns the pks of the Features in the given mask, in ascending order.
+        :param mask:
+        :return:
+        """
+        return sorted(self._features[index].pk for index in iter_bits(mask))
+
+    # -'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-.,__,.-'~'-
+    # Masks
+
+    @property
+    def uninterpretable_mask(self) -> FeatureMask:
+        """
+        The mask of all the Features that are explicitly uninterpretable.
+        :return:
+        """
+        self._ensure_loaded()
+        return self._uninterpretable_mask
+
+    def name_mask(self, name: str) -> FeatureMask:
+        """
+        Returns the mask of all the Features with the given name.
+        :param name:
+        :return:
+        """
+        self._ensure_loaded()
+        return self._name_masks.get(name, 0)
+
+    def property_mask(self, name: str) -> FeatureMask:
+        """
+        Returns the mask of all the Features that have a property with the
+        given name, regardless of its value.
+        :param name:
+        :return:
+        """
+        self._ensure_loaded()
+        return self._property_masks.get(name, 0)
+
+    def same_name_mask(self, mask: FeatureMask) -> FeatureMask:
+        """
+        Returns the mask of all the Features that share a name with any of
+        the Features in the given mask.
+        :param mask:
+        :return:
+        """
+        same_name = 0
+        for name in {feature.name for feature in self.features(mask)}:
+            same_name |= self.name_mask(name)
+        return same_name
+
+
+#: The registry for the current process.
+feature_registry = FeatureRegistry()
@@ -0,0 +1,40 @@
+import logging
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Feature, FeatureProperty, LexicalItem
+from .registry import feature_registry
+
+logger = logging.getLogger("cs-toolkit")
+
+
+@receiver(post_save, sender=Feature, dispatch_uid="lexicon_feature_saved")
+@receiver(post_delete, sender=Feature, dispatch_uid="lexicon_feature_deleted")
+@receiver(post_save, sender=FeatureProperty, dispatch_uid="lexicon_property_saved")
+@receiver(post_delete, sender=FeatureProperty, dispatch_uid="lexicon_property_deleted")
+@receiver(
+    m2m_changed,
+    sender=Feature.properties.through,
+    dispatch_uid="lexicon_feature_properties_changed",
+)
+@receiver(
+    m2m_changed,
+    sender=LexicalItem.features.through,
+    dispatch_uid="lexicon_lexical_item_features_changed",
+)
+def invalidate_feature_registry(action="", **kwargs):
+    """
+    Invalidate the `FeatureRegistry` whenever a Feature or FeatureProperty
+    (or the Features of a LexicalItem) changes, so that the new metadata is
+    picked up by this process (and, via the registry generation token, by
+    the workers).
+    Runs after the current database transaction (if any) has been committed,
+    as with the `notify` change notifications.
+    """
+    if action and not action.startswith("post_"):
+        return
+
+    logger.debug("Lexicon changed; invalidating the Feature registry.")
+    transaction.on_commit(feature_registry.invalidate)
@@ -1,3 +1,48 @@
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TransactionTestCase
 
-# Create your tests here.
+from lexicon.models import Feature, FeatureProperty, LexicalItem
+from lexicon.registry import FeatureRegistry
+
+
+class FeatureRegistryTests(TransactionTestCase):
+    def test_cache_is_shared(self):
+        # The registry generation token has to reach the task workers, which
+        # run in separate processes.
+        self.assertNotIsInstance(cache, LocMemCache)
+
+    def test_refresh_after_feature_edit(self):
+        # Stands in for the registry of another process (e.g., a task
+        # worker); it only learns about changes via the generation token.
+        worker_registry = FeatureRegistry()
+
+        feature = Feature.objects.create(name="Case", description="")
+        worker_registry.refresh_if_changed()
+        self.assertEqual(worker_registry.display_string(feature.pk), "[Case]")
+        self.assertFalse(
+            worker_registry.mask([feature]) & worker_registry.uninterpretable_mask
+        )
+
+        # Make the Feature uninterpretable.
+        interpretable = FeatureProperty.objects.create(
+            name="interpretable", type="Boolean", raw_value="False", description=""
+        )
+        feature.properties.add(interpretable)
+
+        worker_registry.refresh_if_changed()
+        self.assertEqual(worker_registry.display_string(feature.pk), "[uCase]")
+        self.assertTrue(
+            worker_registry.mask([feature]) & worker_registry.uninterpretable_mask
+        )
+
+    def test_refresh_after_lexical_item_edit(self):
+        worker_registry = FeatureRegistry()
+        feature = Feature.objects.create(name="Case", description="")
+        lexical_item = LexicalItem.objects.create(text="John", language="en")
+        worker_registry.refresh_if_changed()
+        generation = worker_registry.generation
+
+        lexical_item.features.add(feature)
+        worker_registry.refresh_if_changed()
+        self.assertNotEqual(worker_registry.generation, generation)